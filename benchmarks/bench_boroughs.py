@@ -0,0 +1,107 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+WEBAPP = os.path.join(ROOT, 'webapp')
+sys.path.insert(0, ROOT)
+
+from common.boroughs import BoroughIndex, boroughs_path, load_index  # noqa: E402
+
+
+def sjoin_labels(lng, lat, boundaries_path):
+    # Labels as the dashboard used to assign them at every start.
+    import geopandas as gpd
+
+    boundaries = gpd.read_file(boundaries_path)
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lng, lat), crs=boundaries.crs)
+    joined = gpd.sjoin(points, boundaries, predicate='within')
+    joined = joined[~joined.index.duplicated()]
+    return joined['name'].reindex(points.index).to_numpy(dtype=object)
+
+
+def bench_append(directory, rows):
+    # Converts a copy of the traffic feed, appends rows to it and converts
+    # again, against converting the appended file from scratch.
+    import ingest
+
+    scratch = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(directory, ingest.BOROUGH_BOUNDARIES), scratch)
+        csv_path = os.path.join(scratch, 'traffic.csv')
+        shutil.copy(os.path.join(directory, 'traffic.csv'), csv_path)
+        os.chdir(scratch)
+        ingest.convert('traffic.csv')
+        with open(csv_path) as f:
+            lines = f.readlines()[1:rows + 1]
+        with open(csv_path, 'a') as f:
+            f.writelines(lines)
+
+        start = time.perf_counter()
+        ingest.convert('traffic.csv')
+        appended = time.perf_counter() - start
+        incremental = ingest.load_feed('traffic.csv')
+
+        os.remove(ingest.columnar_path('traffic.csv'))
+        start = time.perf_counter()
+        ingest.convert('traffic.csv')
+        full = time.perf_counter() - start
+        same = incremental.equals(ingest.load_feed('traffic.csv'))
+    finally:
+        os.chdir(ROOT)
+        shutil.rmtree(scratch, ignore_errors=True)
+    print(f"append {len(lines)} rows {appended:8.2f} s   full conversion {full:.2f} s   same frame: {same}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare labeling points by borough with sjoin and with the cached index")
+    parser.add_argument('--dir', default=WEBAPP, help="webapp directory holding the borough polygons and feeds")
+    parser.add_argument('--points', type=int, default=1000000)
+    parser.add_argument('--append', type=int, default=1000, help="rows appended to traffic.csv, if present")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.dir)
+    sys.path.insert(0, directory)
+    boundaries_path = os.path.join(directory, 'new-york-city-boroughs.geojson')
+
+    # Uniform over the city's bounding box, so many points fall near a
+    # shoreline or borough line, or in the water.
+    rng = np.random.default_rng(args.seed)
+    lng = rng.uniform(-74.26, -73.70, args.points)
+    lat = rng.uniform(40.49, 40.92, args.points)
+
+    start = time.perf_counter()
+    expected = sjoin_labels(lng, lat, boundaries_path)
+    print(f"sjoin        {time.perf_counter() - start:8.2f} s")
+
+    start = time.perf_counter()
+    index = BoroughIndex.from_geojson(boundaries_path)
+    print(f"build index  {time.perf_counter() - start:8.2f} s   once per polygon file, "
+          f"{index.grid.shape[1]}x{index.grid.shape[0]} grid")
+    index.save(boroughs_path(boundaries_path))
+    start = time.perf_counter()
+    index = load_index(boundaries_path)
+    print(f"load index   {time.perf_counter() - start:8.2f} s")
+
+    start = time.perf_counter()
+    labels = index.labels(lng, lat)
+    seconds = time.perf_counter() - start
+    print(f"label        {seconds:8.2f} s   {args.points / seconds / 1e6:.1f}M points/s")
+
+    inside = int(labels.notna().sum())
+    labels = labels.to_numpy(dtype=object)
+    agree = sum(a == b or (a != a and b != b) for a, b in zip(labels, expected))
+    print(f"agree with sjoin on {agree} of {args.points} points, {inside} inside a borough")
+
+    if args.append and os.path.exists(os.path.join(directory, 'traffic.csv')):
+        bench_append(directory, args.append)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder'))
+
+import networkx as nx
+import osmnx as ox
+
+from ch import ContractionHierarchy, ch_path
+from routing import RoutingEngine
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def report(name, timings):
+    ms = [t * 1000 for t in timings]
+    print(f"{name:<14} mean {statistics.mean(ms):9.3f} ms   p50 {percentile(ms, 50):9.3f} ms   p95 {percentile(ms, 95):9.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare contraction hierarchy queries with nx.shortest_path")
+    parser.add_argument('--graph', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder', 'weighted_graph.graphml'))
+    parser.add_argument('--pairs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--rebuild', action='store_true', help="build the hierarchy even if one is saved next to the graph")
+    args = parser.parse_args()
+
+    G = ox.load_graphml(filepath=args.graph)
+    for u, v, data in G.edges(data=True):
+        if 'weight' in data:
+            data['weight'] = float(data['weight'])
+    engine = RoutingEngine.from_graph(G, weight='weight')
+    print(f"{engine.num_nodes} nodes, {engine.num_edges} edges")
+
+    path = ch_path(args.graph)
+    if os.path.exists(path) and not args.rebuild:
+        start = time.perf_counter()
+        engine.hierarchy = ContractionHierarchy.load(path, engine)
+        print(f"Loaded hierarchy in {time.perf_counter() - start:.2f}s")
+    else:
+        start = time.perf_counter()
+        engine.hierarchy = ContractionHierarchy.build(engine)
+        print(f"Preprocessing took {time.perf_counter() - start:.1f}s")
+    print(f"{engine.hierarchy.num_arcs} arcs, {engine.hierarchy.nbytes / 1e6:.1f} MB")
+
+    rnd = random.Random(args.seed)
+    nodes = list(G.nodes)
+    pairs = [(rnd.choice(nodes), rnd.choice(nodes)) for _ in range(args.pairs)]
+
+    timings = {'networkx': [], 'dijkstra': [], 'ch': []}
+    mismatches = 0
+    for source, target in pairs:
+        start = time.perf_counter()
+        try:
+            expected = nx.shortest_path(G, source=source, target=target, weight='weight')
+        except nx.NetworkXNoPath:
+            expected = None
+        timings['networkx'].append(time.perf_counter() - start)
+
+        for method in ('dijkstra', 'ch'):
+            start = time.perf_counter()
+            try:
+                route = engine.shortest_path(source, target, method=method)
+            except nx.NetworkXNoPath:
+                route = None
+            timings[method].append(time.perf_counter() - start)
+            if route != expected:
+                mismatches += 1
+
+    for name, values in timings.items():
+        report(name, values)
+    print(f"{mismatches} routes differ from nx.shortest_path")
+
+
+if __name__ == '__main__':
+    main()
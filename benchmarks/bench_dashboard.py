@@ -0,0 +1,61 @@
+import argparse
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+WEBAPP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webapp')
+
+
+def fetch_page(client, threads):
+    # The page and every chart it links to, the charts fetched side by
+    # side as a browser would. Returns the seconds taken and bytes sent.
+    start = time.perf_counter()
+    page = client.get('/')
+    urls = re.findall(r'src="(/charts/[^"]+)"', page.get_data(as_text=True))
+    with ThreadPoolExecutor(threads) as pool:
+        charts = list(pool.map(client.get, urls))
+    return time.perf_counter() - start, len(page.data), sum(len(r.data) for r in charts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold and warm latency of the dashboard page and its charts")
+    parser.add_argument('--dir', default=WEBAPP, help="webapp directory holding the source CSVs")
+    parser.add_argument('--requests', type=int, default=20, help="warm requests to average over")
+    parser.add_argument('--threads', type=int, default=6, help="charts fetched at once")
+    args = parser.parse_args()
+
+    os.chdir(args.dir)
+    sys.path.insert(0, os.getcwd())
+    start = time.perf_counter()
+    import main as webapp
+    print(f"import and load {time.perf_counter() - start:8.2f} s")
+
+    # A scratch cache directory, so the first request really is cold.
+    cache_dir = tempfile.mkdtemp()
+    webapp.dashboard.cache_dir = cache_dir
+    client = webapp.app.test_client()
+    try:
+        cold, page_bytes, chart_bytes = fetch_page(client, args.threads)
+        warm = [fetch_page(client, args.threads)[0] for _ in range(args.requests)]
+
+        # As after a restart: nothing in memory, the page values on disk.
+        webapp.dashboard._values.clear()
+        webapp.charts.cache = webapp.ChartCache()
+        restart = fetch_page(client, args.threads)[0]
+    finally:
+        webapp.charts.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    print(f"cold            {cold * 1000:10.1f} ms   page and charts built from the loaded data")
+    print(f"warm            {statistics.mean(warm) * 1000:10.1f} ms   mean of {args.requests}, max {max(warm) * 1000:.1f} ms")
+    print(f"restarted       {restart * 1000:10.1f} ms   page from disk, charts drawn again")
+    print(f"page {page_bytes / 1024:.1f} KB, charts {chart_bytes / 1024:.1f} KB fetched separately "
+          f"with {webapp.charts.processes} chart processes")
+
+if __name__ == '__main__':
+    main()
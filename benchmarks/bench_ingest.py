@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+WEBAPP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webapp')
+FILES = ['collisions.csv', 'constructions.csv', 'traffic.csv']
+
+
+def legacy_load():
+    # The feeds as main.py used to load them at import time.
+    import geopandas as gpd
+    import pandas as pd
+
+    collision_data = pd.read_csv('collisions.csv')
+    construction_data = pd.read_csv('constructions.csv')
+    traffic_data = pd.read_csv('traffic.csv')
+    collision_data = collision_data[collision_data['borough'] != '0']
+    construction_data = construction_data[construction_data['borough'] != '0']
+    construction_data['data_as_of'] = pd.to_datetime(construction_data['data_as_of'])
+    construction_data['data_as_of'] = construction_data['data_as_of'].apply(lambda d: d.replace(year=2023))
+    borough_boundaries = gpd.read_file('new-york-city-boroughs.geojson')
+    traffic_geo = gpd.GeoDataFrame(traffic_data, geometry=gpd.points_from_xy(traffic_data['longitude'], traffic_data['latitude']))
+    traffic_geo_with_borough = gpd.sjoin(traffic_geo, borough_boundaries, predicate='within')
+    traffic_data['borough'] = traffic_geo_with_borough['name']
+    return collision_data, construction_data, traffic_data
+
+
+def columnar_load():
+    from functions import load_data
+    return load_data(FILES)
+
+
+def resident_mb():
+    # Current resident set size; peak size where /proc is not available.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child(mode):
+    # Runs in a fresh interpreter: imports first, so only the load itself is
+    # timed, and resident memory is read before and after it.
+    import geopandas  # noqa: F401
+    import pandas  # noqa: F401
+    import pyarrow  # noqa: F401
+    import functions  # noqa: F401
+
+    before = resident_mb()
+    start = time.perf_counter()
+    frames = legacy_load() if mode == 'legacy' else columnar_load()
+    seconds = time.perf_counter() - start
+    after = resident_mb()
+    print(json.dumps({
+        'seconds': seconds,
+        'rss_mb': after - before,
+        'frames_mb': sum(df.memory_usage(deep=True).sum() for df in frames) / 2 ** 20,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare loading the raw CSV feeds with their typed columnar copies")
+    parser.add_argument('--dir', default=WEBAPP, help="webapp directory holding the source CSVs")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', choices=['legacy', 'columnar'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.chdir(args.dir)
+    sys.path.insert(0, os.getcwd())
+    if args.child:
+        child(args.child)
+        return
+
+    import ingest
+    start = time.perf_counter()
+    for path in FILES:
+        ingest.convert(path)
+    print(f"conversion  {time.perf_counter() - start:8.2f} s   once per new CSV")
+
+    for mode in ('legacy', 'columnar'):
+        runs = []
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--dir', args.dir, '--child', mode],
+                                 check=True, capture_output=True, text=True).stdout
+            runs.append(json.loads(out.strip().splitlines()[-1]))
+        best = min(runs, key=lambda r: r['seconds'])
+        print(f"{mode:<10} {best['seconds']:8.2f} s   resident +{best['rss_mb']:7.1f} MB   frames {best['frames_mb']:7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder'))
+
+import numpy as np
+
+from matrix import MatrixRouter
+from routing import RoutingEngine
+from snapshot import load_graph
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time many-to-many routing matrices")
+    parser.add_argument('--graph', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder', 'weighted_graph.graphml'))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--baseline-pairs', type=int, default=20,
+                        help="pairs routed one at a time with nx.shortest_path to extrapolate the old cost, 0 to skip")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    snapshot = load_graph(args.graph)
+    engine = RoutingEngine.from_snapshot(snapshot)
+    print(f"{engine.num_nodes} nodes, {engine.num_edges} edges, {os.cpu_count()} cores")
+    rng = np.random.default_rng(args.seed)
+
+    per_pair = None
+    if args.baseline_pairs:
+        import networkx as nx
+        import osmnx as ox
+        G = ox.load_graphml(filepath=args.graph)
+        for u, v, data in G.edges(data=True):
+            if 'weight' in data:
+                data['weight'] = float(data['weight'])
+        pairs = engine.node_ids[rng.integers(0, engine.num_nodes, (args.baseline_pairs, 2))].tolist()
+        start = time.perf_counter()
+        for source, target in pairs:
+            try:
+                nx.shortest_path(G, source=source, target=target, weight='weight')
+            except nx.NetworkXNoPath:
+                pass
+        per_pair = (time.perf_counter() - start) / len(pairs)
+
+    serial = MatrixRouter(engine, snapshot, processes=1)
+    pooled = MatrixRouter(engine, snapshot, args.graph, processes=args.processes)
+    # Start the workers outside the timings, as a running app would have.
+    pooled.matrix(engine.node_ids[:pooled.processes * 32].tolist(), engine.node_ids[:1].tolist())
+
+    for size in args.sizes:
+        sources = engine.node_ids[rng.integers(0, engine.num_nodes, size)].tolist()
+        targets = engine.node_ids[rng.integers(0, engine.num_nodes, size)].tolist()
+        line = f"{size:>4} x {size:<4}"
+        for name, router in (('serial', serial), (f'{args.processes} processes', pooled)):
+            start = time.perf_counter()
+            router.matrix(sources, targets)
+            line += f"   {name} {time.perf_counter() - start:8.2f} s"
+        if per_pair is not None:
+            line += f"   nx.shortest_path per pair ~{per_pair * size * size:10.1f} s"
+        print(line)
+    pooled.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+PATH_FINDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder')
+
+
+def legacy_page(app, route, start, end):
+    # The route page as it used to be built: every street edge and every
+    # hazard marker added to a folium map on each request.
+    import folium
+    snapshot = app.snapshot
+    mymap = folium.Map(location=[(start[0] + end[0]) / 2, (start[1] + end[1]) / 2], zoom_start=10,
+                       tiles='CartoDB positron', control_scale=True)
+    ys, xs = snapshot.y.tolist(), snapshot.x.tolist()
+    for u, v in zip(snapshot.edge_u.tolist(), snapshot.edge_v.tolist()):
+        folium.PolyLine([(ys[u], xs[u]), (ys[v], xs[v])], color='gray', weight=1).add_to(mymap)
+    folium.PolyLine(app.engine.coordinates(route), color='red', weight=3).add_to(mymap)
+    for df, column, label, color in ((app.df1, 'Average_volume', 'Traffic Volume ', 'blue'),
+                                     (app.df2, 'award', 'Construction Award ', 'green'),
+                                     (app.df3, 'total_casualties', 'Total Collision Casuality', 'red')):
+        for _, row in df.iterrows():
+            folium.Marker([row['latitude'], row['longitude']], popup=f'{label}{row[column]}',
+                          icon=folium.Icon(color=color)).add_to(mymap)
+    folium.Marker(start, popup='Start Location', icon=folium.Icon(color='black')).add_to(mymap)
+    folium.Marker(end, popup='End Location', icon=folium.Icon(color='black')).add_to(mymap)
+    return mymap.get_root().render().encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure route page size and render time")
+    parser.add_argument('--dir', default=PATH_FINDER, help="path finder directory holding weighted_graph.graphml")
+    parser.add_argument('--requests', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.chdir(args.dir)
+    sys.path.insert(0, os.getcwd())
+    import app
+
+    rnd = random.Random(args.seed)
+    nodes = app.snapshot.num_nodes
+    points = {}
+    for i in range(args.requests):
+        for end in ('a', 'b'):
+            n = rnd.randrange(nodes)
+            points[f'{end}{i}'] = (float(app.snapshot.y[n]), float(app.snapshot.x[n]))
+    app.get_coordinates = lambda address: points.get(address, (None, None))
+    client = app.app.test_client()
+
+    rows = {'legacy': ([], []), 'current': ([], [])}
+    for i in range(args.requests):
+        start, end = points[f'a{i}'], points[f'b{i}']
+        source, target = app.spatial_index.nearest_nodes([start[1], end[1]], [start[0], end[0]]).tolist()
+        route = app.engine.shortest_path(source, target, method=app.ROUTING_METHOD)
+
+        t = time.perf_counter()
+        body = legacy_page(app, route, start, end)
+        rows['legacy'][0].append(time.perf_counter() - t)
+        rows['legacy'][1].append(len(body))
+
+        t = time.perf_counter()
+        page = client.post('/', data={'start_location': f'a{i}', 'end_location': f'b{i}'})
+        route = client.post('/api/route', json={'start': f'a{i}', 'end': f'b{i}'})
+        rows['current'][0].append(time.perf_counter() - t)
+        rows['current'][1].append(len(page.data) + len(route.data))
+
+    for name, (seconds, sizes) in rows.items():
+        print(f"{name:<8} render {statistics.mean(seconds) * 1000:9.1f} ms   response {statistics.mean(sizes) / 1024:10.1f} KB")
+    print("current is the route page plus its /api/route JSON")
+    for url in (app.STREETS_URL, app.HAZARDS_URL):
+        print(f"static   {url}: {os.path.getsize(url.lstrip('/')) / 1024:.1f} KB, fetched once per browser")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder'))
+
+import numpy as np
+import osmnx as ox
+
+from snapshot import load_graph
+from spatial import SpatialIndex, load_index, spatial_path
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare snapping with osmnx and with the cached spatial index")
+    parser.add_argument('--graph', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder', 'weighted_graph.graphml'))
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--loop-points', type=int, default=200, help="points snapped one call at a time, like the notebook")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    snapshot = load_graph(args.graph)
+    if os.path.exists(spatial_path(args.graph)):
+        os.remove(spatial_path(args.graph))
+    _, build = timed(load_index, args.graph, snapshot)
+    index, load = timed(SpatialIndex.load, spatial_path(args.graph), snapshot)
+    print(f"Index build {build:.3f}s, load from disk {load:.3f}s")
+
+    rng = np.random.default_rng(args.seed)
+    X = rng.uniform(snapshot.x.min(), snapshot.x.max(), args.points)
+    Y = rng.uniform(snapshot.y.min(), snapshot.y.max(), args.points)
+    G = ox.load_graphml(filepath=args.graph)
+
+    def loop(fn):
+        return [fn(G, x, y) for x, y in zip(X[:args.loop_points], Y[:args.loop_points])]
+
+    rows = [
+        ('ox nearest_nodes, loop', timed(loop, ox.distance.nearest_nodes)[1] / args.loop_points),
+        ('ox nearest_edges, loop', timed(loop, ox.distance.nearest_edges)[1] / args.loop_points),
+        ('ox nearest_nodes, batch', timed(ox.distance.nearest_nodes, G, X, Y)[1] / args.points),
+        ('ox nearest_edges, batch', timed(ox.distance.nearest_edges, G, X, Y)[1] / args.points),
+        ('index nearest_nodes', timed(index.nearest_nodes, X, Y)[1] / args.points),
+        ('index nearest_edges', timed(index.nearest_edges, X, Y)[1] / args.points),
+    ]
+    for name, seconds in rows:
+        print(f"{name:<26} {seconds * 1e6:10.1f} us/point   {seconds * args.points:8.3f} s for {args.points} points")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PATH_FINDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'path finder')
+sys.path.insert(0, PATH_FINDER)
+
+
+def memory():
+    # Resident memory split into private (anonymous) pages and pages mapped
+    # from files, which other workers mapping the same snapshot share.
+    fields = {}
+    with open('/proc/self/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            if name in ('VmRSS', 'RssAnon', 'RssFile'):
+                fields[name] = int(value.split()[0]) / 1024
+    return fields
+
+
+def load(mode, graph):
+    start = time.perf_counter()
+    from routing import RoutingEngine
+    if mode == 'graphml':
+        import osmnx as ox
+        G = ox.load_graphml(filepath=graph)
+        for u, v, data in G.edges(data=True):
+            if 'weight' in data:
+                data['weight'] = float(data['weight'])
+        engine = RoutingEngine.from_graph(G, weight='weight')
+    else:
+        from snapshot import GraphSnapshot, snapshot_path
+        engine = RoutingEngine.from_snapshot(GraphSnapshot.load(snapshot_path(graph)))
+    elapsed = time.perf_counter() - start
+    # Build the routing matrix, so the pages a request touches are resident too.
+    engine.matrix()
+    print(json.dumps(dict(memory(), seconds=elapsed)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare path finder startup from GraphML and from the binary snapshot")
+    parser.add_argument('--graph', default=os.path.join(PATH_FINDER, 'weighted_graph.graphml'))
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--load', choices=('graphml', 'snapshot'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        load(args.load, args.graph)
+        return
+
+    from snapshot import build_snapshot
+    start = time.perf_counter()
+    build_snapshot(args.graph)
+    print(f"Snapshot build took {time.perf_counter() - start:.1f}s")
+
+    for mode in ('graphml', 'snapshot'):
+        results = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, __file__, '--graph', args.graph, '--load', mode],
+                                 capture_output=True, text=True, check=True).stdout
+            results.append(json.loads(out.strip().splitlines()[-1]))
+        best = min(results, key=lambda r: r['seconds'])
+        print(f"{mode:<9} load {best['seconds']:7.3f} s   RSS {best['VmRSS']:7.1f} MB   "
+              f"private {best['RssAnon']:7.1f} MB   file-backed {best['RssFile']:7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
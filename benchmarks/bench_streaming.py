@@ -0,0 +1,118 @@
+import argparse
+import json
+import math
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+WEBAPP = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webapp')
+FILES = ['collisions.csv', 'constructions.csv', 'traffic.csv']
+
+
+def peak_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def resident_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:
+        return peak_mb()
+
+
+def whole(year):
+    # The year's aggregates as the dashboard computed them: every feed read
+    # whole, then sliced and grouped.
+    from functions import HOUR_COLUMNS, aggregate_crash_data, filter_crash_data, filter_traffic_data, read_data
+
+    collision_data, construction_data, traffic_data = read_data()
+    traffic = filter_traffic_data(traffic_data, year)
+    crashes = aggregate_crash_data(filter_crash_data(collision_data, year))
+    return crashes, traffic[HOUR_COLUMNS].mean(), len(traffic)
+
+
+def streamed(year, chunk_rows):
+    from functions import HOUR_COLUMNS
+    from streaming import CRASH_COLUMNS, CRASH_KEYS, CrashAggregate, HourlyVolume, aggregate, in_year, read_chunks
+
+    crashes, = aggregate(in_year(read_chunks('collisions.csv', ['crash_date', *CRASH_KEYS, *CRASH_COLUMNS], chunk_rows),
+                                 'crash_date', year), CrashAggregate())
+    volume, = aggregate(in_year(read_chunks('traffic.csv', ['Date', *HOUR_COLUMNS], chunk_rows), 'Date', year),
+                        HourlyVolume())
+    return crashes.result(), volume.by_hour(), int(volume.counts.iloc[:, 0].sum())
+
+
+def child(mode, year, chunk_rows):
+    import pandas  # noqa: F401
+    import functions  # noqa: F401
+    import streaming  # noqa: F401
+
+    before = resident_mb()
+    start = time.perf_counter()
+    crashes, hourly, traffic_rows = whole(year) if mode == 'whole' else streamed(year, chunk_rows)
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        'seconds': seconds,
+        'base_mb': before,
+        'peak_mb': peak_mb(),
+        'locations': len(crashes),
+        'casualties': float(crashes['total_casualties'].sum()),
+        'hourly': float(hourly.sum()),
+        'traffic_rows': traffic_rows,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare whole-table and chunked aggregation of synthetic feeds")
+    parser.add_argument('--collisions', type=int, default=2000000)
+    parser.add_argument('--traffic', type=int, default=500000)
+    parser.add_argument('--year', type=int, default=2022)
+    parser.add_argument('--chunk-rows', type=int, default=200000)
+    parser.add_argument('--keep', help="directory to write the feeds to and keep, instead of a temporary one")
+    parser.add_argument('--child', choices=['whole', 'streamed'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        os.chdir(args.keep)
+        sys.path.insert(0, os.path.abspath(WEBAPP))
+        child(args.child, args.year, args.chunk_rows)
+        return
+
+    directory = args.keep or tempfile.mkdtemp()
+    try:
+        if not all(os.path.exists(os.path.join(directory, f)) for f in FILES):
+            start = time.perf_counter()
+            os.makedirs(directory, exist_ok=True)
+            synthetic.write(os.path.join(directory, 'collisions.csv'), synthetic.collisions, args.collisions)
+            synthetic.write(os.path.join(directory, 'traffic.csv'), synthetic.traffic, args.traffic, seed=1)
+            shutil.copy(os.path.join(WEBAPP, 'constructions.csv'), directory)
+            shutil.copy(os.path.join(WEBAPP, 'new-york-city-boroughs.geojson'), directory)
+            print(f"generated   {time.perf_counter() - start:8.2f} s   {args.collisions} collisions, {args.traffic} traffic counts")
+        size = sum(os.path.getsize(os.path.join(directory, f)) for f in FILES) / 2 ** 20
+        print(f"feeds       {size:8.1f} MB")
+
+        results = {}
+        for mode in ('whole', 'streamed'):
+            out = subprocess.run([sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--child', mode,
+                                  '--keep', directory, '--year', str(args.year), '--chunk-rows', str(args.chunk_rows)],
+                                 check=True, capture_output=True, text=True).stdout
+            results[mode] = result = json.loads(out.strip().splitlines()[-1])
+            print(f"{mode:<10} {result['seconds']:8.2f} s   peak {result['peak_mb']:7.1f} MB, "
+                  f"{result['base_mb']:.1f} MB of it taken before reading")
+        same = all(math.isclose(results['whole'][k], results['streamed'][k], rel_tol=1e-9)
+                   for k in ('locations', 'casualties', 'hourly', 'traffic_rows'))
+        print(f"same aggregates: {same}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+PATH_FINDER = os.path.join(BENCHMARKS, '..', 'path finder')
+WEBAPP = os.path.join(BENCHMARKS, '..', 'webapp')
+
+# Input sizes by name; --grid and the row counts override them.
+SCALES = {
+    'small': {'grid': 60, 'collisions': 100000, 'traffic': 20000, 'constructions': 2000},
+    'city': {'grid': 150, 'collisions': 2000000, 'traffic': 500000, 'constructions': 8000},
+}
+# The generated inputs of each app; anything else in its directory was
+# derived from them by an earlier run and is removed before a cold start.
+INPUTS = {
+    'path_finder': ['weighted_graph.graphml', 'traffic_clustered.csv', 'construction_clustered.csv',
+                    'collision_clustered.csv'],
+    'webapp': ['collisions.csv', 'constructions.csv', 'traffic.csv', 'new-york-city-boroughs.geojson'],
+}
+# Metrics where a larger number is better; for the rest smaller is.
+HIGHER_IS_BETTER = ('per_s',)
+# Suffixes of the timings, rates and sizes compared between runs; counts
+# such as nodes are only shown.
+MEASURED = ('_s', '_ms', '_mb')
+
+
+def peak_mb():
+    # The process's own peak resident memory. ru_maxrss would carry over
+    # the parent's from before the exec.
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def at(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'mean': sum(samples) / len(samples)}
+
+
+def path_finder(args):
+    # Startup, route latency and matrix throughput of the path finder app,
+    # as one process serving requests sees them.
+    import numpy as np
+
+    start = time.perf_counter()
+    import app
+    startup = time.perf_counter() - start
+
+    client = app.app.test_client()
+    snapshot = app.snapshot
+    rng = np.random.default_rng(args.seed)
+    pairs = rng.integers(0, snapshot.num_nodes, (args.routes, 2))
+    latencies, failed = [], 0
+    for s, t in pairs.tolist():
+        body = {'start_lat': float(snapshot.y[s]), 'start_lng': float(snapshot.x[s]),
+                'end_lat': float(snapshot.y[t]), 'end_lng': float(snapshot.x[t])}
+        started = time.perf_counter()
+        response = client.post('/api/route', json=body)
+        latencies.append((time.perf_counter() - started) * 1000)
+        failed += response.status_code != 200
+
+    nodes = rng.integers(0, snapshot.num_nodes, 2 * args.matrix)
+    points = np.column_stack([snapshot.y[nodes], snapshot.x[nodes]]).tolist()
+    body = {'origins': points[:args.matrix], 'destinations': points[args.matrix:]}
+    started = time.perf_counter()
+    for _ in range(args.matrix_runs):
+        client.post('/api/matrix', json=body)
+    seconds = (time.perf_counter() - started) / args.matrix_runs
+    app.matrix_router.close()
+    return {
+        'startup_s': startup,
+        'route_ms': percentiles(latencies),
+        'routes_failed': failed,
+        'matrix_s': seconds,
+        'matrix_cells_per_s': args.matrix ** 2 / seconds,
+        'method': app.ROUTING_METHOD,
+        'nodes': int(snapshot.num_nodes),
+        'edges': int(snapshot.num_edges),
+    }
+
+
+def dashboard(args):
+    # Startup and render time of the dashboard page, the first request and
+    # then repeated ones.
+    start = time.perf_counter()
+    import main
+    startup = time.perf_counter() - start
+
+    client = main.app.test_client()
+    started = time.perf_counter()
+    page = client.get('/')
+    first = (time.perf_counter() - started) * 1000
+    renders = []
+    for _ in range(args.renders):
+        started = time.perf_counter()
+        client.get('/')
+        renders.append((time.perf_counter() - started) * 1000)
+    main.charts.close()
+    return {
+        'startup_s': startup,
+        'first_render_ms': first,
+        'render_ms': percentiles(renders),
+        'page_kb': len(page.data) / 1024,
+    }
+
+
+def child(args):
+    os.chdir(args.data)
+    app_dir = PATH_FINDER if args.child == 'path_finder' else WEBAPP
+    sys.path.insert(0, os.path.abspath(app_dir))
+    result = path_finder(args) if args.child == 'path_finder' else dashboard(args)
+    result['peak_mb'] = peak_mb()
+    print(json.dumps(result))
+
+
+def generate(directory, params, seed):
+    # The synthetic inputs for params in directory, written again only when
+    # they were made for other params.
+    stamp = os.path.join(directory, 'params.json')
+    wanted = dict(params, seed=seed)
+    try:
+        with open(stamp) as f:
+            if json.load(f) == wanted:
+                return 0.0
+    except (OSError, ValueError):
+        pass
+    start = time.perf_counter()
+    shutil.rmtree(directory, ignore_errors=True)
+    synthetic.write_path_finder(os.path.join(directory, 'path_finder'), params['grid'], seed=seed)
+    synthetic.write_webapp(os.path.join(directory, 'webapp'), params['collisions'], params['traffic'],
+                           params['constructions'], seed)
+    with open(stamp, 'w') as f:
+        json.dump(wanted, f)
+    return time.perf_counter() - start
+
+
+def clean(directory, inputs):
+    for name in os.listdir(directory):
+        if name not in inputs:
+            path = os.path.join(directory, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+
+def run_child(name, directory, args):
+    command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--child', name,
+               '--data', directory, '--seed', str(args.seed), '--routes', str(args.routes),
+               '--matrix', str(args.matrix), '--matrix-runs', str(args.matrix_runs), '--renders', str(args.renders)]
+    env = dict(os.environ, NAVGUARD_GEOCODER='offline', NAVGUARD_GEOCODE_DB=os.path.join(directory, 'geocode.sqlite'),
+               NAVGUARD_MATRIX_PROCESSES=str(args.processes), NAVGUARD_CHART_PROCESSES=str(args.processes))
+    out = subprocess.run(command, capture_output=True, text=True, env=env)
+    if out.returncode:
+        sys.exit(f"The {name} benchmark failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, previous, tolerance):
+    # Prints each metric against the previous run's; returns the names of
+    # those worse by more than tolerance.
+    old, new = flatten(previous['results']), flatten(results)
+    worse = []
+    for name in sorted(set(old) & set(new)):
+        if not old[name]:
+            continue
+        change = new[name] / old[name] - 1
+        if name.endswith(HIGHER_IS_BETTER):
+            change = -change
+        flag = ''
+        if change > tolerance and any(part.endswith(MEASURED) for part in name.split('.')):
+            flag = '   REGRESSION'
+            worse.append(name)
+        print(f"{name:<40} {old[name]:12.2f} {new[name]:12.2f}   {change * 100:+6.1f}%{flag}")
+    return worse
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark both apps offline on synthetic inputs and write the "
+                                                 "results as JSON")
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--grid', type=int, help="intersections per side of the street grid")
+    parser.add_argument('--collisions', type=int)
+    parser.add_argument('--traffic', type=int)
+    parser.add_argument('--constructions', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--routes', type=int, default=200, help="route requests timed")
+    parser.add_argument('--matrix', type=int, default=50, help="origins and destinations per matrix request")
+    parser.add_argument('--matrix-runs', type=int, default=3)
+    parser.add_argument('--renders', type=int, default=20, help="dashboard renders timed after the first")
+    parser.add_argument('--processes', type=int, default=1, help="matrix and chart worker processes")
+    parser.add_argument('--data', help="directory to keep the generated inputs in and reuse, "
+                                       "instead of a temporary one")
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--compare', metavar='JSON', help="results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="share by which a metric may be worse before it counts as a regression")
+    parser.add_argument('--child', choices=['path_finder', 'dashboard'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    params = dict(SCALES[args.scale])
+    for key in params:
+        if getattr(args, key) is not None:
+            params[key] = getattr(args, key)
+    directory = args.data or tempfile.mkdtemp()
+    results = {}
+    try:
+        generated = generate(directory, params, args.seed)
+        if generated:
+            print(f"generated        {generated:8.2f} s   {params}")
+        # Each app is started twice: first with nothing derived from its
+        # inputs on disk, then again as after a restart.
+        for name, app_dir in (('path_finder', 'path_finder'), ('dashboard', 'webapp')):
+            clean(os.path.join(directory, app_dir), INPUTS[app_dir])
+            first = run_child(name, os.path.join(directory, app_dir), args)
+            second = run_child(name, os.path.join(directory, app_dir), args)
+            results[name] = dict(second, startup_cold_s=first['startup_s'], peak_cold_mb=first['peak_mb'])
+            if name == 'dashboard':
+                results[name]['first_render_cold_ms'] = first['first_render_ms']
+    finally:
+        if not args.data:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    pf, db = results['path_finder'], results['dashboard']
+    print(f"path finder      {pf['nodes']} nodes, {pf['edges']} edges, routing with {pf['method']}")
+    print(f"  startup        {pf['startup_cold_s']:8.2f} s cold, {pf['startup_s']:.2f} s warm")
+    print(f"  route          {pf['route_ms']['p50']:8.2f} ms p50, {pf['route_ms']['p90']:.2f} ms p90, "
+          f"{pf['route_ms']['p99']:.2f} ms p99, {pf['routes_failed']} of {args.routes} without a route")
+    print(f"  matrix         {pf['matrix_cells_per_s']:8.0f} cells/s, {args.matrix}x{args.matrix} in {pf['matrix_s']:.3f} s")
+    print(f"  peak memory    {pf['peak_mb']:8.1f} MB, {pf['peak_cold_mb']:.1f} MB on the cold start")
+    print("dashboard")
+    print(f"  startup        {db['startup_cold_s']:8.2f} s cold, {db['startup_s']:.2f} s warm")
+    print(f"  first render   {db['first_render_cold_ms']:8.1f} ms cold, {db['first_render_ms']:.1f} ms warm")
+    print(f"  render         {db['render_ms']['p50']:8.2f} ms p50, {db['render_ms']['p99']:.2f} ms p99, "
+          f"{db['page_kb']:.1f} KB page")
+    print(f"  peak memory    {db['peak_mb']:8.1f} MB, {db['peak_cold_mb']:.1f} MB on the cold start")
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'params': dict(params, seed=args.seed, routes=args.routes, matrix=args.matrix,
+                           renders=args.renders, processes=args.processes),
+        },
+        'results': results,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if previous['meta']['params'] != report['meta']['params']:
+            print("Warning: the runs used different inputs or settings")
+        worse = compare(results, previous, args.tolerance)
+        if worse:
+            print(f"{len(worse)} metrics regressed by more than {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+BOROUGHS = ['BROOKLYN', 'QUEENS', 'MANHATTAN', 'BRONX', 'STATEN ISLAND']
+CONSTRUCTION_TYPES = ['CIP', 'CAP', 'LL11', 'ELEC']
+FACTORS = ['Unspecified', 'Driver Inattention/Distraction', 'Following Too Closely',
+           'Failure to Yield Right-of-Way', 'Passing or Lane Usage Improper']
+STREETS = ['BROADWAY', 'BEDFORD AVENUE', 'QUEENS BOULEVARD', 'EAST 91 STREET', 'GLENWOOD ROAD', 'CLARKSON AVENUE']
+CASUALTY_COLUMNS = [
+    'number_of_persons_injured', 'number_of_persons_killed',
+    'number_of_pedestrians_injured', 'number_of_pedestrians_killed',
+    'number_of_cyclist_injured', 'number_of_cyclist_killed',
+    'number_of_motorist_injured', 'number_of_motorist_killed',
+]
+HOUR_COLUMNS = [
+    '_12_00_1_00_am', '_1_00_2_00am', '_2_00_3_00am', '_3_00_4_00am',
+    '_4_00_5_00am', '_5_00_6_00am', '_6_00_7_00am', '_7_00_8_00am',
+    '_8_00_9_00am', '_9_00_10_00am', '_10_00_11_00am', '_11_00_12_00pm',
+    '_12_00_1_00pm', '_1_00_2_00pm', '_2_00_3_00pm', '_3_00_4_00pm',
+    '_4_00_5_00pm', '_5_00_6_00pm', '_6_00_7_00pm', '_7_00_8_00pm',
+    '_8_00_9_00pm', '_9_00_10_00pm', '_10_00_11_00pm', '_11_00_12_00am',
+]
+# Points fall on a grid of about 100 m, so locations repeat as the
+# intersections in the real feeds do.
+LAT = (40.55, 40.90)
+LNG = (-74.15, -73.75)
+
+CHUNK_ROWS = 500000
+# Intersections per side of the street grid; 150 gives about 22,000 nodes
+# and 72,000 edges.
+GRID = 150
+# Share of streets that are one-way and of grid points left out, so routes
+# are not all straight lines.
+ONE_WAY = 0.3
+MISSING = 0.03
+# (kind, value column) of the cluster files the path finder loads.
+CLUSTERED = [('traffic', 'Average_volume'), ('construction', 'award'), ('collision', 'total_casualties')]
+
+
+def dates(rng, n, first, years):
+    return pd.Timestamp(first) + pd.to_timedelta(rng.integers(0, years * 365, n), 'D')
+
+
+def points(rng, n):
+    return rng.uniform(*LAT, n).round(3), rng.uniform(*LNG, n).round(3)
+
+
+def collisions(rng, n, start=0):
+    # n rows shaped like the NYC collision feed, 2016 to 2023.
+    lat, lng = points(rng, n)
+    df = pd.DataFrame({
+        'crash_date': dates(rng, n, '2016-01-01', 8).strftime('%Y-%m-%d'),
+        'crash_time': pd.to_timedelta(rng.integers(0, 24 * 60, n), 'min').astype(str),
+        'borough': rng.choice(BOROUGHS, n),
+        'zip_code': rng.integers(10001, 11697, n),
+        'latitude': lat,
+        'longitude': lng,
+        'on_street_name': rng.choice(STREETS, n),
+        'off_street_name': rng.choice(STREETS, n),
+    })
+    for column in CASUALTY_COLUMNS:
+        df[column] = rng.poisson(0.3, n)
+    df['contributing_factor_vehicle_1'] = rng.choice(FACTORS, n)
+    df['contributing_factor_vehicle_2'] = rng.choice(FACTORS, n)
+    df['collision_id'] = np.arange(start, start + n)
+    df['vehicle_type_code1'] = '4 dr sedan'
+    df['vehicle_type_code2'] = 'Station Wagon/Sport Utility Vehicle'
+    return df
+
+
+def traffic(rng, n, start=0):
+    # n rows shaped like the ATR hourly traffic counts, 2019 to 2023.
+    lat, lng = points(rng, n)
+    df = pd.DataFrame({
+        'ID': np.arange(start, start + n),
+        'SegmentID': rng.integers(1, 5000, n),
+        'Roadway_Name': rng.choice(STREETS, n),
+        'From_St': rng.choice(STREETS, n),
+        'To_St': rng.choice(STREETS, n),
+        'Direction': rng.choice(['NB', 'SB', 'EB', 'WB'], n),
+        'Date': dates(rng, n, '2019-01-01', 5).strftime('%m/%d/%Y'),
+    })
+    for column in HOUR_COLUMNS:
+        df[column] = rng.integers(0, 1500, n)
+    df['latitude'] = lat
+    df['longitude'] = lng
+    return df
+
+
+def constructions(rng, n, start=0):
+    # n rows shaped like the school construction projects feed.
+    lat, lng = points(rng, n)
+    borough = rng.choice(BOROUGHS, n)
+    return pd.DataFrame({
+        'unique_id': np.arange(start + 1, start + n + 1),
+        'name': pd.Series(rng.integers(1, 500, n)).map('P.S. {}'.format),
+        'boro': pd.Series(borough).str[0],
+        'geo_dist': rng.integers(1, 33, n),
+        'projdesc': rng.choice(['FIRE ALARM SYSTEM REPLACEMENT', 'ROOF REPLACEMENT', 'BOILER CONVERSION'], n),
+        'award': rng.uniform(0, 5000, n).round(2),
+        'consttype': rng.choice(CONSTRUCTION_TYPES, n),
+        'buildingid': pd.Series(rng.integers(1, 999, n)).map('K{:03d}'.format),
+        'building_address': rng.choice(STREETS, n),
+        'city': pd.Series(borough).str.title(),
+        'zip_code': rng.integers(10001, 11697, n),
+        'borough': borough,
+        'latitude': lat,
+        'longitude': lng,
+        'nta': pd.Series(rng.integers(1, 99, n)).map('BK{:02d}01'.format),
+        # The feed dates its projects in 1900, which has no 29 February.
+        'data_as_of': dates(rng, n, '1900-01-01', 1).strftime('%Y-%m-%d'),
+    })
+
+
+def clustered(rng, n, column):
+    # n cluster centres as clustering.py writes them, values from 0 to 100.
+    lat, lng = rng.uniform(*LAT, n), rng.uniform(*LNG, n)
+    return pd.DataFrame({'latitude': lat, 'longitude': lng, column: rng.uniform(0, 100, n).round(2),
+                         'borough': rng.choice(BOROUGHS, n)})
+
+
+def borough_polygons():
+    # The area the feeds cover cut into five bands, one per borough, as a
+    # GeoJSON FeatureCollection like the city's borough boundaries.
+    edges = np.linspace(*LNG, len(BOROUGHS) + 1)
+    features = []
+    for name, west, east in zip(BOROUGHS, edges[:-1], edges[1:]):
+        ring = [[west, LAT[0]], [east, LAT[0]], [east, LAT[1]], [west, LAT[1]], [west, LAT[0]]]
+        features.append({'type': 'Feature', 'properties': {'name': name.title()},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def street_graph(rng, grid=GRID):
+    # A grid of two-way and one-way streets over the area the feeds cover,
+    # as an osmnx MultiDiGraph with x/y nodes and length, weight and name
+    # on every edge.
+    import networkx as nx
+
+    rows = cols = grid
+    lat = np.linspace(*LAT, rows)[:, None] + rng.uniform(-1e-4, 1e-4, (rows, cols))
+    lng = np.linspace(*LNG, cols)[None, :] + rng.uniform(-1e-4, 1e-4, (rows, cols))
+    present = rng.random((rows, cols)) >= MISSING
+    ids = 1000000 + np.arange(rows * cols).reshape(rows, cols)
+
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    G.add_nodes_from((int(ids[i, j]), {'x': float(lng[i, j]), 'y': float(lat[i, j])})
+                     for i, j in zip(*np.nonzero(present)))
+    for di, dj, prefix in ((0, 1, 'Street'), (1, 0, 'Avenue')):
+        a = (slice(0, rows - di), slice(0, cols - dj))
+        b = (slice(di, rows), slice(dj, cols))
+        both = present[a] & present[b]
+        u, v = ids[a][both], ids[b][both]
+        lat1, lng1, lat2, lng2 = lat[a][both], lng[a][both], lat[b][both], lng[b][both]
+        length = 6371009 * np.hypot(np.radians(lat2 - lat1), np.radians(lng2 - lng1) * np.cos(np.radians(lat1)))
+        weight = length * (1 + rng.uniform(0, 2, len(u)))
+        line = np.nonzero(both)[0 if prefix == 'Street' else 1]
+        one_way = rng.random(len(u)) < ONE_WAY
+        for k in range(len(u)):
+            data = {'length': float(length[k]), 'weight': float(weight[k]), 'name': f'{line[k]} {prefix}'}
+            G.add_edge(int(u[k]), int(v[k]), **data)
+            if not one_way[k]:
+                G.add_edge(int(v[k]), int(u[k]), **data)
+    return G
+
+
+def write(path, make, rows, seed=0, chunk_rows=CHUNK_ROWS):
+    # Writes rows rows of make() to path a chunk at a time.
+    rng = np.random.default_rng(seed)
+    for start in range(0, rows, chunk_rows):
+        n = min(chunk_rows, rows - start)
+        make(rng, n, start).to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+    return path
+
+
+def write_webapp(directory, n_collisions, n_traffic, n_constructions, seed=0):
+    # Everything the dashboard reads, in directory.
+    os.makedirs(directory, exist_ok=True)
+    write(os.path.join(directory, 'collisions.csv'), collisions, n_collisions, seed)
+    write(os.path.join(directory, 'traffic.csv'), traffic, n_traffic, seed + 1)
+    write(os.path.join(directory, 'constructions.csv'), constructions, n_constructions, seed + 2)
+    with open(os.path.join(directory, 'new-york-city-boroughs.geojson'), 'w') as f:
+        json.dump(borough_polygons(), f)
+
+
+def write_path_finder(directory, grid=GRID, n_clusters=250, seed=0):
+    # Everything the path finder reads, in directory.
+    import osmnx as ox
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    ox.save_graphml(street_graph(rng, grid), os.path.join(directory, 'weighted_graph.graphml'))
+    for kind, column in CLUSTERED:
+        clustered(rng, n_clusters, column).to_csv(os.path.join(directory, f'{kind}_clustered.csv'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic feeds, and optionally a street graph, "
+                                                 "with the schemas of the real ones")
+    parser.add_argument('dir')
+    parser.add_argument('--collisions', type=int, default=1000000)
+    parser.add_argument('--traffic', type=int, default=200000)
+    parser.add_argument('--constructions', type=int, default=0, help="construction projects, none by default")
+    parser.add_argument('--grid', type=int, default=0, help="also write a street graph of grid x grid intersections")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    write(os.path.join(args.dir, 'collisions.csv'), collisions, args.collisions, args.seed)
+    write(os.path.join(args.dir, 'traffic.csv'), traffic, args.traffic, args.seed + 1)
+    if args.constructions:
+        write(os.path.join(args.dir, 'constructions.csv'), constructions, args.constructions, args.seed + 2)
+    if args.grid:
+        write_path_finder(args.dir, args.grid, seed=args.seed)
+    print(f"Wrote {args.collisions} collisions and {args.traffic} traffic counts to {args.dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from suite import PATH_FINDER, SCALES, WEBAPP, generate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.metrics import process_memory
+
+
+# What gunicorn.conf.py does, without needing gunicorn: the app's wsgi
+# module is imported once in a master process, which then forks workers
+# that serve from the memory it loaded. For each worker this reports how
+# long it took from the fork to answering /ready, and how much memory it
+# holds privately (the pages it had to copy) once ready and after serving
+# requests. The same app started as a standalone process, as each worker
+# would be without preloading, is measured for comparison.
+
+APPS = {'path_finder': (PATH_FINDER, 'path_finder'), 'dashboard': (WEBAPP, 'webapp')}
+
+
+def requests_for(name, count, seed):
+    # (method, url, json body) of the requests a worker serves.
+    if name == 'dashboard':
+        return [('GET', '/', None)] * count
+    import numpy as np
+
+    snapshot = sys.modules['app'].snapshot
+    pairs = np.random.default_rng(seed).integers(0, snapshot.num_nodes, (count, 2))
+    return [('POST', '/api/route', {'start_lat': float(snapshot.y[s]), 'start_lng': float(snapshot.x[s]),
+                                    'end_lat': float(snapshot.y[t]), 'end_lng': float(snapshot.x[t])})
+            for s, t in pairs.tolist()]
+
+
+def serve(module, requests):
+    client = module.app.test_client()
+    for method, url, body in requests:
+        client.open(url, method=method, json=body)
+
+
+def worker(module, requests, forked, out):
+    # Runs in a forked child and writes its measurements to the pipe out.
+    client = module.app.test_client()
+    ready = client.get('/ready').status_code == 200
+    spawn_ms = (time.perf_counter() - forked) * 1000
+    at_ready = process_memory()
+    serve(module, requests)
+    result = {'ready': ready, 'spawn_ms': spawn_ms, 'ready_private_mb': at_ready.get('private', 0),
+              'private_mb': process_memory().get('private', 0), 'rss_mb': process_memory().get('rss', 0)}
+    os.write(out, json.dumps(result).encode())
+    os.close(out)
+
+
+def preforked(args):
+    start = time.perf_counter()
+    import wsgi
+    load_s = time.perf_counter() - start
+    requests = requests_for(args.child, args.requests, args.seed)
+    if not args.no_freeze:
+        gc.freeze()
+    master = process_memory()
+
+    pids = []
+    for _ in range(args.workers):
+        read, write = os.pipe()
+        forked = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            try:
+                worker(wsgi, requests, forked, write)
+            finally:
+                os._exit(0)
+        os.close(write)
+        pids.append((pid, read))
+
+    workers = []
+    for pid, read in pids:
+        with os.fdopen(read) as f:
+            workers.append(json.loads(f.read()))
+        os.waitpid(pid, 0)
+    return {'load_s': load_s, 'master_rss_mb': master.get('rss', 0), 'workers': workers}
+
+
+def standalone(args):
+    start = time.perf_counter()
+    import wsgi
+    load_s = time.perf_counter() - start
+    serve(wsgi, requests_for(args.child, args.requests, args.seed))
+    memory = process_memory()
+    return {'load_s': load_s, 'private_mb': memory.get('private', 0), 'rss_mb': memory.get('rss', 0)}
+
+
+def run_child(name, directory, args, mode):
+    command = [sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--child', name, '--mode', mode,
+               '--data', directory, '--workers', str(args.workers), '--requests', str(args.requests),
+               '--seed', str(args.seed)] + (['--no-freeze'] if args.no_freeze else [])
+    env = dict(os.environ, NAVGUARD_GEOCODER='offline', NAVGUARD_GEOCODE_DB=os.path.join(directory, 'geocode.sqlite'),
+               NAVGUARD_MATRIX_PROCESSES='1', NAVGUARD_CHART_PROCESSES='1')
+    out = subprocess.run(command, capture_output=True, text=True, env=env)
+    if out.returncode:
+        sys.exit(f"The {name} benchmark failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def report(name, alone, forked):
+    print(f"{name}")
+    print(f"  standalone process   load {alone['load_s']:7.2f} s   {alone['rss_mb']:7.1f} MB resident, "
+          f"{alone['private_mb']:7.1f} MB private")
+    print(f"  preloaded master     load {forked['load_s']:7.2f} s   {forked['master_rss_mb']:7.1f} MB resident")
+    for i, w in enumerate(forked['workers']):
+        print(f"  worker {i:<3}           spawn {w['spawn_ms']:6.1f} ms   {w['rss_mb']:7.1f} MB resident, "
+              f"{w['ready_private_mb']:6.1f} MB private when ready, {w['private_mb']:6.1f} MB after serving"
+              f"{'' if w['ready'] else '   NOT READY'}")
+    extra = sum(w['private_mb'] for w in forked['workers'])
+    print(f"  {len(forked['workers'])} workers hold {extra:.1f} MB of their own on top of the master's, against "
+          f"{alone['rss_mb'] * len(forked['workers']):.1f} MB for as many standalone processes")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker spawn time and per-worker memory of both apps "
+                                                 "when forked from a preloaded master")
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--apps', nargs='*', choices=list(APPS), default=list(APPS))
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=50, help="requests each worker serves before measuring")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-freeze', action='store_true', help="fork without gc.freeze() first")
+    parser.add_argument('--data', help="directory of inputs generated by suite.py, reused")
+    parser.add_argument('--child', choices=list(APPS), help=argparse.SUPPRESS)
+    parser.add_argument('--mode', choices=['preforked', 'standalone'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        os.chdir(args.data)
+        sys.path.insert(0, os.path.abspath(APPS[args.child][0]))
+        print(json.dumps(preforked(args) if args.mode == 'preforked' else standalone(args)))
+        return
+
+    directory = args.data or tempfile.mkdtemp()
+    generate(directory, SCALES[args.scale], args.seed)
+    for name in args.apps:
+        app_dir = os.path.join(directory, APPS[name][1])
+        # A first start builds what is derived from the inputs, so both
+        # measured starts find it on disk.
+        run_child(name, app_dir, argparse.Namespace(**dict(vars(args), requests=1)), 'standalone')
+        alone = run_child(name, app_dir, args, 'standalone')
+        forked = run_child(name, app_dir, args, 'preforked')
+        report(name, alone, forked)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+
+
+BOROUGHS_VERSION = 1
+# Side of the lookup grid's cells in degrees, about 200 m in New York.
+CELL_DEG = 0.002
+# Grid values besides polygon numbers.
+OUTSIDE = -1
+MIXED = -2
+
+
+def boroughs_path(geojson_path):
+    return os.path.splitext(geojson_path)[0] + '.boroughs.pkl'
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+class BoroughIndex:
+    # Labels lon/lat points with the polygon they lie in. A raster grid over
+    # the polygons answers points in cells wholly inside one polygon, or
+    # outside all of them, by lookup; only points in cells crossed by a
+    # boundary are tested exactly, against the prepared polygons. Labels
+    # match gpd.sjoin(..., predicate='within'), taking the first polygon
+    # where they overlap.
+
+    def __init__(self, names, polygons, origin, cell, grid, source=None):
+        self.names = list(names)
+        self.polygons = polygons
+        self.origin = origin
+        self.cell = cell
+        self.grid = grid
+        self.source = source
+        self._prepare()
+
+    def _prepare(self):
+        import shapely
+
+        shapely.prepare(self.polygons)
+        self.bounds = shapely.bounds(self.polygons)
+
+    @classmethod
+    def from_geojson(cls, path, name_column='name', cell=CELL_DEG):
+        import geopandas as gpd
+        import shapely
+
+        boundaries = gpd.read_file(path).to_crs('EPSG:4326')
+        polygons = np.asarray(boundaries.geometry.values, dtype=object)
+        shapely.prepare(polygons)
+
+        x0, y0, x1, y1 = shapely.total_bounds(polygons)
+        nx = int(np.ceil((x1 - x0) / cell))
+        ny = int(np.ceil((y1 - y0) / cell))
+        iy, ix = np.divmod(np.arange(nx * ny), nx)
+        boxes = shapely.box(x0 + ix * cell, y0 + iy * cell, x0 + (ix + 1) * cell, y0 + (iy + 1) * cell)
+
+        # Cells a polygon's boundary passes through, or that more than one
+        # polygon touches, are left for the exact test.
+        grid = np.full(nx * ny, OUTSIDE, dtype=np.int16)
+        touching = np.zeros(nx * ny, dtype=np.int16)
+        for i, polygon in enumerate(polygons):
+            touches = shapely.intersects(polygon, boxes)
+            touching += touches
+            grid[touches] = MIXED
+            grid[shapely.contains_properly(polygon, boxes) & (touching == 1)] = i
+        grid[touching > 1] = MIXED
+        return cls(boundaries[name_column].tolist(), polygons, (x0, y0), cell, grid.reshape(ny, nx), source_stamp(path))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['bounds']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prepare()
+
+    def save(self, path):
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((BOROUGHS_VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, geojson_path=None):
+        with open(path, 'rb') as f:
+            version, index = pickle.load(f)
+        if version != BOROUGHS_VERSION:
+            raise ValueError(f"{path} was written by an incompatible version of boroughs.py")
+        if geojson_path is not None and index.source != source_stamp(geojson_path):
+            raise ValueError(f"{path} is older than {geojson_path}")
+        return index
+
+    def codes(self, lng, lat):
+        # Index into names of the polygon each point lies in, -1 outside
+        # all of them.
+        import shapely
+
+        lng = np.asarray(lng, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        ny, nx = self.grid.shape
+        col = np.floor((lng - self.origin[0]) / self.cell)
+        row = np.floor((lat - self.origin[1]) / self.cell)
+        on_grid = (col >= 0) & (col < nx) & (row >= 0) & (row < ny)
+
+        codes = np.full(len(lng), OUTSIDE, dtype=np.int16)
+        codes[on_grid] = self.grid[row[on_grid].astype(np.intp), col[on_grid].astype(np.intp)]
+        exact = np.flatnonzero(codes == MIXED)
+        codes[exact] = OUTSIDE
+        for i, polygon in enumerate(self.polygons):
+            x0, y0, x1, y1 = self.bounds[i]
+            x, y = lng[exact], lat[exact]
+            near = exact[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+            inside = near[shapely.contains_xy(polygon, lng[near], lat[near])]
+            codes[inside] = i
+            exact = np.setdiff1d(exact, inside, assume_unique=True)
+        return codes
+
+    def labels(self, lng, lat):
+        # The same as a pandas Categorical of names, NaN outside.
+        import pandas as pd
+
+        return pd.Categorical.from_codes(self.codes(lng, lat), categories=self.names)
+
+
+def load_index(geojson_path):
+    # The index cached next to geojson_path, rebuilt when it is missing or
+    # older than the polygons.
+    path = boroughs_path(geojson_path)
+    try:
+        return BoroughIndex.load(path, geojson_path)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError) as e:
+        print(f"Building borough index: {e}")
+    index = BoroughIndex.from_geojson(geojson_path)
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    geojson_path = sys.argv[1] if len(sys.argv) > 1 else 'new-york-city-boroughs.geojson'
+    start = time.perf_counter()
+    index = BoroughIndex.from_geojson(geojson_path)
+    index.save(boroughs_path(geojson_path))
+    print(f"Indexed {len(index.names)} polygons on a {index.grid.shape[1]}x{index.grid.shape[0]} grid "
+          f"in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,261 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from common.metrics import count_lookup, span
+
+
+CACHE_SIZE = 4096
+TTL = 30 * 24 * 3600
+# Addresses the backends could not resolve are remembered for a shorter
+# time, so a typo is not sent upstream on every retry.
+MISS_TTL = 24 * 3600
+# At the repository root rather than in the working directory, so both apps
+# share one cache whichever directory they are started from.
+GEOCODE_DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'geocode_cache.sqlite')
+
+ABBREVIATIONS = {
+    'st': 'street', 'str': 'street', 'ave': 'avenue', 'av': 'avenue', 'blvd': 'boulevard',
+    'rd': 'road', 'dr': 'drive', 'pl': 'place', 'pkwy': 'parkway', 'hwy': 'highway',
+    'expy': 'expressway', 'ln': 'lane', 'ct': 'court', 'sq': 'square', 'tpke': 'turnpike',
+    'e': 'east', 'w': 'west', 'n': 'north', 's': 'south',
+}
+# Trailing parts of an address that say which city it is in rather than
+# where in it, dropped when matching against the gazetteer.
+PLACE_WORDS = {
+    'new york', 'new york city', 'nyc', 'ny', 'usa', 'us', 'united states', 'manhattan',
+    'brooklyn', 'queens', 'bronx', 'the bronx', 'staten island',
+}
+# Words that name a kind of street rather than a street.
+STREET_TYPES = {'street', 'avenue', 'boulevard', 'road', 'drive', 'place', 'parkway', 'highway', 'expressway',
+                'lane', 'court', 'square', 'turnpike'}
+INTERSECTION = re.compile(r'\s+(?:and|at|&|/)\s+')
+
+
+def normalize_address(address):
+    text = str(address).casefold().replace("'", '')
+    text = re.sub(r'([&/])', r' \1 ', text)
+    text = re.sub(r'[^\w&/,]+', ' ', text)
+    text = re.sub(r'(\d+)(?:st|nd|rd|th)\b', r'\1', text)
+    parts = []
+    for part in text.split(','):
+        words = [ABBREVIATIONS.get(w, w) for w in part.split()]
+        if words:
+            parts.append(' '.join(words))
+    return ', '.join(parts)
+
+
+def _street_query(address):
+    # The part of a normalized address naming streets: place names, zip
+    # codes and a leading house number are dropped.
+    parts = [p for p in address.split(', ') if p not in PLACE_WORDS and not p.isdigit()]
+    street = parts[0] if parts else ''
+    street = re.sub(r'^corner of\s+', '', street)
+    if not INTERSECTION.search(street):
+        # A leading number is a house number only when a street name
+        # follows it: in "5 avenue", normalized from "5th Avenue", it is the
+        # street's own.
+        house = re.match(r'\d+[a-z]?\s+(.+)$', street)
+        if house and house.group(1) not in STREET_TYPES:
+            street = house.group(1)
+    return street
+
+
+class NominatimBackend:
+
+    def __init__(self, user_agent="NavGuard", timeout=10):
+        from geopy.geocoders import Nominatim
+        self.geolocator = Nominatim(user_agent=user_agent, timeout=timeout)
+
+    def geocode(self, address):
+        location = self.geolocator.geocode(address)
+        return (location.latitude, location.longitude) if location else None
+
+
+class StubBackend:
+    # Answers from a fixed {address: (lat, lng)} mapping, for running the
+    # apps and their tests without the live service.
+
+    def __init__(self, locations):
+        self.locations = {normalize_address(a): tuple(c) for a, c in locations.items()}
+
+    def geocode(self, address):
+        return self.locations.get(normalize_address(address))
+
+
+class Gazetteer:
+    # Offline lookup of street names and intersections of the street graph.
+    # A street resolves to the node of that street closest to its centre,
+    # "A and B" to a node where the two streets meet.
+
+    def __init__(self, streets, intersections):
+        self.streets = streets
+        self.intersections = intersections
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        named = snapshot.edge_name >= 0
+        name_ids = np.concatenate([snapshot.edge_name[named], snapshot.edge_name[named]])
+        nodes = np.concatenate([snapshot.edge_u[named], snapshot.edge_v[named]])
+        pairs = np.unique(np.stack([name_ids, nodes], axis=1), axis=0)
+        keys = [normalize_address(name) for name in snapshot.names]
+
+        streets = {}
+        bounds = np.flatnonzero(np.diff(pairs[:, 0])) + 1
+        for group in np.split(pairs, bounds):
+            if not len(group):
+                continue
+            members = group[:, 1]
+            x, y = snapshot.x[members], snapshot.y[members]
+            centre = np.argmin((x - x.mean()) ** 2 + (y - y.mean()) ** 2)
+            streets.setdefault(keys[group[0, 0]], (float(y[centre]), float(x[centre])))
+
+        intersections = {}
+        order = np.lexsort((pairs[:, 0], pairs[:, 1]))
+        by_node = pairs[order]
+        bounds = np.flatnonzero(np.diff(by_node[:, 1])) + 1
+        for group in np.split(by_node, bounds):
+            if len(group) < 2:
+                continue
+            node = group[0, 1]
+            point = (float(snapshot.y[node]), float(snapshot.x[node]))
+            names = sorted({keys[i] for i in group[:, 0]})
+            for i, a in enumerate(names):
+                for b in names[i + 1:]:
+                    intersections.setdefault((a, b), point)
+        return cls(streets, intersections)
+
+    def geocode(self, address):
+        street = _street_query(normalize_address(address))
+        names = INTERSECTION.split(street)
+        if len(names) == 2:
+            return self.intersections.get(tuple(sorted(names)))
+        return self.streets.get(street)
+
+
+class GeocodeStore:
+    # Persistent cache in SQLite, shared by every worker and both apps. A
+    # connection per call keeps it safe across threads and processes.
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS geocodes "
+                       "(address TEXT PRIMARY KEY, lat REAL, lng REAL, created REAL)")
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def get(self, address):
+        db = self._connect()
+        try:
+            row = db.execute("SELECT lat, lng, created FROM geocodes WHERE address = ?", (address,)).fetchone()
+        finally:
+            db.close()
+        if row is None:
+            return None
+        lat, lng, created = row
+        ttl = MISS_TTL if lat is None else TTL
+        if time.time() - created > ttl:
+            return None
+        return (lat, lng), created
+
+    def put(self, address, coords, created):
+        lat, lng = coords if coords else (None, None)
+        db = self._connect()
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?)", (address, lat, lng, created))
+        finally:
+            db.close()
+
+
+class Geocoder:
+    # Looks an address up in an in-memory LRU, then the SQLite store, then
+    # each backend in turn, remembering the answer (or its absence) on the
+    # way back. Returns (lat, lng), or (None, None) like get_coordinates
+    # always has.
+
+    def __init__(self, backends, store=None, cache_size=CACHE_SIZE):
+        self.backends = list(backends)
+        self.store = store
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, coords, created):
+        with self._lock:
+            self._cache[key] = (coords, created)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def geocode(self, address):
+        key = normalize_address(address)
+        if not key:
+            return None, None
+
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None:
+                coords, created = hit
+                if time.time() - created <= (TTL if coords[0] is not None else MISS_TTL):
+                    self._cache.move_to_end(key)
+                    count_lookup('geocode', 'memory')
+                    return coords
+                del self._cache[key]
+
+        if self.store is not None:
+            hit = self.store.get(key)
+            if hit is not None:
+                self._remember(key, *hit)
+                count_lookup('geocode', 'store')
+                return hit[0]
+
+        coords = None
+        failed = not self.backends
+        for backend in self.backends:
+            try:
+                with span(f'geocode_{type(backend).__name__.lower()}'):
+                    coords = backend.geocode(address)
+            except Exception as e:
+                print(f"Error occurred during geocoding: {e}")
+                failed = True
+                continue
+            if coords is not None:
+                break
+
+        # A backend error is not an answer, so only real misses are cached.
+        if coords is None and failed:
+            count_lookup('geocode', 'error')
+            return None, None
+        count_lookup('geocode', 'backend' if coords is not None else 'miss')
+        coords = tuple(coords) if coords is not None else (None, None)
+        created = time.time()
+        self._remember(key, coords, created)
+        if self.store is not None:
+            self.store.put(key, coords if coords[0] is not None else None, created)
+        return coords
+
+
+def make_geocoder(gazetteer=None, mode=None, db_path=None):
+    # NAVGUARD_GEOCODER picks the backends: "nominatim" (the default) asks
+    # the live service and falls back to the gazetteer, "offline" uses only
+    # the gazetteer. NAVGUARD_GEOCODE_DB is the SQLite cache file.
+    mode = mode or os.environ.get('NAVGUARD_GEOCODER', 'nominatim')
+    db_path = db_path or os.environ.get('NAVGUARD_GEOCODE_DB', GEOCODE_DB)
+    backends = []
+    if mode == 'nominatim':
+        backends.append(NominatimBackend())
+    elif mode != 'offline':
+        raise ValueError(f"Unknown geocoder {mode!r}")
+    if gazetteer is not None:
+        backends.append(gazetteer)
+    return Geocoder(backends, GeocodeStore(db_path))
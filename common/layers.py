@@ -0,0 +1,73 @@
+import numpy as np
+
+
+# Coordinates are sent with this many decimals, about a metre.
+PRECISION = 5
+# Below DETAIL_ZOOM points are merged into cells of CELL_PX screen pixels,
+# one circle per cell; from DETAIL_ZOOM on every point is sent.
+MIN_ZOOM = 10
+DETAIL_ZOOM = 16
+CELL_PX = 32
+
+
+def point_columns(df, value=None, precision=PRECISION):
+    # The rows with coordinates as rounded lat, lng (and value) arrays,
+    # without building anything per row.
+    df = df.dropna(subset=['latitude', 'longitude'])
+    lat = np.round(df['latitude'].to_numpy(dtype=np.float64), precision)
+    lng = np.round(df['longitude'].to_numpy(dtype=np.float64), precision)
+    values = None if value is None else df[value].to_numpy(dtype=np.float64)
+    return lat, lng, values
+
+
+def point_list(df, precision=PRECISION):
+    # [[lat, lng], ...] as FastMarkerCluster and heat maps take them.
+    lat, lng, _ = point_columns(df, precision=precision)
+    return np.column_stack([lat, lng]).tolist()
+
+
+def mercator(lat, lng):
+    # Position on the web map as fractions of the world's width and height.
+    x = (lng + 180.0) / 360.0
+    s = np.sin(np.radians(np.clip(lat, -85.0511, 85.0511)))
+    y = 0.5 - np.log((1 + s) / (1 - s)) / (4 * np.pi)
+    return x, y
+
+
+def grid_cells(lat, lng, values, zoom, cell_px=CELL_PX):
+    # The points merged per cell of cell_px pixels at zoom: each cell's
+    # mean position, number of points and mean value.
+    x, y = mercator(lat, lng)
+    scale = 256 * 2 ** zoom / cell_px
+    cols = np.floor(x * scale).astype(np.int64)
+    rows = np.floor(y * scale).astype(np.int64)
+    cells, inverse = np.unique(rows * (int(scale) + 1) + cols, return_inverse=True)
+    count = np.bincount(inverse, minlength=len(cells))
+    result = {
+        'lat': np.round(np.bincount(inverse, lat, len(cells)) / count, PRECISION),
+        'lng': np.round(np.bincount(inverse, lng, len(cells)) / count, PRECISION),
+        'count': count,
+    }
+    if values is not None:
+        known = ~np.isnan(values)
+        totals = np.bincount(inverse[known], values[known], len(cells))
+        counted = np.bincount(inverse[known], minlength=len(cells))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result['value'] = np.round(totals / counted, 2)
+    return result
+
+
+def zoom_layer(lat, lng, values, zoom, cell_px=CELL_PX):
+    # One zoom level of a point layer as plain lists, ready for JSON: the
+    # points themselves from DETAIL_ZOOM on, cells below it.
+    if zoom >= DETAIL_ZOOM:
+        layer = {'lat': lat, 'lng': lng, 'count': np.ones(len(lat), dtype=np.int64)}
+        if values is not None:
+            layer['value'] = values
+    else:
+        layer = grid_cells(lat, lng, values, zoom, cell_px)
+    layer = {key: column.tolist() for key, column in layer.items()}
+    if values is not None:
+        # JSON has no NaN; cells or points without a value get null.
+        layer['value'] = [None if v != v else v for v in layer['value']]
+    return layer
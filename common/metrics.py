@@ -0,0 +1,383 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Upper bounds of the histogram buckets: seconds for latencies, bytes for
+# response sizes, metres for routes.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+LENGTH_BUCKETS = (500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+# A request is profiled when it carries PROFILE_HEADER set to the value of
+# NAVGUARD_PROFILE_TOKEN; without that variable nothing is profiled. The
+# profile is written to PROFILE_DIR and named in PROFILE_FILE_HEADER of the
+# response, for reading with pstats or snakeviz.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_FILE_HEADER = 'X-Profile-File'
+PROFILE_DIR = os.environ.get('NAVGUARD_PROFILE_DIR', 'profiles')
+# With NAVGUARD_METRICS_DIR set, each process of a server writes its
+# metrics there as <pid>.json, at most every SHARE_SECONDS, and /metrics
+# of any of them adds up all the files, so a scrape sees the whole server
+# rather than whichever worker answered. The counts of exited workers are
+# added into EXITED_FILE there, and their own files removed.
+SHARE_SECONDS = 1.0
+EXITED_FILE = 'exited.json'
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(into, values):
+        for key, value in values.items():
+            into[key] = into.get(key, 0) + value
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted((self.values() if values is None else values).items()):
+            lines.append(f'{self.name}{_label_text(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    # Counts of observations per bucket, cumulated only when rendered, with
+    # their sum, per combination of label values.
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][slot] += 1
+            counts[1] += value
+
+    def values(self):
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    @staticmethod
+    def merge(into, values):
+        for key, (counts, total) in values.items():
+            mine = into.get(key)
+            into[key] = (list(counts), total) if mine is None else \
+                ([a + b for a, b in zip(mine[0], counts)], mine[1] + total)
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        for key, (counts, total) in sorted((self.values() if values is None else values).items()):
+            running = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                running += count
+                lines.append(f'{self.name}_bucket{_label_text(names, key + (bound,))} {running}')
+            lines.append(f'{self.name}_sum{_label_text(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_label_text(self.labels, key)} {running}')
+        return lines
+
+
+class Registry:
+    # The metrics of a process, rendered in the Prometheus text format.
+    # Asking twice for the same name returns the same metric, so modules
+    # can declare what they count independently.
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _all(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def dump(self):
+        # {name: [[label values, value], ...]}, as JSON can hold it.
+        return {metric.name: [[list(key), value] for key, value in metric.values().items()] for metric in self._all()}
+
+    def reset(self):
+        for metric in self._all():
+            metric.reset()
+
+    def merged(self, dumps):
+        # One dump with the values of dumps added up.
+        result = {}
+        for metric in self._all():
+            values = {}
+            for dump in dumps:
+                metric.merge(values, {tuple(key): value for key, value in dump.get(metric.name, ())})
+            result[metric.name] = [[list(key), value] for key, value in values.items()]
+        return result
+
+    def render(self, dumps=()):
+        # The Prometheus text of these metrics, with the values of dumps
+        # from other processes added in.
+        lines = []
+        for metric in self._all():
+            values = metric.values()
+            for dump in dumps:
+                metric.merge(values, {tuple(key): value for key, value in dump.get(metric.name, ())})
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram('navguard_stage_seconds', "Time spent in each stage of a request", ('stage',))
+CACHE_LOOKUPS = REGISTRY.counter('navguard_cache_lookups_total', "Cache lookups by cache and where they were answered",
+                                 ('cache', 'result'))
+
+# The stages timed in the current request, in order.
+_request = threading.local()
+
+
+@contextmanager
+def span(stage):
+    # Times the block as one stage: observed in STAGE_SECONDS, and within a
+    # request also listed in its Server-Timing header.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        spans = getattr(_request, 'spans', None)
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+
+def spans():
+    # {stage: seconds} of the current request so far, repeated stages
+    # added up.
+    totals = {}
+    for stage, elapsed in getattr(_request, 'spans', None) or ():
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return totals
+
+
+def count_lookup(cache, result):
+    CACHE_LOOKUPS.inc(cache=cache, result=result)
+
+
+_shared = [0.0]
+
+
+def share_metrics(registry=REGISTRY, force=False):
+    # Writes this process's metrics to NAVGUARD_METRICS_DIR, if set, unless
+    # it did less than SHARE_SECONDS ago.
+    directory = os.environ.get('NAVGUARD_METRICS_DIR')
+    now = time.monotonic()
+    if not directory or not force and now - _shared[0] < SHARE_SECONDS:
+        return
+    _shared[0] = now
+    os.makedirs(directory, exist_ok=True)
+    _write_dump(os.path.join(directory, f'{os.getpid()}.json'), registry.dump())
+
+
+def _write_dump(path, dump):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(dump, f)
+    os.replace(tmp, path)
+
+
+def _read_dump(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def retire_metrics(pid, registry=REGISTRY):
+    # Adds the metrics pid, an exited process, wrote to NAVGUARD_METRICS_DIR
+    # into EXITED_FILE and removes its file, so the directory does not grow
+    # with every worker a server ever ran. Called by one process only, the
+    # gunicorn master. EXITED_FILE names pid until the next call, so a
+    # reader that still finds its file does not count it twice.
+    directory = os.environ.get('NAVGUARD_METRICS_DIR')
+    if not directory:
+        return
+    path = os.path.join(directory, f'{pid}.json')
+    dump = _read_dump(path)
+    if dump is None:
+        return
+    exited = _read_dump(os.path.join(directory, EXITED_FILE)) or {'metrics': {}}
+    _write_dump(os.path.join(directory, EXITED_FILE),
+                {'pids': [pid], 'metrics': registry.merged([exited['metrics'], dump])})
+    os.remove(path)
+
+
+def shared_metrics():
+    # The dumps the other processes wrote to NAVGUARD_METRICS_DIR, and the
+    # counts of workers that have exited: they still happened.
+    directory = os.environ.get('NAVGUARD_METRICS_DIR')
+    if not directory or not os.path.isdir(directory):
+        return []
+    names = os.listdir(directory)
+    exited = _read_dump(os.path.join(directory, EXITED_FILE)) or {'pids': [], 'metrics': {}}
+    skip = {f'{pid}.json' for pid in exited['pids'] + [os.getpid()]}
+    dumps = [exited['metrics']]
+    for name in names:
+        if name.endswith('.json') and name != EXITED_FILE and name not in skip:
+            dump = _read_dump(os.path.join(directory, name))
+            if dump is not None:
+                dumps.append(dump)
+    return dumps
+
+
+def process_memory(pid='self'):
+    # {'rss', 'private', 'shared'} of a process in MB, from Linux's
+    # smaps_rollup: private pages are the ones only this process holds,
+    # such as a forked worker's copies of what it changed. Empty where
+    # /proc is not available.
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    private = fields.get('Private_Clean', 0) + fields.get('Private_Dirty', 0)
+    return {'rss': fields.get('Rss', 0), 'private': private, 'shared': fields.get('Rss', 0) - private}
+
+
+# One profile at a time: a second profiler in the same process would see
+# the first one's calls.
+_profile_lock = threading.Lock()
+
+
+def _start_profile():
+    token = os.environ.get('NAVGUARD_PROFILE_TOKEN')
+    from flask import request
+
+    if not token or request.headers.get(PROFILE_HEADER) != token or not _profile_lock.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def _finish_profile(profile, endpoint):
+    profile.disable()
+    _profile_lock.release()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}-{threading.get_ident() % 100000}-{endpoint}.prof'
+    profile.dump_stats(os.path.join(PROFILE_DIR, name))
+    return name
+
+
+def instrument(app, registry=REGISTRY):
+    # Times every request of app by endpoint and status, records the size
+    # of its response, adds a Server-Timing header listing its spans, and
+    # serves registry at /metrics, with those of the server's other
+    # processes when they share them (see share_metrics).
+    from flask import Response, request
+
+    request_seconds = registry.histogram('navguard_request_seconds', "Request latency by endpoint and status",
+                                         ('endpoint', 'method', 'status'))
+    response_bytes = registry.histogram('navguard_response_bytes', "Response body size by endpoint",
+                                        ('endpoint',), SIZE_BUCKETS)
+
+    @app.before_request
+    def start_request():
+        _request.spans = []
+        _request.profile = _start_profile()
+        _request.started = time.perf_counter()
+
+    @app.after_request
+    def finish_request(response):
+        started = getattr(_request, 'started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        endpoint = request.endpoint or 'unmatched'
+        if _request.profile is not None:
+            response.headers[PROFILE_FILE_HEADER] = _finish_profile(_request.profile, endpoint)
+        request_seconds.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+        # Streamed and file responses are not read just to be measured.
+        size = response.content_length if response.direct_passthrough or response.is_streamed \
+            else response.calculate_content_length()
+        if size is not None:
+            response_bytes.observe(size, endpoint=endpoint)
+        timings = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in spans().items()]
+        response.headers['Server-Timing'] = ', '.join(timings + [f'total;dur={elapsed * 1000:.2f}'])
+        _request.spans = _request.profile = _request.started = None
+        share_metrics(registry)
+        return response
+
+    @app.teardown_request
+    def abandon_request(error=None):
+        # Requests that failed before after_request still release the
+        # profiler.
+        profile = getattr(_request, 'profile', None)
+        if profile is not None:
+            profile.disable()
+            _profile_lock.release()
+        _request.spans = _request.profile = _request.started = None
+
+    def metrics():
+        return Response(registry.render(shared_metrics()), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
+    return app
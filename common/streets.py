@@ -0,0 +1,139 @@
+from bisect import bisect_left
+
+import numpy as np
+
+from common.geocoding import normalize_address
+
+
+# Suggestions returned by StreetIndex.complete() unless asked otherwise.
+SUGGESTIONS = 10
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class StreetIndex:
+    # Street names normalized as addresses are (see normalize_address),
+    # kept sorted for prefix lookups and with an inverted index of their
+    # trigrams for lookups anywhere in a name. Each street carries a name to
+    # show, as the feed spells it, and a count per column of stats, such as
+    # the collisions on it, by which suggestions are ranked. The trigram
+    # lists hold streets in rank order, so a lookup stops at the first few
+    # that match.
+
+    def __init__(self, keys, names, stats):
+        self.keys = list(keys)
+        self.names = list(names)
+        self.stats = {column: np.asarray(values) for column, values in stats.items()}
+        self.rank = next(iter(self.stats.values())) if self.stats else np.zeros(len(self.keys))
+        self.ids = {key: i for i, key in enumerate(self.keys)}
+        self.by_rank = np.argsort(-self.rank, kind='stable').tolist()
+        postings = {}
+        for i in self.by_rank:
+            for gram in trigrams(self.keys[i]):
+                postings.setdefault(gram, []).append(i)
+        self.postings = postings
+
+    @classmethod
+    def build(cls, names, codes, stats=None, count='count'):
+        # From rows naming up to len(codes) streets each: names holds the
+        # distinct spellings and each codes array the spelling of one
+        # street per row, -1 for none, as pandas categoricals do. A row is
+        # counted once per street it names, under count, and its values in
+        # stats ({column: array}) are added to each of those streets.
+        keys = np.array([normalize_address(name) for name in names], dtype=object)
+        named = keys != ''
+        unique, key_of = np.unique(keys[named].astype(str), return_inverse=True)
+        spelling_key = np.full(len(keys), -1, dtype=np.int64)
+        spelling_key[named] = key_of
+        first = np.full(len(unique), -1, dtype=np.int64)
+        first[key_of[::-1]] = np.flatnonzero(named)[::-1]
+
+        totals = {count: np.zeros(len(unique), dtype=np.int64)}
+        totals.update({column: np.zeros(len(unique)) for column in stats or {}})
+        seen = []
+        for row_codes in codes:
+            row_codes = np.asarray(row_codes, dtype=np.int64)
+            row_keys = np.where(row_codes >= 0, spelling_key[np.maximum(row_codes, 0)], -1)
+            rows = row_keys >= 0
+            for earlier in seen:
+                rows &= row_keys != earlier
+            seen.append(row_keys)
+            totals[count] += np.bincount(row_keys[rows], minlength=len(unique))
+            for column, values in (stats or {}).items():
+                values = np.nan_to_num(np.asarray(values, dtype=np.float64)[rows])
+                totals[column] += np.bincount(row_keys[rows], values, minlength=len(unique))
+        for column, values in (stats or {}).items():
+            if np.issubdtype(np.asarray(values).dtype, np.integer):
+                totals[column] = totals[column].astype(np.int64)
+        return cls(unique.tolist(), [str(names[i]) for i in first], totals)
+
+    @classmethod
+    def from_frame(cls, df, columns, stats=(), count='collisions'):
+        # From the categorical street columns of a feed, such as the
+        # on_street_name and off_street_name of the collisions.
+        categories = [df[column].astype('category') for column in columns if column in df]
+        if not categories:
+            return cls([], [], {count: []})
+        names = categories[0].cat.categories
+        for other in categories[1:]:
+            names = names.union(other.cat.categories)
+        codes = [c.cat.set_categories(names).cat.codes.to_numpy() for c in categories]
+        return cls.build(names.astype(str).tolist(), codes, {column: df[column].to_numpy() for column in stats
+                                                               if column in df}, count)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, name):
+        return normalize_address(name) in self.ids
+
+    def street(self, name):
+        # {'name', 'key', stat: value...} of the street, None when unknown.
+        i = self.ids.get(normalize_address(name))
+        return None if i is None else self._describe(i)
+
+    def _describe(self, i):
+        street = {'name': self.names[i], 'key': self.keys[i]}
+        street.update({column: values[i].item() for column, values in self.stats.items()})
+        return street
+
+    def prefixed(self, prefix):
+        # Ids of the streets whose normalized name starts with prefix.
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + '\U0010ffff')
+        return np.arange(lo, hi)
+
+    def containing(self, text, limit=None, skip=()):
+        # Ids of up to limit streets whose normalized name contains text, in
+        # rank order: the streets holding its rarest trigram are checked
+        # one by one.
+        grams = trigrams(text)
+        candidates = min((self.postings.get(gram, ()) for gram in grams), key=len) if grams else self.by_rank
+        found = []
+        for i in candidates:
+            if text in self.keys[i] and i not in skip:
+                found.append(i)
+                if len(found) == limit:
+                    break
+        return found
+
+    def matches(self, text):
+        # Whether any street's name contains text, as a case-insensitive
+        # str.contains over the feed would say.
+        text = normalize_address(text)
+        return bool(text) and len(self.containing(text, 1)) > 0
+
+    def complete(self, text, limit=SUGGESTIONS):
+        # Up to limit streets for what has been typed so far: those whose
+        # name starts with it first, then those with it elsewhere in their
+        # name, each ranked by the first stat. None for a limit below 1.
+        text = normalize_address(text)
+        if not text or limit < 1:
+            return []
+        prefixed = self.prefixed(text)
+        found = prefixed[np.argsort(-self.rank[prefixed], kind='stable')][:limit].tolist()
+        if len(found) < limit:
+            found += self.containing(text, limit - len(found), set(found))
+        return [self._describe(i) for i in found]
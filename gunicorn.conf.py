@@ -0,0 +1,69 @@
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common.metrics import REGISTRY, process_memory, retire_metrics, share_metrics
+
+
+# Both apps are served by gunicorn from their wsgi modules (see Procfile).
+# With preload_app the module is imported once, in the master, and the
+# workers are forked with the graph or the feeds already loaded, sharing
+# those pages copy-on-write rather than each loading its own.
+preload_app = True
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('NAVGUARD_THREADS', 4))
+timeout = 120
+
+# The workers are the parallelism: each one drawing charts or searching
+# matrices in a pool of its own would start cpu_count processes apiece.
+os.environ.setdefault('NAVGUARD_CHART_PROCESSES', '1')
+os.environ.setdefault('NAVGUARD_MATRIX_PROCESSES', '1')
+
+# The processes of one server share their metrics through a directory of
+# their own, so /metrics of any worker counts the whole server (see
+# common/metrics.py). It is emptied when the server starts, and the files
+# of exited workers are folded into one as the master reaps them.
+os.environ.setdefault('NAVGUARD_METRICS_DIR', os.path.join(tempfile.gettempdir(), f'navguard-metrics-{os.getpid()}'))
+
+
+def on_starting(server):
+    shutil.rmtree(os.environ['NAVGUARD_METRICS_DIR'], ignore_errors=True)
+
+
+def when_ready(server):
+    # Everything loaded so far is moved out of the garbage collector's
+    # reach, so its passes in the workers do not write to, and so copy,
+    # the pages holding it.
+    gc.freeze()
+    # What loading the app counted is the master's; workers count from 0.
+    share_metrics(force=True)
+    server.log.info(f"Master {os.getpid()} loaded: {process_memory().get('rss', 0):.0f} MB resident")
+
+
+def pre_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_fork(server, worker):
+    REGISTRY.reset()
+
+
+def post_worker_init(worker):
+    memory = process_memory()
+    worker.log.info(f"Worker {worker.pid} spawned in {(time.perf_counter() - worker.forked_at) * 1000:.0f} ms, "
+                    f"{memory.get('private', 0):.1f} MB of its own of {memory.get('rss', 0):.0f} MB resident")
+
+
+def worker_exit(server, worker):
+    share_metrics(force=True)
+    memory = process_memory()
+    server.log.info(f"Worker {worker.pid} exiting with {memory.get('private', 0):.1f} MB of its own "
+                    f"of {memory.get('rss', 0):.0f} MB resident")
+
+
+def child_exit(server, worker):
+    retire_metrics(worker.pid)
@@ -1,97 +1,276 @@
-from flask import Flask, render_template, request
-import folium
-import osmnx as ox
+import math
+import os
+import sys
+import time
+from flask import Flask, jsonify, render_template, request
 import networkx as nx
+import numpy as np
 import pandas as pd
-from geopy.geocoders import Nominatim
-from sklearn.cluster import KMeans
+from routing import RoutingEngine
+from ch import ContractionHierarchy, ch_path
+from snapshot import load_graph
+from spatial import load_index
+from basemap import hazard_layer, street_layer
+from routes import route_summary
+from matrix import MatrixRouter
+from overlay import WeightOverlay, overlay_path
+from routecache import make_route_cache, route_key
+from timeweights import load_timeweights, slot_name, slot_of
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.geocoding import Gazetteer, make_geocoder
+from common.layers import DETAIL_ZOOM, MIN_ZOOM
+from common.metrics import LENGTH_BUCKETS, REGISTRY, instrument, span, spans
+from common.streets import SUGGESTIONS, StreetIndex
 
 app = Flask(__name__)
+# Per-stage latencies and counters at /metrics; see common/metrics.py.
+instrument(app)
 
 
-G_loaded = ox.load_graphml(filepath="weighted_graph.graphml")
+GRAPH_PATH = "weighted_graph.graphml"
+snapshot = load_graph(GRAPH_PATH)
+spatial_index = load_index(GRAPH_PATH, snapshot)
 
 
 df3 = pd.read_csv('collision_clustered.csv')
 df2 = pd.read_csv('construction_clustered.csv')
 df1 = pd.read_csv('traffic_clustered.csv')
 
+STREETS_URL = street_layer(snapshot)
+HAZARDS_URL = hazard_layer(
+    ['traffic_clustered.csv', 'construction_clustered.csv', 'collision_clustered.csv'],
+    [(df1, 'Average_volume', 'Traffic Volume ', 'blue'),
+     (df2, 'award', 'Construction Award ', 'green'),
+     (df3, 'total_casualties', 'Total Collision Casuality', 'red')],
+)
 
 
-for u, v, data in G_loaded.edges(data=True):
-    if 'weight' in data:
-        data['weight'] = float(data['weight'])
+engine = RoutingEngine.from_snapshot(snapshot)
 
+# Scipy's Dijkstra answers a route faster than the contraction hierarchy
+# on this graph (about 0.5 ms against 1.7 ms), so the hierarchy is only
+# loaded, and kept customized to each weight version, when
+# NAVGUARD_ROUTING=ch asks for it.
+ROUTING_METHOD = os.environ.get('NAVGUARD_ROUTING', 'dijkstra')
 
-def get_coordinates(address):
+if ROUTING_METHOD == 'ch':
     try:
-        geolocator = Nominatim(user_agent="YourAppName", timeout=10)
-        location = geolocator.geocode(address)
-        return (location.latitude, location.longitude) if location else (None, None)
-    except Exception as e:
-        print(f"Error occurred during geocoding: {e}")
-        return None, None
-
-
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    if request.method == 'POST':
-
-        start_location = request.form.get('start_location')
-        end_location = request.form.get('end_location')
-
-        print(f'Start Location: {start_location}')
-        print(f'End Location: {end_location}')
+        engine.hierarchy = ContractionHierarchy.load(ch_path(GRAPH_PATH), engine)
+    except (OSError, ValueError) as e:
+        print(f"Routing with Dijkstra, no contraction hierarchy: {e}")
+        ROUTING_METHOD = 'dijkstra'
 
+# Fresh feeds are published as weight versions with overlay.py; each request
+# routes on whichever version is current when it starts.
+overlay = WeightOverlay(snapshot, spatial_index, engine, overlay_path(GRAPH_PATH))
+overlay.refresh(force=True)
 
-        start_lat, start_lng = get_coordinates(start_location)
-        end_lat, end_lng = get_coordinates(end_location)
+# Hour-of-week weights built with timeweights.py, used when a route is asked
+# for a departure time. The hierarchy is customized for the static weights
+# only, so those routes are searched without it.
+time_weights = load_timeweights(GRAPH_PATH, overlay)
+TIME_ROUTING_METHOD = 'dijkstra'
 
-        print(f'Start Location: {start_lat}')
-        print(f'End Location: {end_lat}')
+# Routes found, by snapped node pair and weight version; see routecache.py.
+route_cache = make_route_cache()
 
+MATRIX_MAX_CELLS = 250000
+matrix_router = MatrixRouter(engine, snapshot, GRAPH_PATH, processes=int(os.environ.get('NAVGUARD_MATRIX_PROCESSES', 0)) or None)
 
-        source_node = ox.distance.nearest_nodes(G_loaded, start_lng, start_lat)
-        target_node = ox.distance.nearest_nodes(G_loaded, end_lng, end_lat)
-        optimal_route = nx.shortest_path(G_loaded, source=source_node, target=target_node, weight='weight')
 
+geocoder = make_geocoder(Gazetteer.from_snapshot(snapshot))
+# The graph's street names, which the gazetteer resolves, for suggesting
+# addresses as they are typed.
+street_index = StreetIndex.build(snapshot.names, [snapshot.edge_name], count='edges')
+MAX_SUGGESTIONS = 50
 
-        map_center = [(start_lat + end_lat) / 2, (start_lng + end_lng) / 2]
-        
+ROUTE_METRES = REGISTRY.histogram('navguard_route_length_meters', "Length of the routes found", ('method',),
+                                  LENGTH_BUCKETS)
+MATRIX_CELLS = REGISTRY.counter('navguard_matrix_cells_total', "Origin/destination pairs routed by /api/matrix")
 
-        mymap = folium.Map(location=map_center, zoom_start=10, tiles='CartoDB positron', control_scale=True)
-
-        for edge in G_loaded.edges:
-            start_node, end_node, _ = edge
-            start_coord = (G_loaded.nodes[start_node]['y'], G_loaded.nodes[start_node]['x'])
-            end_coord = (G_loaded.nodes[end_node]['y'], G_loaded.nodes[end_node]['x'])
-            folium.PolyLine([start_coord, end_coord], color='gray', weight=1).add_to(mymap)
-            
-
-        optimal_route_coords = [(G_loaded.nodes[node]['y'], G_loaded.nodes[node]['x']) for node in optimal_route]
-        folium.PolyLine(optimal_route_coords, color='red', weight=3).add_to(mymap)
 
+def get_coordinates(address):
+    return geocoder.geocode(address)
 
-        for index, row in df1.iterrows():
-            folium.Marker([row['latitude'], row['longitude']], popup=f'Traffic Volume {row["Average_volume"]}', icon=folium.Icon(color='blue')).add_to(mymap)
 
+def coordinates(lat, lng):
+    # lat and lng as floats. Raises ValueError unless both are finite
+    # numbers on the globe: float() also reads "nan" and "inf".
+    lat, lng = float(lat), float(lng)
+    if not (math.isfinite(lat) and math.isfinite(lng)) or abs(lat) > 90 or abs(lng) > 180:
+        raise ValueError(f"Not a point on the globe: {lat}, {lng}")
+    return lat, lng
 
-        for index, row in df2.iterrows():
-            folium.Marker([row['latitude'], row['longitude']], popup=f'Construction Award {row["award"]}', icon=folium.Icon(color='green')).add_to(mymap)
 
+def resolve_location(params, prefix):
+    lat, lng = params.get(f'{prefix}_lat'), params.get(f'{prefix}_lng')
+    if lat not in (None, '') and lng not in (None, ''):
+        return coordinates(lat, lng)
+    address = params.get(prefix)
+    if not address:
+        return None, None
+    return get_coordinates(address)
 
-        for index, row in df3.iterrows():
-            folium.Marker([row['latitude'], row['longitude']], popup=f'Total Collision Casuality{row["total_casualties"]}', icon=folium.Icon(color='red')).add_to(mymap)
 
+@app.route('/ready')
+def ready():
+    # Everything is loaded before the first request is taken, so a process
+    # answering is ready.
+    return jsonify(ready=True, weights_version=overlay.current.version, pid=os.getpid())
 
-        folium.Marker([start_lat, start_lng], popup='Start Location', icon=folium.Icon(color='black')).add_to(mymap)
-        folium.Marker([end_lat, end_lng], popup='End Location', icon=folium.Icon(color='black')).add_to(mymap)
 
+@app.route('/api/streets')
+def api_streets():
+    # Streets for an address input, ?q= being what was typed so far.
+    try:
+        limit = max(1, min(int(request.args.get('limit', SUGGESTIONS)), MAX_SUGGESTIONS))
+    except ValueError:
+        return jsonify(error="limit must be a number"), 400
+    return jsonify(streets=street_index.complete(request.args.get('q', ''), limit))
+
+
+@app.route('/api/route', methods=['GET', 'POST'])
+def api_route():
+    params = request.get_json(silent=True)
+    if params is None:
+        params = request.values
+    elif not isinstance(params, dict):
+        return jsonify(error="The body must be a JSON object"), 400
+    started = time.perf_counter()
+    try:
+        with span('geocode'):
+            start_lat, start_lng = resolve_location(params, 'start')
+            end_lat, end_lng = resolve_location(params, 'end')
+    except (TypeError, ValueError):
+        return jsonify(error="Coordinates must be finite numbers, latitudes within 90 and longitudes within 180"), 400
+    slot = None
+    if params.get('depart'):
+        try:
+            slot = slot_of(params['depart'])
+        except ValueError:
+            return jsonify(error="depart must be a date and time, or now"), 400
+        if time_weights is None:
+            return jsonify(error="Departure times are not available: no hour-of-week weights were built with timeweights.py"), 503
+    if start_lat is None or end_lat is None:
+        return jsonify(error="Could not find the start or end location"), 404
+
+    with span('snap'):
+        source_node, target_node = spatial_index.nearest_nodes([start_lng, end_lng], [start_lat, end_lat]).tolist()
+
+    state = overlay.refresh()
+    if slot is None:
+        method = ROUTING_METHOD
+    else:
+        method = TIME_ROUTING_METHOD
+
+    def search():
+        with span('route'):
+            route_engine = state.engine if slot is None else time_weights.engine(state, slot)
+            optimal_route = route_engine.shortest_path(source_node, target_node, method=method)
+        with span('summary'):
+            return route_summary(snapshot, route_engine, optimal_route)
+
+    key = route_key(snapshot.meta.get('source'), source_node, target_node, state.version, slot)
+    try:
+        route, cached = route_cache.get(key, search)
+    except nx.NetworkXNoPath:
+        return jsonify(error="No route between these locations"), 404
+    ROUTE_METRES.observe(route['length'], method=method)
+
+    result = dict(route)
+    result.update(
+        start={'lat': start_lat, 'lng': start_lng, 'node': source_node},
+        end={'lat': end_lat, 'lng': end_lng, 'node': target_node},
+        method=method,
+        weights_version=state.version,
+        departure_slot=None if slot is None else {'slot': slot, 'name': slot_name(slot)},
+        cache=cached,
+    )
+    timing = spans()
+    result['timing'] = {
+        'geocode_ms': timing['geocode'] * 1000,
+        'snap_ms': timing['snap'] * 1000,
+        'route_ms': timing.get('route', 0.0) * 1000,
+        'total_ms': (time.perf_counter() - started) * 1000,
+    }
+    return jsonify(result)
+
+
+def parse_points(points):
+    # [lat, lng] pairs or {"lat": ..., "lng": ...} objects.
+    coords = []
+    for point in points:
+        if isinstance(point, dict):
+            point = (point['lat'], point['lng'])
+        lat, lng = point
+        coords.append(coordinates(lat, lng))
+    return np.array(coords, dtype=np.float64).reshape(-1, 2)
+
+
+def matrix_rows(matrix):
+    return np.where(np.isfinite(matrix), matrix, None).tolist()
+
+
+@app.route('/api/matrix', methods=['POST'])
+def api_matrix():
+    params = request.get_json(silent=True)
+    if params is None:
+        params = {}
+    elif not isinstance(params, dict):
+        return jsonify(error="The body must be a JSON object"), 400
+    started = time.perf_counter()
+    try:
+        origins = parse_points(params.get('origins') or [])
+        destinations = parse_points(params.get('destinations') or [])
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error="origins and destinations must be lists of [lat, lng] points with finite coordinates"), 400
+    if not len(origins) or not len(destinations):
+        return jsonify(error="origins and destinations must not be empty"), 400
+    if len(origins) * len(destinations) > MATRIX_MAX_CELLS:
+        return jsonify(error=f"At most {MATRIX_MAX_CELLS} origin/destination pairs per request"), 400
+
+    with span('snap'):
+        points = np.vstack([origins, destinations])
+        nodes = spatial_index.nearest_nodes(points[:, 1], points[:, 0]).tolist()
+
+    with span('matrix'):
+        state = overlay.refresh()
+        weights, lengths, paths = matrix_router.matrix(nodes[:len(origins)], nodes[len(origins):],
+                                                       with_paths=bool(params.get('paths')), state=state)
+    MATRIX_CELLS.inc(len(origins) * len(destinations))
+
+    result = {
+        'origins': [{'lat': lat, 'lng': lng, 'node': node} for (lat, lng), node in zip(origins.tolist(), nodes)],
+        'destinations': [{'lat': lat, 'lng': lng, 'node': node}
+                         for (lat, lng), node in zip(destinations.tolist(), nodes[len(origins):])],
+        'weights': matrix_rows(weights),
+        'lengths': matrix_rows(lengths),
+        'weights_version': state.version,
+    }
+    if paths is not None:
+        result['paths'] = paths
+    timing = spans()
+    result['timing'] = {
+        'snap_ms': timing['snap'] * 1000,
+        'route_ms': timing['matrix'] * 1000,
+        'total_ms': (time.perf_counter() - started) * 1000,
+    }
+    return jsonify(result)
 
-        map_path = 'templates/temp_map.html'
-        mymap.save(map_path)
 
-        return render_template("temp_map.html")
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    if request.method == 'POST':
+        return render_template(
+            'route.html',
+            start_location=request.form.get('start_location'),
+            end_location=request.form.get('end_location'),
+            depart=request.form.get('depart') or None,
+            streets_url=STREETS_URL,
+            hazards_url=HAZARDS_URL,
+            hazard_zooms=(MIN_ZOOM, DETAIL_ZOOM),
+        )
 
     return render_template('index.html')
 
@@ -99,7 +278,3 @@ def index():
 
 if __name__ == '__main__':
     app.run(debug=True ,port=5002)
-
-
-
-
@@ -0,0 +1,99 @@
+import json
+import os
+import sys
+import zlib
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.layers import DETAIL_ZOOM, MIN_ZOOM, PRECISION, point_columns, zoom_layer
+
+
+LAYER_VERSION = 3
+LAYER_DIR = os.path.join('static', 'layers')
+# Streets are simplified to within one screen pixel at DETAIL_ZOOM, in
+# degrees of longitude; closer in, the bends this drops are too small to
+# see under the one pixel wide line.
+STREET_TOLERANCE = 360 / (256 * 2 ** DETAIL_ZOOM)
+
+
+def _stamp(*parts):
+    return format(zlib.crc32(json.dumps([LAYER_VERSION, *parts], sort_keys=True).encode()), '08x')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def street_features(snapshot, tolerance=STREET_TOLERANCE):
+    # Every street once, whichever directions it can be driven in, as lines
+    # of a single MultiLineString following the edge geometry, simplified
+    # to within tolerance, or straight between the end nodes.
+    import shapely
+    coords, line_of = [], []
+    seen = set()
+    xs, ys = snapshot.x.tolist(), snapshot.y.tolist()
+    offsets = snapshot.geometry_offsets.tolist()
+    for i, (u, v) in enumerate(zip(snapshot.edge_u.tolist(), snapshot.edge_v.tolist())):
+        pair = (u, v) if u < v else (v, u)
+        if pair in seen:
+            continue
+        seen.add(pair)
+        lo, hi = offsets[i], offsets[i + 1]
+        if lo == hi:
+            coords.append(np.array([(xs[u], ys[u]), (xs[v], ys[v])]))
+        else:
+            coords.append(np.column_stack([snapshot.geometry_x[lo:hi], snapshot.geometry_y[lo:hi]]))
+        line_of.append(np.full(len(coords[-1]), len(line_of)))
+    lines = []
+    if coords:
+        simplified = shapely.simplify(shapely.linestrings(np.concatenate(coords), indices=np.concatenate(line_of)),
+                                      tolerance, preserve_topology=False)
+        points, index = shapely.get_coordinates(simplified, return_index=True)
+        points = np.round(points, PRECISION)
+        lines = [line.tolist() for line in np.split(points, np.flatnonzero(np.diff(index)) + 1)]
+    return {
+        'type': 'FeatureCollection',
+        'features': [{'type': 'Feature', 'properties': {}, 'geometry': {'type': 'MultiLineString', 'coordinates': lines}}],
+    }
+
+
+def hazard_levels(layers):
+    # layers is a list of (dataframe, value column, popup label, colour).
+    # Returns, per zoom from MIN_ZOOM to DETAIL_ZOOM, every layer's points
+    # as columns, merged into grid cells below DETAIL_ZOOM.
+    columns = [(point_columns(df, column), label, color) for df, column, label, color in layers]
+    return {
+        zoom: {'layers': [{'label': label, 'color': color, **zoom_layer(lat, lng, values, zoom)}
+                          for (lat, lng, values), label, color in columns]}
+        for zoom in range(MIN_ZOOM, DETAIL_ZOOM + 1)
+    }
+
+
+def street_layer(snapshot):
+    # Writes the street background once per graph snapshot and returns its
+    # URL. The file name carries a hash of the source, so browsers can
+    # cache it for good and a new graph gets a new URL.
+    name = f"streets-{_stamp(snapshot.meta.get('source'), snapshot.num_edges)}.geojson"
+    path = os.path.join(LAYER_DIR, name)
+    if not os.path.exists(path):
+        _write(path, street_features(snapshot))
+    return '/' + path.replace(os.sep, '/')
+
+
+def hazard_layer(csv_paths, layers):
+    # Writes one file per zoom level and returns their URL with {z} in
+    # place of the zoom, which the page fills in from MIN_ZOOM to
+    # DETAIL_ZOOM.
+    stamps = [(p, os.stat(p).st_size, os.stat(p).st_mtime) for p in csv_paths]
+    name = f"hazards-{_stamp(stamps)}-{{z}}.json"
+    path = os.path.join(LAYER_DIR, name)
+    if not os.path.exists(path.format(z=DETAIL_ZOOM)):
+        # The most detailed level last: its presence means all are written.
+        for zoom, data in sorted(hazard_levels(layers).items()):
+            _write(path.format(z=zoom), data)
+    return '/' + path.replace(os.sep, '/')
@@ -0,0 +1,391 @@
+import copy
+import math
+import sys
+import time
+import zlib
+from heapq import heappop, heappush
+
+import numpy as np
+
+
+CH_VERSION = 1
+
+
+def ch_path(graphml_path):
+    base = graphml_path[:-len('.graphml')] if graphml_path.endswith('.graphml') else graphml_path
+    return base + '.ch.npz'
+
+
+def weights_checksum(engine):
+    return zlib.crc32(engine.indptr.tobytes() + engine.indices.tobytes() + engine.weights.tobytes())
+
+
+def contraction_order(engine):
+    # Greedy minimum-degree elimination on the undirected skeleton. Every
+    # pair of higher neighbours of a contracted node gets an arc, so the
+    # hierarchy does not depend on the weights: customize() fills them in
+    # and can be rerun on new weights without contracting the graph again.
+    n = engine.num_nodes
+    sources = np.repeat(np.arange(n), np.diff(engine.indptr))
+    adj = [set() for _ in range(n)]
+    for u, v in zip(sources.tolist(), engine.indices.tolist()):
+        if u != v:
+            adj[u].add(v)
+            adj[v].add(u)
+
+    rank = np.full(n, -1, dtype=np.int32)
+    upward = [None] * n
+    heap = [(len(adj[v]), v) for v in range(n)]
+    heap.sort()
+    r = 0
+    while heap:
+        degree, v = heappop(heap)
+        if rank[v] != -1 or degree != len(adj[v]):
+            continue
+        rank[v] = r
+        r += 1
+        neighbours = adj[v]
+        upward[v] = neighbours
+        adj[v] = None
+        for a in neighbours:
+            nbrs = adj[a]
+            nbrs.discard(v)
+            nbrs.update(neighbours)
+            nbrs.discard(a)
+            heappush(heap, (len(nbrs), a))
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum([len(upward[v]) for v in range(n)], out=indptr[1:])
+    heads = np.empty(indptr[-1], dtype=np.int32)
+    for v in range(n):
+        heads[indptr[v]:indptr[v + 1]] = sorted(upward[v])
+    return rank, indptr, heads
+
+
+class ContractionHierarchy:
+    # Arcs are stored once, at their lower endpoint, in CSR form. For arc k
+    # from lower node a to higher node b, up_weight[k] is the cost of a -> b
+    # and down_weight[k] the cost of b -> a. *_middle[k] is the contracted
+    # node a shortcut passes through, or -1 for an original street edge, and
+    # *_needed[k] is False for arcs no shortest path ever uses.
+
+    def __init__(self, rank, indptr, heads, up_weight, down_weight, up_middle, down_middle,
+                 up_needed=None, down_needed=None, checksum=None):
+        self.rank = np.asarray(rank, dtype=np.int32)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.heads = np.asarray(heads, dtype=np.int32)
+        self.up_weight = np.asarray(up_weight, dtype=np.float64)
+        self.down_weight = np.asarray(down_weight, dtype=np.float64)
+        self.up_middle = np.asarray(up_middle, dtype=np.int32)
+        self.down_middle = np.asarray(down_middle, dtype=np.int32)
+        self.up_needed = np.isfinite(self.up_weight) if up_needed is None else np.asarray(up_needed, dtype=bool)
+        self.down_needed = np.isfinite(self.down_weight) if down_needed is None else np.asarray(down_needed, dtype=bool)
+        self.checksum = checksum
+        self._graph = None
+        self._topology = None
+
+    @classmethod
+    def build(cls, engine):
+        rank, indptr, heads = contraction_order(engine)
+        m = len(heads)
+        ch = cls(rank, indptr, heads, np.full(m, np.inf), np.full(m, np.inf), np.full(m, -1), np.full(m, -1))
+        ch.customize(engine)
+        return ch
+
+    @property
+    def num_arcs(self):
+        return len(self.heads)
+
+    @property
+    def nbytes(self):
+        arrays = (self.rank, self.indptr, self.heads, self.up_weight, self.down_weight,
+                  self.up_middle, self.down_middle, self.up_needed, self.down_needed)
+        return sum(a.nbytes for a in arrays)
+
+    def arc(self, a, b):
+        lo, hi = self.indptr[a], self.indptr[a + 1]
+        k = lo + int(np.searchsorted(self.heads[lo:hi], b))
+        if k < hi and self.heads[k] == b:
+            return k
+        return -1
+
+    def topology(self):
+        # Python views of the arcs: per node {higher neighbour: arc}, and
+        # per node {lower neighbour: arc} for the arcs reaching it. They only
+        # depend on the order, so customized copies share them.
+        if self._topology is None:
+            n = len(self.rank)
+            indptr = self.indptr.tolist()
+            heads = self.heads.tolist()
+            arcs = [dict(zip(heads[indptr[v]:indptr[v + 1]], range(indptr[v], indptr[v + 1]))) for v in range(n)]
+            lower = [{} for _ in range(n)]
+            for v in range(n):
+                for a, k in arcs[v].items():
+                    lower[a][v] = k
+            self._topology = (self.rank.tolist(), arcs, lower)
+        return self._topology
+
+    def customize(self, engine):
+        n = engine.num_nodes
+        rank, arcs, _ = self.topology()
+        m = len(self.heads)
+        up = [math.inf] * m
+        down = [math.inf] * m
+        up_mid = [-1] * m
+        down_mid = [-1] * m
+
+        sources = np.repeat(np.arange(n), np.diff(engine.indptr)).tolist()
+        for u, v, w in zip(sources, engine.indices.tolist(), engine.weights.astype(np.float64).tolist()):
+            if u == v:
+                continue
+            if rank[u] < rank[v]:
+                k = arcs[u][v]
+                if w < up[k]:
+                    up[k] = w
+            else:
+                k = arcs[v][u]
+                if w < down[k]:
+                    down[k] = w
+
+        # Bottom-up: an arc's weight is its street edge or the best detour
+        # through a lower node, whose own arcs are final by then.
+        for v in np.argsort(self.rank).tolist():
+            upper = list(arcs[v].items())
+            for a, k_va in upper:
+                to_v = down[k_va]
+                if to_v == math.inf:
+                    continue
+                for b, k_vb in upper:
+                    if a == b:
+                        continue
+                    w = to_v + up[k_vb]
+                    if rank[a] < rank[b]:
+                        k = arcs[a][b]
+                        if w < up[k]:
+                            up[k] = w
+                            up_mid[k] = v
+                    else:
+                        k = arcs[b][a]
+                        if w < down[k]:
+                            down[k] = w
+                            down_mid[k] = v
+
+        # Top-down: also allow detours through higher nodes. Arcs that get
+        # cheaper that way are never on a shortest up-down path and are left
+        # out of the query graph.
+        up_perfect = list(up)
+        down_perfect = list(down)
+        for v in np.argsort(-self.rank, kind='stable').tolist():
+            upper = list(arcs[v].items())
+            for i, (a, k_va) in enumerate(upper):
+                for b, k_vb in upper[i + 1:]:
+                    if rank[a] < rank[b]:
+                        k_ab = arcs[a][b]
+                        k_lo, k_hi = k_va, k_vb
+                    else:
+                        k_ab = arcs[b][a]
+                        k_lo, k_hi = k_vb, k_va
+                    w = up_perfect[k_lo] + up_perfect[k_ab]
+                    if w < up_perfect[k_hi]:
+                        up_perfect[k_hi] = w
+                    w = up_perfect[k_hi] + down_perfect[k_ab]
+                    if w < up_perfect[k_lo]:
+                        up_perfect[k_lo] = w
+                    w = up_perfect[k_ab] + down_perfect[k_hi]
+                    if w < down_perfect[k_lo]:
+                        down_perfect[k_lo] = w
+                    w = down_perfect[k_ab] + down_perfect[k_lo]
+                    if w < down_perfect[k_hi]:
+                        down_perfect[k_hi] = w
+
+        self.up_weight = np.array(up)
+        self.down_weight = np.array(down)
+        self.up_middle = np.array(up_mid, dtype=np.int32)
+        self.down_middle = np.array(down_mid, dtype=np.int32)
+        self.up_needed = np.isfinite(self.up_weight) & (self.up_weight <= np.array(up_perfect))
+        self.down_needed = np.isfinite(self.down_weight) & (self.down_weight <= np.array(down_perfect))
+        self.checksum = weights_checksum(engine)
+        self._graph = None
+
+    def updated(self, engine, changed):
+        # A copy customized for engine, whose weights differ from the ones
+        # this hierarchy was customized for only on the CSR arcs in
+        # changed. Only hierarchy arcs whose weight can depend on those are
+        # recomputed, lowest first, each from its street edges and its
+        # triangles through lower nodes. The top-down pruning cannot be
+        # redone locally, so the copy searches all arcs until the next full
+        # customize().
+        rank, arcs, lower = self.topology()
+        indptr, indices, weights = engine._lists()
+        up = self.up_weight.tolist()
+        down = self.down_weight.tolist()
+        up_mid = self.up_middle.tolist()
+        down_mid = self.down_middle.tolist()
+
+        def street_weight(a, b):
+            return min((weights[e] for e in range(indptr[a], indptr[a + 1]) if indices[e] == b), default=math.inf)
+
+        heap = []
+        queued = set()
+        owners = np.searchsorted(engine.indptr, changed, side='right') - 1
+        for u, v in zip(owners.tolist(), engine.indices[changed].tolist()):
+            if u != v:
+                lo, hi = (u, v) if rank[u] < rank[v] else (v, u)
+                k = arcs[lo][hi]
+                if k not in queued:
+                    queued.add(k)
+                    heappush(heap, (rank[lo], k, lo, hi))
+
+        while heap:
+            _, k, a, b = heappop(heap)
+            new_up, new_down = street_weight(a, b), street_weight(b, a)
+            new_up_mid = new_down_mid = -1
+            lower_a, lower_b = lower[a], lower[b]
+            for v in lower_a.keys() & lower_b.keys():
+                k_va, k_vb = lower_a[v], lower_b[v]
+                w = down[k_va] + up[k_vb]
+                if w < new_up:
+                    new_up, new_up_mid = w, v
+                w = down[k_vb] + up[k_va]
+                if w < new_down:
+                    new_down, new_down_mid = w, v
+            if new_up == up[k] and new_down == down[k]:
+                continue
+            up[k], down[k], up_mid[k], down_mid[k] = new_up, new_down, new_up_mid, new_down_mid
+            for y in arcs[a]:
+                if y != b:
+                    lo, hi = (b, y) if rank[b] < rank[y] else (y, b)
+                    k = arcs[lo][hi]
+                    if k not in queued:
+                        queued.add(k)
+                        heappush(heap, (rank[lo], k, lo, hi))
+
+        ch = copy.copy(self)
+        ch.up_weight = np.array(up)
+        ch.down_weight = np.array(down)
+        ch.up_middle = np.array(up_mid, dtype=np.int32)
+        ch.down_middle = np.array(down_mid, dtype=np.int32)
+        ch.up_needed = np.isfinite(ch.up_weight)
+        ch.down_needed = np.isfinite(ch.down_weight)
+        ch.checksum = weights_checksum(engine)
+        ch._graph = None
+        return ch
+
+    def save(self, path):
+        np.savez(path, version=CH_VERSION, checksum=self.checksum, rank=self.rank, indptr=self.indptr,
+                 heads=self.heads, up_weight=self.up_weight, down_weight=self.down_weight,
+                 up_middle=self.up_middle, down_middle=self.down_middle,
+                 up_needed=self.up_needed, down_needed=self.down_needed)
+
+    @classmethod
+    def load(cls, path, engine=None):
+        with np.load(path) as data:
+            if int(data['version']) != CH_VERSION:
+                raise ValueError(f"{path} was built by an incompatible version of ch.py")
+            ch = cls(data['rank'], data['indptr'], data['heads'], data['up_weight'], data['down_weight'],
+                     data['up_middle'], data['down_middle'], data['up_needed'], data['down_needed'],
+                     int(data['checksum']))
+        if engine is not None and ch.checksum != weights_checksum(engine):
+            raise ValueError(f"{path} does not match the loaded graph weights, rebuild it with ch.py")
+        return ch
+
+    def _search_graph(self):
+        # Per node, the needed upward arcs as (head, weight) pairs, once for
+        # the up weights and once for the down weights.
+        if self._graph is None:
+            owners = np.repeat(np.arange(len(self.rank)), np.diff(self.indptr))
+            graphs = []
+            for needed, weight in ((self.up_needed, self.up_weight), (self.down_needed, self.down_weight)):
+                counts = np.bincount(owners[needed], minlength=len(self.rank))
+                indptr = np.zeros(len(self.rank) + 1, dtype=np.int64)
+                np.cumsum(counts, out=indptr[1:])
+                heads = self.heads[needed].tolist()
+                weights = weight[needed].tolist()
+                graphs.append([list(zip(heads[lo:hi], weights[lo:hi]))
+                               for lo, hi in zip(indptr[:-1].tolist(), indptr[1:].tolist())])
+            self._graph = graphs
+        return self._graph
+
+    def query(self, s, t):
+        if s == t:
+            return [s]
+        graphs = self._search_graph()
+        dists = ({s: 0.0}, {t: 0.0})
+        preds = ({s: -1}, {t: -1})
+        fringes = ([(0.0, s)], [(0.0, t)])
+        settled = (set(), set())
+        best = math.inf
+        meet = -1
+        while fringes[0] or fringes[1]:
+            front0 = fringes[0][0][0] if fringes[0] else math.inf
+            front1 = fringes[1][0][0] if fringes[1] else math.inf
+            if min(front0, front1) >= best:
+                break
+            direction = 0 if front0 <= front1 else 1
+            d, v = heappop(fringes[direction])
+            if v in settled[direction]:
+                continue
+            settled[direction].add(v)
+            dist, pred, other = dists[direction], preds[direction], dists[1 - direction]
+            if v in other and d + other[v] < best:
+                best = d + other[v]
+                meet = v
+
+            fringe = fringes[direction]
+            for u, w in graphs[direction][v]:
+                vu_dist = d + w
+                if vu_dist < dist.get(u, math.inf):
+                    dist[u] = vu_dist
+                    pred[u] = v
+                    heappush(fringe, (vu_dist, u))
+        if meet == -1:
+            return None
+
+        up_path = []
+        v = meet
+        while v != -1:
+            up_path.append(v)
+            v = preds[0][v]
+        up_path.reverse()
+        down_path = []
+        v = meet
+        while v != -1:
+            down_path.append(v)
+            v = preds[1][v]
+
+        path = [s]
+        for a, b in zip(up_path[:-1], up_path[1:]):
+            self._unpack(a, b, path)
+        for a, b in zip(down_path[:-1], down_path[1:]):
+            self._unpack(a, b, path)
+        return path
+
+    def _unpack(self, a, b, path):
+        # Appends the original nodes after a on the arc a -> b.
+        stack = [(a, b)]
+        while stack:
+            a, b = stack.pop()
+            if self.rank[a] < self.rank[b]:
+                middle = self.up_middle[self.arc(a, b)]
+            else:
+                middle = self.down_middle[self.arc(b, a)]
+            if middle == -1:
+                path.append(b)
+            else:
+                stack.append((int(middle), b))
+                stack.append((a, int(middle)))
+
+
+if __name__ == '__main__':
+    from routing import RoutingEngine
+    from snapshot import load_graph
+
+    graphml_path = sys.argv[1] if len(sys.argv) > 1 else 'weighted_graph.graphml'
+    engine = RoutingEngine.from_snapshot(load_graph(graphml_path))
+
+    start = time.perf_counter()
+    ch = ContractionHierarchy.build(engine)
+    print(f"Contracted {engine.num_nodes} nodes into {ch.num_arcs} arcs in {time.perf_counter() - start:.1f}s")
+
+    ch.save(ch_path(graphml_path))
+    print(f"Saved {ch_path(graphml_path)}")
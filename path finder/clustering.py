@@ -0,0 +1,262 @@
+import argparse
+import os
+import re
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.boroughs import load_index
+
+
+CLUSTERING_VERSION = 1
+BOROUGHS = ['MANHATTAN', 'BROOKLYN', 'QUEENS', 'BRONX', 'STATEN ISLAND']
+BOROUGH_BOUNDARIES = os.path.join('..', 'webapp', 'new-york-city-boroughs.geojson')
+# Clusters per borough, as the notebook made for Manhattan.
+CLUSTERS = 50
+BATCH_SIZE = 4096
+# Iterations when starting from the centroids of the previous run, which
+# are already close; a cold start gets MiniBatchKMeans' default.
+WARM_ITER = 20
+CHUNK_ROWS = 200000
+
+COLLISION_COLUMNS = [
+    'number_of_persons_injured', 'number_of_persons_killed',
+    'number_of_cyclist_injured', 'number_of_cyclist_killed',
+    'number_of_motorist_injured', 'number_of_motorist_killed',
+]
+# The hourly counts of the traffic feed, '_12_00_1_00_am' to '_11_00_12_00am'.
+HOUR_COLUMN = re.compile(r'^_\d+_00_')
+
+# Per kind (as overlay.KINDS names them): the raw feed, the columns its
+# rows are grouped into locations by, as the notebook grouped them, the
+# value column written, and whether values are scaled to 0-100 over the
+# whole city.
+FEEDS = {
+    'traffic': {
+        'csv': 'traffic.csv',
+        'keys': ['latitude', 'longitude', 'Roadway_Name', 'Direction', 'From_St', 'To_St'],
+        'value': 'Average_volume',
+        'scale': True,
+    },
+    'construction': {
+        'csv': 'constructions.csv',
+        'keys': ['borough', 'latitude', 'longitude', 'consttype', 'buildingid', 'zip_code'],
+        'value': 'award',
+        'scale': False,
+    },
+    'collision': {
+        'csv': 'collisions.csv',
+        'keys': ['borough', 'latitude', 'longitude'],
+        'value': 'total_casualties',
+        'scale': True,
+    },
+}
+
+
+def clustered_path(kind, directory='.'):
+    return os.path.join(directory, f'{kind}_clustered.csv')
+
+
+def centroids_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.centroids.npz'
+
+
+def row_values(kind, chunk):
+    # The value of each raw row: mean hourly volume, casualties, or award.
+    if kind == 'traffic':
+        hours = [c for c in chunk.columns if HOUR_COLUMN.match(c)]
+        return chunk[hours].sum(axis=1) / 24
+    if kind == 'collision':
+        return chunk[[c for c in COLLISION_COLUMNS if c in chunk]].sum(axis=1)
+    return chunk['award']
+
+
+def locations(kind, csv_path, chunk_rows=CHUNK_ROWS):
+    # The mean value per location of a raw feed, read a chunk at a time, as
+    # lat, lng and value arrays.
+    feed = FEEDS[kind]
+
+    def wanted(column):
+        return column in feed['keys'] or column in COLLISION_COLUMNS or column == 'award' or HOUR_COLUMN.match(column)
+
+    partials = []
+    with pd.read_csv(csv_path, usecols=wanted, chunksize=chunk_rows, low_memory=False) as reader:
+        for chunk in reader:
+            chunk = chunk.dropna(subset=['latitude', 'longitude'])
+            keys = [chunk[k] for k in feed['keys'] if k in chunk]
+            groups = row_values(kind, chunk).groupby(keys, dropna=False)
+            partials.append(pd.DataFrame({'sum': groups.sum(), 'count': groups.count()}))
+    totals = pd.concat(partials).groupby(level=list(range(partials[0].index.nlevels)), dropna=False).sum()
+    totals = totals[totals['count'] > 0].reset_index()
+    values = (totals['sum'] / totals['count']).to_numpy(dtype=np.float64)
+    if feed['scale'] and len(values):
+        low, high = values.min(), values.max()
+        values = (values - low) / ((high - low) or 1) * 100
+    return totals['latitude'].to_numpy(dtype=np.float64), totals['longitude'].to_numpy(dtype=np.float64), values
+
+
+def by_borough(lat, lng, values, boundaries_path=BOROUGH_BOUNDARIES):
+    # The locations split per borough, from the polygons rather than the
+    # feeds' own borough columns, which are often blank. Locations outside
+    # the city, such as the 0, 0 placeholders, are dropped.
+    index = load_index(boundaries_path)
+    codes = index.codes(lng, lat)
+    names = [name.upper() for name in index.names]
+    parts = {}
+    for borough in BOROUGHS:
+        rows = np.isin(codes, [i for i, name in enumerate(names) if name == borough])
+        parts[borough] = (lat[rows], lng[rows], values[rows])
+    return parts
+
+
+def digest(lat, lng):
+    return zlib.crc32(np.ascontiguousarray(lat).tobytes() + np.ascontiguousarray(lng).tobytes())
+
+
+def cluster(lat, lng, values, clusters=CLUSTERS, previous=None, seed=42):
+    # MiniBatchKMeans over the locations of one borough. previous is the
+    # (centroids, digest) of the last run: when the locations are the same
+    # its centroids are kept and rows are only assigned to them, otherwise
+    # they seed the fit. Returns the clusters as a frame, the centroids,
+    # how the fit started and the seconds it took.
+    from sklearn.cluster import MiniBatchKMeans
+
+    start = time.perf_counter()
+    points = np.column_stack([lat, lng])
+    k = min(clusters, len(points))
+    if k == 0:
+        return pd.DataFrame({'latitude': [], 'longitude': [], 'value': []}), np.empty((0, 2)), 'empty', 0.0
+    seeded = previous is not None and len(previous[0]) == k
+    if seeded and previous[1] == digest(lat, lng):
+        centroids, how = previous[0], 'reused'
+    else:
+        model = MiniBatchKMeans(n_clusters=k, init=previous[0] if seeded else 'k-means++', n_init=1,
+                                max_iter=WARM_ITER if seeded else 100, batch_size=BATCH_SIZE, random_state=seed)
+        model.fit(points)
+        centroids, how = model.cluster_centers_, 'warm' if seeded else 'cold'
+    labels = assign(points, centroids)
+    known = ~np.isnan(values)
+    counts = np.bincount(labels[known], minlength=k)
+    totals = np.bincount(labels[known], values[known], minlength=k)
+    used = np.bincount(labels, minlength=k) > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = totals / counts
+    frame = pd.DataFrame({'latitude': centroids[used, 0], 'longitude': centroids[used, 1], 'value': means[used]})
+    return frame, centroids, how, time.perf_counter() - start
+
+
+def assign(points, centroids, chunk=20000):
+    # Nearest centroid of each point, a chunk of points at a time.
+    return np.concatenate([((points[i:i + chunk, None, :] - centroids[None, :, :]) ** 2).sum(axis=2).argmin(axis=1)
+                           for i in range(0, len(points), chunk)])
+
+
+def load_centroids(path):
+    # {borough: (centroids, digest)} of the previous run, empty when there
+    # is none or it was written by another version.
+    try:
+        with np.load(path) as data:
+            if int(data['version']) != CLUSTERING_VERSION:
+                return {}
+            return {borough: (data[f'{borough}_centroids'], int(data[f'{borough}_digest']))
+                    for borough in BOROUGHS if f'{borough}_centroids' in data}
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save_centroids(path, centroids):
+    arrays = {'version': CLUSTERING_VERSION}
+    for borough, (points, point_digest) in centroids.items():
+        arrays[f'{borough}_centroids'] = points
+        arrays[f'{borough}_digest'] = point_digest
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def _cluster_task(kind, borough, lat, lng, values, clusters, previous):
+    frame, centroids, how, seconds = cluster(lat, lng, values, clusters, previous)
+    return kind, borough, frame, (centroids, digest(lat, lng)), how, seconds
+
+
+def run(feeds, out_dir='.', boundaries_path=BOROUGH_BOUNDARIES, clusters=CLUSTERS, processes=None, cold=False):
+    # Clusters each {kind: raw csv} per borough, the boroughs of all kinds
+    # in a pool of processes, and writes {kind}_clustered.csv in out_dir
+    # with the centroids kept next to it for the next run. Returns the
+    # paths written.
+    processes = processes or os.cpu_count() or 1
+    tasks = []
+    previous = {}
+    for kind, csv_path in feeds.items():
+        start = time.perf_counter()
+        lat, lng, values = locations(kind, csv_path)
+        parts = by_borough(lat, lng, values, boundaries_path)
+        print(f"{kind:<13} {len(lat):9d} locations read in {time.perf_counter() - start:6.2f}s")
+        previous[kind] = {} if cold else load_centroids(centroids_path(clustered_path(kind, out_dir)))
+        for borough, (b_lat, b_lng, b_values) in parts.items():
+            tasks.append((kind, borough, b_lat, b_lng, b_values, clusters, previous[kind].get(borough)))
+
+    start = time.perf_counter()
+    if processes > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(processes, len(tasks))) as pool:
+            results = list(pool.map(_cluster_task, *zip(*tasks)))
+    else:
+        results = [_cluster_task(*task) for task in tasks]
+    wall = time.perf_counter() - start
+
+    frames = {kind: [] for kind in feeds}
+    centroids = {kind: {} for kind in feeds}
+    for (kind, borough, frame, kept, how, seconds), task in zip(results, tasks):
+        print(f"{kind:<13} {borough:<14} {len(task[2]):8d} locations  {len(frame):4d} clusters  "
+              f"{seconds:6.2f}s  {how}")
+        frame['borough'] = borough
+        frames[kind].append(frame)
+        centroids[kind][borough] = kept
+    print(f"Clustered {len(tasks)} borough feeds in {wall:.2f}s with {min(processes, len(tasks))} processes")
+
+    paths = []
+    for kind in feeds:
+        path = clustered_path(kind, out_dir)
+        df = pd.concat(frames[kind], ignore_index=True).rename(columns={'value': FEEDS[kind]['value']})
+        df.to_csv(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        save_centroids(centroids_path(path), centroids[kind])
+        paths.append(path)
+    return paths
+
+
+def publish(paths, graphml_path):
+    # Builds the graph's weights from the fresh cluster files and publishes
+    # them as one new weight version for the path finder.
+    from overlay import open_overlay
+    from weights import build
+
+    return build(open_overlay(graphml_path), paths).version
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cluster the raw feeds per borough into the *_clustered.csv "
+                                                 "files the path finder weights its graph with")
+    parser.add_argument('--feeds', default=os.path.join('..', 'webapp'),
+                        help="directory of collisions.csv, constructions.csv and traffic.csv")
+    parser.add_argument('--kinds', nargs='*', default=list(FEEDS), choices=list(FEEDS))
+    parser.add_argument('--out', default='.', help="directory to write the cluster files to")
+    parser.add_argument('--boroughs', default=BOROUGH_BOUNDARIES, help="borough boundaries GeoJSON")
+    parser.add_argument('--clusters', type=int, default=CLUSTERS, help="clusters per borough")
+    parser.add_argument('--processes', type=int, default=0, help="worker processes, 0 for one per core")
+    parser.add_argument('--cold', action='store_true', help="ignore the centroids of the previous run")
+    parser.add_argument('--publish', metavar='GRAPHML',
+                        help="publish the result as a new weight version of this graph")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    feeds = {kind: os.path.join(args.feeds, FEEDS[kind]['csv']) for kind in args.kinds}
+    paths = run(feeds, args.out, args.boroughs, args.clusters, args.processes or None, args.cold)
+    print(f"Wrote {', '.join(paths)} in {time.perf_counter() - started:.1f}s")
+    if args.publish:
+        print(f"Published weight version {publish(paths, args.publish)}")
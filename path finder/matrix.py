@@ -0,0 +1,140 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+
+
+# Sources searched together in one csgraph call; each one holds a row of
+# distances and predecessors for the whole graph, so this bounds memory.
+CHUNK = 32
+
+_worker = None
+
+
+def _lengths_matrix(engine, snapshot):
+    lengths = snapshot.edge_length[engine.arc_edge].astype(np.float64)
+    return csr_matrix((lengths, engine.indices, engine.indptr), shape=(engine.num_nodes, engine.num_nodes))
+
+
+def _path_lengths(pred, lengths, targets):
+    # Length along the shortest-path tree from the source to each target,
+    # summed by pointer jumping rather than by walking every path.
+    n = len(pred)
+    has_pred = pred >= 0
+    parent = np.where(has_pred, pred, np.arange(n))
+    step = np.zeros(n)
+    rows = np.flatnonzero(has_pred)
+    step[rows] = np.asarray(lengths[parent[rows], rows]).ravel()
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            break
+        step = step + step[parent]
+        parent = grandparent
+    return step[targets]
+
+
+def _search(engine, lengths, sources, targets, with_paths):
+    dist, pred = csgraph_dijkstra(engine.matrix(), indices=sources, return_predecessors=True)
+    weights = dist[:, targets]
+    path_lengths = np.array([_path_lengths(p, lengths, targets) for p in pred])
+    path_lengths[~np.isfinite(weights)] = np.inf
+    paths = None
+    if with_paths:
+        paths = []
+        for s, p in zip(sources, pred):
+            row = []
+            for t in targets:
+                if t != s and p[t] < 0:
+                    row.append(None)
+                    continue
+                nodes = [t]
+                while nodes[-1] != s:
+                    nodes.append(p[nodes[-1]])
+                row.append(engine.node_ids[nodes[::-1]].tolist())
+            paths.append(row)
+    return weights, path_lengths, paths
+
+
+def _init_worker(graphml_path):
+    global _worker
+    from routing import RoutingEngine
+    from snapshot import load_graph
+    snapshot = load_graph(graphml_path)
+    engine = RoutingEngine.from_snapshot(snapshot)
+    _worker = {'snapshot': snapshot, 'base': engine, 'weights_path': None,
+               'engine': engine, 'lengths': _lengths_matrix(engine, snapshot)}
+
+
+def _worker_search(sources, targets, with_paths, weights_path):
+    # weights_path names the published weight version to search, None for
+    # the snapshot's own weights; a worker loads each version once.
+    if weights_path != _worker['weights_path']:
+        from overlay import load_weights
+        engine = _worker['base']
+        if weights_path is not None:
+            engine = engine.with_weights(*load_weights(weights_path))
+        _worker.update(weights_path=weights_path, engine=engine, lengths=_lengths_matrix(engine, _worker['snapshot']))
+    return _search(_worker['engine'], _worker['lengths'], sources, targets, with_paths)
+
+
+class MatrixRouter:
+    # Many-to-many routing: one Dijkstra per distinct origin answers every
+    # destination at once. With processes > 1, chunks of origins are
+    # searched in a pool of workers that map the same graph snapshot.
+    # matrix() takes the weight version to use from a WeightState; workers
+    # can only follow versions that were saved to disk.
+
+    def __init__(self, engine, snapshot, graphml_path=None, processes=None):
+        self.engine = engine
+        self.snapshot = snapshot
+        self.graphml_path = graphml_path
+        self.processes = processes or os.cpu_count() or 1
+        self._lengths = (None, None)
+        self._pool = None
+
+    def lengths(self, engine):
+        if self._lengths[0] is not engine:
+            self._lengths = (engine, _lengths_matrix(engine, self.snapshot))
+        return self._lengths[1]
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.processes, initializer=_init_worker,
+                                             initargs=(os.path.abspath(self.graphml_path),))
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def matrix(self, sources, targets, with_paths=False, state=None):
+        # sources and targets are OSM node ids. Returns the weight and
+        # length matrices, inf where a target cannot be reached, and the
+        # node paths when asked for.
+        engine = self.engine if state is None else state.engine
+        weights_path = None if state is None or state.version == 0 else state.path
+        sources = np.array([engine.index[s] for s in sources], dtype=np.int64)
+        targets = np.array([engine.index[t] for t in targets], dtype=np.int64)
+        unique, inverse = np.unique(sources, return_inverse=True)
+        chunks = [unique[i:i + CHUNK] for i in range(0, len(unique), CHUNK)]
+
+        pooled = state is None or state.version == 0 or state.path is not None
+        if self.processes > 1 and self.graphml_path is not None and len(chunks) > 1 and pooled:
+            pool = self.pool()
+            n = len(chunks)
+            results = list(pool.map(_worker_search, chunks, [targets] * n, [with_paths] * n,
+                                    [os.path.abspath(weights_path) if weights_path else None] * n))
+        else:
+            results = [_search(engine, self.lengths(engine), chunk, targets, with_paths) for chunk in chunks]
+
+        weights = np.vstack([r[0] for r in results])[inverse]
+        lengths = np.vstack([r[1] for r in results])[inverse]
+        paths = None
+        if with_paths:
+            rows = [row for r in results for row in r[2]]
+            paths = [rows[i] for i in inverse]
+        return weights, lengths, paths
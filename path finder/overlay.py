@@ -0,0 +1,341 @@
+import argparse
+import copy
+import fcntl
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from weights import edge_values, risk_weights
+
+
+# The clustered feeds and their value columns; construction sites count
+# whatever their award. weights.RISK says how much each kind weighs.
+KINDS = {
+    'traffic': ('traffic_clustered.csv', 'Average_volume'),
+    'construction': ('construction_clustered.csv', None),
+    'collision': ('collision_clustered.csv', 'total_casualties'),
+}
+# Versions kept on disk behind the current one, for readers still loading
+# them while a new one is published.
+KEEP = 3
+# Above this share of changed arcs a change reaches most of the contraction
+# hierarchy anyway, and customizing it from scratch is as fast and keeps it
+# pruned.
+RECUSTOMIZE_FRACTION = 0.005
+# Seconds between checks of the pointer file for versions published by
+# another process.
+REFRESH_SECONDS = 1.0
+
+
+def overlay_path(graphml_path):
+    base = graphml_path[:-len('.graphml')] if graphml_path.endswith('.graphml') else graphml_path
+    return base + '.overlay'
+
+
+def load_weights(path):
+    # The arc weights and arc edges of a published version, as needed by
+    # RoutingEngine.with_weights.
+    with np.load(path) as data:
+        return data['weights'], data['arc_edge']
+
+
+class WeightState:
+    # One immutable version of the weights. Requests take overlay.current
+    # once and route on state.engine throughout, so a version published
+    # meanwhile never mixes into a query.
+
+    def __init__(self, version, engine, tables, path=None):
+        self.version = version
+        self.engine = engine
+        self.tables = tables
+        self.path = path
+
+
+class WeightOverlay:
+    # Risk weights layered over the graph snapshot. tables holds, per kind,
+    # the largest value the clustered rows put on each edge they snap to;
+    # the weights of those edges follow from them and the edge lengths as
+    # weights.risk_weights() has it, and every other edge keeps its GraphML
+    # weight, which version 0 routes on. Parallel edges collapse to the
+    # cheapest one as in the snapshot. Only arcs whose weight actually
+    # changed are handed to the contraction hierarchy.
+
+    def __init__(self, snapshot, spatial_index, engine, path=None):
+        self.snapshot = snapshot
+        self.spatial_index = spatial_index
+        self.path = path
+        self.current = WeightState(0, engine, {kind: {} for kind in KINDS})
+        self._lock = threading.Lock()
+        self._checked = 0
+        self._pointer_mtime = None
+        u, v = snapshot.edge_u, snapshot.edge_v
+        starts = np.flatnonzero(np.r_[True, (u[1:] != u[:-1]) | (v[1:] != v[:-1])])
+        self._arc_starts = starts
+        self._arc_ends = np.r_[starts[1:], len(u)]
+
+    def replace(self, kind, lats, lngs, values=None):
+        # A fresh batch of a feed: the kind's previous rows are dropped.
+        return self.update({kind: self._snap(kind, lats, lngs, values)}, replace=True)
+
+    def add(self, kind, lats, lngs, values=None):
+        # Single events on top of what the kind already holds; an edge keeps
+        # the larger of its old and new values.
+        return self.update({kind: self._snap(kind, lats, lngs, values)})
+
+    def load_csv(self, csv_path, kind=None):
+        kind = kind or kind_of(csv_path)
+        df = pd.read_csv(csv_path)
+        column = KINDS[kind][1]
+        return self.replace(kind, df['latitude'], df['longitude'], None if column is None else df[column])
+
+    def _snap(self, kind, lats, lngs, values):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown weight kind {kind!r}, expected one of {', '.join(KINDS)}")
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+        values = np.ones(len(lats)) if values is None else np.asarray(values, dtype=np.float64)
+        if not len(lats):
+            return {}
+        edges, _ = self.spatial_index.nearest_edge_index(lngs, lats)
+        edges, values = edge_values(edges, values)
+        return dict(zip(edges.tolist(), values.tolist()))
+
+    def update(self, changes, replace=False):
+        # Publishes a new version from {kind: {edge: value}} and returns it.
+        with self._lock:
+            previous = self.current
+            tables = dict(previous.tables)
+            for kind, table in changes.items():
+                if replace:
+                    tables[kind] = dict(table)
+                else:
+                    merged = dict(tables[kind])
+                    for edge, value in table.items():
+                        merged[edge] = max(merged.get(edge, value), value)
+                    tables[kind] = merged
+            state = self._build(previous, tables)
+            if self.path is not None:
+                self._save(state)
+            self.current = state
+            return state
+
+    def recustomize(self):
+        # Publishes the current weights again with the hierarchy customized
+        # from scratch, which restores the pruning incremental updates drop.
+        with self._lock:
+            previous = self.current
+            engine = previous.engine.with_weights(previous.engine.weights)
+            if previous.engine.hierarchy is not None:
+                engine.hierarchy = copy.copy(previous.engine.hierarchy)
+                engine.hierarchy.customize(engine)
+            state = WeightState(previous.version + 1, engine, previous.tables)
+            if self.path is not None:
+                self._save(state)
+            self.current = state
+            return state
+
+    def edge_weights(self, tables):
+        # tables may also hold (edges, values) arrays in place of dicts.
+        arrays = {kind: table if isinstance(table, tuple) else
+                  (np.fromiter(table.keys(), dtype=np.int64, count=len(table)),
+                   np.fromiter(table.values(), dtype=np.float64, count=len(table)))
+                  for kind, table in tables.items()}
+        touched = np.zeros(self.snapshot.num_edges, dtype=bool)
+        for edges, _ in arrays.values():
+            touched[np.asarray(edges, dtype=np.int64)] = True
+        return np.where(touched, risk_weights(self.snapshot.edge_length, arrays), self.snapshot.edge_weight)
+
+    def arc_weights(self, edge_weights):
+        # The weight of each CSR arc, that of the cheapest of its edges.
+        return np.minimum.reduceat(edge_weights, self._arc_starts).astype(np.float32)
+
+    def edge_arcs(self, edges):
+        # The CSR arc each edge belongs to.
+        return np.searchsorted(self._arc_starts, edges, side='right') - 1
+
+    def _build(self, previous, tables):
+        edge_weights = self.edge_weights(tables)
+        weights = self.arc_weights(edge_weights)
+        base = previous.engine
+        changed = np.flatnonzero(weights != base.weights)
+        arc_edge = base.arc_edge.copy()
+        for arc in changed.tolist():
+            lo, hi = self._arc_starts[arc], self._arc_ends[arc]
+            arc_edge[arc] = lo + int(np.argmin(edge_weights[lo:hi]))
+        engine = base.with_weights(weights, arc_edge)
+        if base.hierarchy is not None:
+            engine.hierarchy = self._customized(base.hierarchy, engine, changed)
+        print(f"Weight version {previous.version + 1}: {len(changed)} of {engine.num_edges} arcs changed")
+        return WeightState(previous.version + 1, engine, tables)
+
+    def _customized(self, hierarchy, engine, changed):
+        if len(changed) > RECUSTOMIZE_FRACTION * engine.num_edges:
+            hierarchy = copy.copy(hierarchy)
+            hierarchy.customize(engine)
+            return hierarchy
+        return hierarchy.updated(engine, changed)
+
+    def _save(self, state):
+        # The version's files are written under temporary names and renamed,
+        # and only then named in current.json, which is replaced atomically.
+        # Writers take turns on a lock file, as snapshot.publish_dir does, so
+        # two processes never pick the same version number.
+        os.makedirs(self.path, exist_ok=True)
+        pointer = os.path.join(self.path, 'current.json')
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(pointer) as f:
+                    state.version = max(state.version, json.load(f)['version'] + 1)
+            except (OSError, ValueError, KeyError):
+                pass
+            name = f'v{state.version}'
+            state.path = os.path.join(self.path, name + '.npz')
+            arrays = {'weights': state.engine.weights, 'arc_edge': state.engine.arc_edge}
+            for kind, table in state.tables.items():
+                arrays[kind + '_edges'] = np.fromiter(table.keys(), dtype=np.int64, count=len(table))
+                arrays[kind + '_values'] = np.fromiter(table.values(), dtype=np.float64, count=len(table))
+            self._write(state.path, lambda f: np.savez(f, **arrays))
+            if state.engine.hierarchy is not None:
+                self._write(os.path.join(self.path, name + '.ch.npz'), state.engine.hierarchy.save)
+            self._write(pointer, lambda f: f.write(json.dumps(
+                {'version': state.version, 'source': self.snapshot.meta.get('source')}).encode()))
+            for name in os.listdir(self.path):
+                version = name.split('.')[0][1:]
+                if name.startswith('v') and version.isdigit() and int(version) < state.version - KEEP:
+                    os.remove(os.path.join(self.path, name))
+
+    def _write(self, path, write):
+        # Calls write(f) on a temporary file of this process, then renames it
+        # to path.
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def refresh(self, force=False):
+        # Switches to a version another process has published, checking the
+        # pointer file at most every REFRESH_SECONDS. Returns the current
+        # state either way.
+        now = time.monotonic()
+        if self.path is None or not force and now - self._checked < REFRESH_SECONDS:
+            return self.current
+        self._checked = now
+        pointer = os.path.join(self.path, 'current.json')
+        try:
+            mtime = os.stat(pointer).st_mtime_ns
+            if mtime == self._pointer_mtime:
+                return self.current
+            with open(pointer) as f:
+                published = json.load(f)
+        except (OSError, ValueError):
+            return self.current
+        self._pointer_mtime = mtime
+        if published.get('source') != self.snapshot.meta.get('source'):
+            print(f"Ignoring weight overlay in {self.path}: it belongs to another version of the graph")
+            return self.current
+        with self._lock:
+            if published['version'] > self.current.version:
+                try:
+                    self.current = self._load(published['version'])
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Ignoring weight version {published['version']}: {e}")
+        return self.current
+
+    def _load(self, version):
+        from ch import ContractionHierarchy
+
+        path = os.path.join(self.path, f'v{version}.npz')
+        with np.load(path) as data:
+            weights, arc_edge = data['weights'], data['arc_edge']
+            tables = {kind: dict(zip(data[kind + '_edges'].tolist(), data[kind + '_values'].tolist()))
+                      for kind in KINDS}
+        previous = self.current.engine
+        engine = previous.with_weights(weights, arc_edge)
+        ch_file = os.path.join(self.path, f'v{version}.ch.npz')
+        if previous.hierarchy is not None and os.path.exists(ch_file):
+            engine.hierarchy = ContractionHierarchy.load(ch_file, engine)
+        elif previous.hierarchy is not None:
+            changed = np.flatnonzero(engine.weights != previous.weights)
+            engine.hierarchy = self._customized(previous.hierarchy, engine, changed)
+        return WeightState(version, engine, tables, path)
+
+
+def open_overlay(graphml_path):
+    # The overlay of the graph at graphml_path as a publisher outside the
+    # app sees it, on the latest published version.
+    from ch import ContractionHierarchy, ch_path
+    from routing import RoutingEngine
+    from snapshot import load_graph
+    from spatial import load_index
+
+    snapshot = load_graph(graphml_path)
+    engine = RoutingEngine.from_snapshot(snapshot)
+    if os.path.exists(ch_path(graphml_path)):
+        engine.hierarchy = ContractionHierarchy.load(ch_path(graphml_path), engine)
+    overlay = WeightOverlay(snapshot, load_index(graphml_path, snapshot), engine, overlay_path(graphml_path))
+    overlay.refresh(force=True)
+    return overlay
+
+
+def kind_of(csv_path):
+    name = os.path.basename(csv_path)
+    for kind in KINDS:
+        if name.startswith(kind):
+            return kind
+    raise ValueError(f"Cannot tell the weight kind of {csv_path}, name it after one of {', '.join(KINDS)}")
+
+
+def read_events(f, batch):
+    # JSON lines {"kind": ..., "lat": ..., "lng": ..., "value": ...}, grouped
+    # per kind into batches of at most batch events.
+    pending = {}
+    count = 0
+    for line in f:
+        if not line.strip():
+            continue
+        event = json.loads(line)
+        pending.setdefault(event['kind'], []).append((event['lat'], event['lng'], event.get('value', 1)))
+        count += 1
+        if count >= batch:
+            yield pending
+            pending, count = {}, 0
+    if pending:
+        yield pending
+
+
+if __name__ == '__main__':
+    import sys
+
+    parser = argparse.ArgumentParser(description="Publish a new weight version from fresh clustered feeds")
+    parser.add_argument('csv', nargs='*', help="*_clustered.csv batches, each replacing its kind's previous rows")
+    parser.add_argument('--graph', default='weighted_graph.graphml')
+    parser.add_argument('--events', help="file of JSON line events added on top, - for stdin")
+    parser.add_argument('--batch', type=int, default=1000, help="events per published version")
+    parser.add_argument('--recustomize', action='store_true',
+                        help="customize the hierarchy from scratch, restoring its pruned search graph")
+    args = parser.parse_args()
+
+    overlay = open_overlay(args.graph)
+
+    start = time.perf_counter()
+    for csv_path in args.csv:
+        overlay.load_csv(csv_path)
+    if args.events:
+        f = sys.stdin if args.events == '-' else open(args.events)
+        for pending in read_events(f, args.batch):
+            for kind, rows in pending.items():
+                lats, lngs, values = zip(*rows)
+                overlay.add(kind, lats, lngs, values)
+    if args.recustomize:
+        overlay.recustomize()
+    print(f"Published weight version {overlay.current.version} in {time.perf_counter() - start:.1f}s")
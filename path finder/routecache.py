@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.metrics import REGISTRY, count_lookup
+
+
+# Routes kept in memory, least recently used dropped first. Keys carry the
+# weight version, so a new version is never answered from an old one; the
+# TTL only bounds how long routes nobody asks for again are kept.
+CACHE_SIZE = 8192
+TTL = 24 * 3600
+
+SAVED_SECONDS = REGISTRY.counter('navguard_route_cache_saved_seconds_total',
+                                 "Search time the route cache saved, as the cached routes took to find")
+STORE_ERRORS = REGISTRY.counter('navguard_route_store_errors_total', "Route store reads and writes that failed",
+                                ('operation',))
+
+
+def route_key(graph, source, target, version, slot=None):
+    # graph tells graphs apart in a store shared by several of them, such
+    # as a snapshot's source stamp.
+    return json.dumps([graph, source, target, version, slot], sort_keys=True, separators=(',', ':'))
+
+
+class RouteStore:
+    # Routes in SQLite, shared by every worker routing on the same graph, as
+    # geocodes are. A connection per call keeps it safe across threads and
+    # processes.
+
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, route TEXT, seconds REAL, created REAL)")
+            db.execute("DELETE FROM routes WHERE created < ?", (time.time() - ttl,))
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def get(self, key):
+        db = self._connect()
+        try:
+            row = db.execute("SELECT route, seconds, created FROM routes WHERE key = ?", (key,)).fetchone()
+        finally:
+            db.close()
+        if row is None or time.time() - row[2] > self.ttl:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def put(self, key, route, seconds, created):
+        db = self._connect()
+        try:
+            with db:
+                db.execute("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?)",
+                           (key, json.dumps(route, separators=(',', ':')), seconds, created))
+        finally:
+            db.close()
+
+
+class RouteCache:
+    # Found routes by key, looked up in an in-memory LRU, then the store,
+    # and only then searched for. Identical requests arriving while a route
+    # is being searched for wait for that search rather than starting their
+    # own. A failed search (no route, say) is not remembered. The store is
+    # only a cache: when it fails the route is searched for, or kept in
+    # memory only, and the error counted and logged.
+
+    def __init__(self, store=None, size=CACHE_SIZE, ttl=TTL):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self._routes = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _remember(self, key, route, seconds, created):
+        with self._lock:
+            self._routes[key] = (route, seconds, created)
+            self._routes.move_to_end(key)
+            while len(self._routes) > self.size:
+                self._routes.popitem(last=False)
+
+    def _hit(self, result, seconds):
+        count_lookup('routes', result)
+        SAVED_SECONDS.inc(seconds)
+
+    def get(self, key, search):
+        # The route of key, calling search() for it when it is not cached,
+        # and where it came from: 'memory', 'store', 'coalesced' or
+        # 'search'.
+        with self._lock:
+            hit = self._routes.get(key)
+            if hit is not None and time.time() - hit[2] <= self.ttl:
+                self._routes.move_to_end(key)
+                self._hit('memory', hit[1])
+                return hit[0], 'memory'
+            future = self._pending.get(key)
+            leader = future is None
+            if leader:
+                future = self._pending[key] = Future()
+
+        if not leader:
+            route, seconds = future.result()
+            self._hit('coalesced', seconds)
+            return route, 'coalesced'
+
+        try:
+            hit = self._store('get', key)
+            if hit is not None:
+                route, seconds, created = hit
+                self._hit('store', seconds)
+                result = 'store'
+            else:
+                started = time.perf_counter()
+                route = search()
+                seconds, created = time.perf_counter() - started, time.time()
+                count_lookup('routes', 'search')
+                result = 'search'
+                self._store('put', key, route, seconds, created)
+            self._remember(key, route, seconds, created)
+            future.set_result((route, seconds))
+            return route, result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+
+    def _store(self, operation, *args):
+        if self.store is None:
+            return None
+        try:
+            return getattr(self.store, operation)(*args)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            STORE_ERRORS.inc(operation=operation)
+            print(f"Route store {operation} failed: {e}")
+            return None
+
+
+def make_route_cache(db_path=None):
+    # NAVGUARD_ROUTE_CACHE_DB names a SQLite file to share routes between
+    # workers through; without it each process keeps its own.
+    db_path = db_path or os.environ.get('NAVGUARD_ROUTE_CACHE_DB')
+    return RouteCache(RouteStore(db_path) if db_path else None)
@@ -0,0 +1,45 @@
+import numpy as np
+
+
+def encode_polyline(coords, precision=5):
+    # Google's encoded polyline format for a list of (lat, lng) pairs.
+    values = np.round(np.asarray(coords, dtype=np.float64).reshape(-1, 2) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel().tolist()
+    chunks = []
+    for value in deltas:
+        value = ~(value << 1) if value < 0 else value << 1
+        while value >= 0x20:
+            chunks.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chunks.append(chr(value + 63))
+    return ''.join(chunks)
+
+
+def route_coords(snapshot, edges):
+    # (lat, lng) points along the given edges, following each edge's
+    # geometry where it has one.
+    coords = []
+    for e in edges:
+        lo, hi = snapshot.geometry_offsets[e], snapshot.geometry_offsets[e + 1]
+        if lo == hi:
+            u, v = snapshot.edge_u[e], snapshot.edge_v[e]
+            points = [(float(snapshot.y[u]), float(snapshot.x[u])), (float(snapshot.y[v]), float(snapshot.x[v]))]
+        else:
+            points = list(zip(snapshot.geometry_y[lo:hi].tolist(), snapshot.geometry_x[lo:hi].tolist()))
+        coords.extend(points[1:] if coords else points)
+    return coords
+
+
+def route_summary(snapshot, engine, path):
+    # Everything a client needs to draw and describe a route of OSM ids.
+    if len(path) < 2:
+        coords = engine.coordinates(path)
+        return {'polyline': encode_polyline(coords), 'weight': 0.0, 'length': 0.0, 'nodes': len(path)}
+    arcs = engine.path_arcs(path)
+    edges = engine.arc_edge[arcs]
+    return {
+        'polyline': encode_polyline(route_coords(snapshot, edges.tolist())),
+        'weight': float(engine.weights[arcs].astype(np.float64).sum()),
+        'length': float(snapshot.edge_length[edges].sum()),
+        'nodes': len(path),
+    }
@@ -0,0 +1,248 @@
+import copy
+import math
+from heapq import heappop, heappush
+
+import networkx as nx
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra as csgraph_dijkstra
+
+
+EARTH_RADIUS_M = 6371009
+
+
+def great_circle(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(a) for a in (lat1, lng1, lat2, lng2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+class RoutingEngine:
+    # Frozen CSR view of the street graph. Node i of the arrays is
+    # node_ids[i] in the original graph, and parallel edges are collapsed to
+    # their cheapest weight, exactly like nx.shortest_path on a MultiDiGraph.
+
+    def __init__(self, node_ids, x, y, indptr, indices, weights, arc_edge=None):
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.arc_edge = None if arc_edge is None else np.asarray(arc_edge, dtype=np.int32)
+        self.index = {osmid: i for i, osmid in enumerate(self.node_ids.tolist())}
+        self._matrix = None
+        self._forward = None
+        self._backward = None
+        self._heuristic_scale = None
+        self.hierarchy = None
+
+    @classmethod
+    def from_graph(cls, G, weight='weight'):
+        node_ids = list(G.nodes)
+        index = {osmid: i for i, osmid in enumerate(node_ids)}
+        x = [G.nodes[n]['x'] for n in node_ids]
+        y = [G.nodes[n]['y'] for n in node_ids]
+
+        indptr = [0]
+        indices = []
+        weights = []
+        for u in node_ids:
+            for v, keydict in G._succ[u].items():
+                indices.append(index[v])
+                weights.append(min(float(data.get(weight, 1)) for data in keydict.values()))
+            indptr.append(len(indices))
+
+        return cls(node_ids, x, y, indptr, indices, weights)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        return cls(snapshot.node_ids, snapshot.x, snapshot.y, snapshot.indptr, snapshot.indices, snapshot.weights,
+                   snapshot.arc_edge)
+
+    def with_weights(self, weights, arc_edge=None):
+        # A new engine over the same nodes and arcs with other weights.
+        # Topology and the id index are shared; everything derived from the
+        # weights starts afresh, so queries on self are unaffected.
+        engine = copy.copy(self)
+        engine.weights = np.asarray(weights, dtype=np.float32)
+        if arc_edge is not None:
+            engine.arc_edge = np.asarray(arc_edge, dtype=np.int32)
+        engine._matrix = None
+        engine._forward = None
+        engine._heuristic_scale = None
+        engine._backward = None
+        engine.hierarchy = None
+        return engine
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        arrays = (self.node_ids, self.x, self.y, self.indptr, self.indices, self.weights)
+        return sum(a.nbytes for a in arrays)
+
+    def coordinates(self, path):
+        nodes = [self.index[n] for n in path]
+        return list(zip(self.y[nodes].tolist(), self.x[nodes].tolist()))
+
+    def matrix(self):
+        if self._matrix is None:
+            self._matrix = csr_matrix((self.weights.astype(np.float64), self.indices, self.indptr),
+                                      shape=(self.num_nodes, self.num_nodes))
+        return self._matrix
+
+    def _lists(self):
+        if self._forward is None:
+            self._forward = (self.indptr.tolist(), self.indices.tolist(), self.weights.astype(np.float64).tolist())
+        return self._forward
+
+    def _reverse_lists(self):
+        if self._backward is None:
+            sources = np.repeat(np.arange(self.num_nodes, dtype=np.int32), np.diff(self.indptr))
+            order = np.argsort(self.indices, kind='stable')
+            indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=self.num_nodes), out=indptr[1:])
+            self._backward = (indptr.tolist(), sources[order].tolist(), self.weights[order].astype(np.float64).tolist())
+        return self._backward
+
+    def heuristic_scale(self):
+        # The largest factor that keeps scale * great_circle a lower bound of
+        # the edge weights, so A* stays admissible whatever the weights mean.
+        if self._heuristic_scale is None:
+            sources = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+            distance = great_circle(self.y[sources], self.x[sources], self.y[self.indices], self.x[self.indices])
+            mask = distance > 0
+            if mask.any():
+                scale = float(np.min(self.weights[mask] / distance[mask])) * (1 - 1e-6)
+            else:
+                scale = 0.0
+            self._heuristic_scale = max(scale, 0.0)
+        return self._heuristic_scale
+
+    def shortest_path(self, source, target, method='dijkstra'):
+        if source not in self.index:
+            raise nx.NodeNotFound(f"Source {source} is not in G")
+        if target not in self.index:
+            raise nx.NodeNotFound(f"Target {target} is not in G")
+        s, t = self.index[source], self.index[target]
+
+        if method == 'dijkstra':
+            path = self._dijkstra(s, t)
+        elif method == 'bidirectional':
+            path = self._bidirectional(s, t)
+        elif method == 'astar':
+            path = self._astar(s, t)
+        elif method == 'ch':
+            if self.hierarchy is None:
+                raise ValueError("No contraction hierarchy loaded, build one with ch.py")
+            path = self.hierarchy.query(s, t)
+        else:
+            raise ValueError(f"Unknown routing method {method!r}")
+
+        if path is None:
+            raise nx.NetworkXNoPath(f"Node {target} not reachable from {source}")
+        return self.node_ids[path].tolist()
+
+    def path_arcs(self, path):
+        # CSR arc index of each step of a path of OSM ids.
+        indptr, indices, weights = self._lists()
+        arcs = []
+        for u, v in zip(path[:-1], path[1:]):
+            a, b = self.index[u], self.index[v]
+            arcs.append(min((e for e in range(indptr[a], indptr[a + 1]) if indices[e] == b), key=weights.__getitem__))
+        return arcs
+
+    def path_weight(self, path):
+        indptr, indices, weights = self._lists()
+        total = 0.0
+        for u, v in zip(path[:-1], path[1:]):
+            a, b = self.index[u], self.index[v]
+            total += min(weights[e] for e in range(indptr[a], indptr[a + 1]) if indices[e] == b)
+        return total
+
+    def _dijkstra(self, s, t):
+        dist, pred = csgraph_dijkstra(self.matrix(), indices=s, return_predecessors=True)
+        if not np.isfinite(dist[t]):
+            return None
+        return _unwind(pred, t, -9999)
+
+    def _bidirectional(self, s, t):
+        if s == t:
+            return [s]
+        n = self.num_nodes
+        graphs = (self._lists(), self._reverse_lists())
+        done = ([False] * n, [False] * n)
+        seen = ([math.inf] * n, [math.inf] * n)
+        preds = ([-1] * n, [-1] * n)
+        seen[0][s] = 0.0
+        seen[1][t] = 0.0
+        fringes = ([(0.0, s)], [(0.0, t)])
+        best = math.inf
+        meet = -1
+        while fringes[0] and fringes[1]:
+            if fringes[0][0][0] + fringes[1][0][0] >= best:
+                break
+            direction = 0 if fringes[0][0][0] <= fringes[1][0][0] else 1
+            fringe = fringes[direction]
+            d, v = heappop(fringe)
+            if done[direction][v]:
+                continue
+            done[direction][v] = True
+            indptr, indices, weights = graphs[direction]
+            dist, pred, other = seen[direction], preds[direction], seen[1 - direction]
+            for e in range(indptr[v], indptr[v + 1]):
+                u = indices[e]
+                vu_dist = d + weights[e]
+                if vu_dist < dist[u]:
+                    dist[u] = vu_dist
+                    pred[u] = v
+                    heappush(fringe, (vu_dist, u))
+                    if vu_dist + other[u] < best:
+                        best = vu_dist + other[u]
+                        meet = u
+        if meet == -1:
+            return None
+        forward = _unwind(preds[0], meet)
+        backward = _unwind(preds[1], meet)
+        return forward + backward[-2::-1]
+
+    def _astar(self, s, t):
+        indptr, indices, weights = self._lists()
+        h = (self.heuristic_scale() * great_circle(self.y, self.x, self.y[t], self.x[t])).tolist()
+        n = self.num_nodes
+        closed = [False] * n
+        seen = [math.inf] * n
+        pred = [-1] * n
+        seen[s] = 0.0
+        fringe = [(h[s], 0.0, s)]
+        while fringe:
+            _, d, v = heappop(fringe)
+            if closed[v]:
+                continue
+            if v == t:
+                return _unwind(pred, t)
+            closed[v] = True
+            for e in range(indptr[v], indptr[v + 1]):
+                u = indices[e]
+                vu_dist = d + weights[e]
+                if vu_dist < seen[u]:
+                    seen[u] = vu_dist
+                    pred[u] = v
+                    heappush(fringe, (vu_dist + h[u], vu_dist, u))
+        return None
+
+
+def _unwind(pred, node, stop=-1):
+    path = []
+    while node != stop:
+        path.append(node)
+        node = pred[node]
+    path.reverse()
+    return path
@@ -0,0 +1,235 @@
+import ast
+import fcntl
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+
+SNAPSHOT_VERSION = 3
+# Seconds a replaced snapshot is kept for readers still loading it.
+KEEP_SECONDS = 60
+
+ARRAYS = {
+    'node_ids': np.int64,
+    'x': np.float64,
+    'y': np.float64,
+    'edge_u': np.int32,
+    'edge_v': np.int32,
+    'edge_key': np.int64,
+    'edge_length': np.float64,
+    'edge_weight': np.float32,
+    'edge_name': np.int32,
+    'geometry_offsets': np.int64,
+    'geometry_x': np.float64,
+    'geometry_y': np.float64,
+    'indptr': np.int64,
+    'indices': np.int32,
+    'weights': np.float32,
+    'arc_edge': np.int32,
+}
+
+
+def snapshot_path(graphml_path):
+    base = graphml_path[:-len('.graphml')] if graphml_path.endswith('.graphml') else graphml_path
+    return base + '.snapshot'
+
+
+def edge_name(data):
+    # GraphML stores simplified edges' name lists as their repr; the first
+    # name is the one the edge is labelled with.
+    name = data.get('name')
+    if isinstance(name, str) and name.startswith('['):
+        try:
+            name = ast.literal_eval(name)
+        except (ValueError, SyntaxError):
+            pass
+    if isinstance(name, (list, tuple)):
+        name = name[0] if name else None
+    return str(name) if name else None
+
+
+def publish_dir(path, write):
+    # Calls write(directory) on a new directory of its own, then points
+    # path, a symlink, at it: the link is swapped in one rename, so readers
+    # always find a whole directory. Writers take turns on a lock file, so
+    # concurrent ones never remove each other's work. Directories replaced
+    # more than KEEP_SECONDS ago are removed; until then readers that
+    # resolved path earlier can still load them.
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        directory = f'{path}.{time.time_ns()}-{os.getpid()}'
+        os.makedirs(directory)
+        try:
+            write(directory)
+            link = directory + '.link'
+            os.symlink(os.path.basename(directory), link)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        if os.path.isdir(path) and not os.path.islink(path):
+            # Written before saves were published through a symlink.
+            shutil.rmtree(path, ignore_errors=True)
+        previous = os.path.realpath(path) if os.path.islink(path) else None
+        os.replace(link, path)
+        # A directory's mtime is when it was replaced.
+        if previous is not None and os.path.isdir(previous):
+            os.utime(previous)
+        parent, prefix = os.path.dirname(path) or '.', os.path.basename(path) + '.'
+        for name in os.listdir(parent):
+            old = os.path.join(parent, name)
+            if name.startswith(prefix) and name[len(prefix):].split('-')[0].isdigit() and name != os.path.basename(directory) \
+                    and os.path.isdir(old) and not os.path.islink(old) and time.time() - os.path.getmtime(old) > KEEP_SECONDS:
+                shutil.rmtree(old, ignore_errors=True)
+
+
+def source_stamp(graphml_path):
+    stat = os.stat(graphml_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class GraphSnapshot:
+    # The street graph as flat arrays in a directory of .npy files, one per
+    # entry of ARRAYS. Edges keep every parallel (u, v, key) edge of the
+    # MultiDiGraph with its length, weight and geometry: the points of edge
+    # i are geometry_x/y[geometry_offsets[i]:geometry_offsets[i + 1]], empty
+    # for straight edges. edge_name indexes the names list, -1 for unnamed
+    # edges. indptr/indices/weights are the collapsed CSR graph the
+    # RoutingEngine runs on, and arc_edge the edge each CSR arc stands for.
+
+    def __init__(self, arrays, names=(), meta=None):
+        for name, dtype in ARRAYS.items():
+            setattr(self, name, np.asarray(arrays[name], dtype=dtype))
+        self.names = list(names)
+        self.meta = meta or {}
+
+    @classmethod
+    def from_graph(cls, G, weight='weight'):
+        node_ids = list(G.nodes)
+        index = {osmid: i for i, osmid in enumerate(node_ids)}
+
+        edge_u, edge_v, edge_key, edge_length, edge_weight, edge_names = [], [], [], [], [], []
+        names = {}
+        geometry_offsets = [0]
+        geometry_x, geometry_y = [], []
+        indptr, indices, weights, arc_edge = [0], [], [], []
+        for u in node_ids:
+            for v, keydict in G._succ[u].items():
+                for key, data in keydict.items():
+                    edge_u.append(index[u])
+                    edge_v.append(index[v])
+                    edge_key.append(key)
+                    edge_length.append(float(data.get('length', 0)))
+                    edge_weight.append(float(data.get(weight, 1)))
+                    name = edge_name(data)
+                    edge_names.append(-1 if name is None else names.setdefault(name, len(names)))
+                    geometry = data.get('geometry')
+                    if geometry is not None:
+                        xs, ys = geometry.xy
+                        geometry_x.extend(xs)
+                        geometry_y.extend(ys)
+                    geometry_offsets.append(len(geometry_x))
+                first = len(edge_u) - len(keydict)
+                cheapest = min(range(len(keydict)), key=lambda k: edge_weight[first + k])
+                indices.append(index[v])
+                weights.append(edge_weight[first + cheapest])
+                arc_edge.append(first + cheapest)
+            indptr.append(len(indices))
+
+        arrays = {
+            'node_ids': node_ids,
+            'x': [G.nodes[n]['x'] for n in node_ids],
+            'y': [G.nodes[n]['y'] for n in node_ids],
+            'edge_u': edge_u,
+            'edge_v': edge_v,
+            'edge_key': edge_key,
+            'edge_length': edge_length,
+            'edge_weight': edge_weight,
+            'edge_name': edge_names,
+            'geometry_offsets': geometry_offsets,
+            'geometry_x': geometry_x,
+            'geometry_y': geometry_y,
+            'indptr': indptr,
+            'indices': indices,
+            'weights': weights,
+            'arc_edge': arc_edge,
+        }
+        return cls(arrays, list(names), {'crs': G.graph.get('crs')})
+
+    @property
+    def num_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def num_edges(self):
+        return len(self.edge_u)
+
+    def edge_coords(self, i):
+        lo, hi = self.geometry_offsets[i], self.geometry_offsets[i + 1]
+        if lo == hi:
+            u, v = self.edge_u[i], self.edge_v[i]
+            return [(self.y[u], self.x[u]), (self.y[v], self.x[v])]
+        return list(zip(self.geometry_y[lo:hi].tolist(), self.geometry_x[lo:hi].tolist()))
+
+    def save(self, path):
+        # Published with publish_dir, so a worker starting meanwhile never
+        # maps a half-written snapshot.
+        def write(directory):
+            for name in ARRAYS:
+                np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+            with open(os.path.join(directory, 'names.json'), 'w') as f:
+                json.dump(self.names, f)
+            with open(os.path.join(directory, 'meta.json'), 'w') as f:
+                json.dump(dict(self.meta, version=SNAPSHOT_VERSION), f)
+
+        publish_dir(path, write)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        # Every file from the directory path points at now, even if a new
+        # snapshot is published meanwhile.
+        path = os.path.realpath(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"{path} was written by an incompatible version of snapshot.py")
+        mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mode) for name in ARRAYS}
+        with open(os.path.join(path, 'names.json')) as f:
+            names = json.load(f)
+        return cls(arrays, names, meta)
+
+
+def build_snapshot(graphml_path, weight='weight'):
+    import osmnx as ox
+
+    G = ox.load_graphml(filepath=graphml_path)
+    snapshot = GraphSnapshot.from_graph(G, weight=weight)
+    snapshot.meta['source'] = source_stamp(graphml_path)
+    snapshot.save(snapshot_path(graphml_path))
+    return snapshot
+
+
+def load_graph(graphml_path, weight='weight'):
+    # Maps the snapshot next to graphml_path, converting the GraphML first
+    # if the snapshot is missing, outdated or from an older version.
+    path = snapshot_path(graphml_path)
+    try:
+        snapshot = GraphSnapshot.load(path)
+        if os.path.exists(graphml_path) and snapshot.meta.get('source') != source_stamp(graphml_path):
+            raise ValueError(f"{path} is older than {graphml_path}")
+        return snapshot
+    except (OSError, ValueError) as e:
+        print(f"Building graph snapshot: {e}")
+    build_snapshot(graphml_path, weight=weight)
+    return GraphSnapshot.load(path)
+
+
+if __name__ == '__main__':
+    graphml_path = sys.argv[1] if len(sys.argv) > 1 else 'weighted_graph.graphml'
+    start = time.perf_counter()
+    snapshot = build_snapshot(graphml_path)
+    print(f"Wrote {snapshot.num_nodes} nodes and {snapshot.num_edges} edges to {snapshot_path(graphml_path)} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,199 @@
+import os
+import pickle
+import sys
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+SPATIAL_VERSION = 1
+EARTH_RADIUS_M = 6371009
+# Street segments are cut into pieces of at most this many metres, so the
+# midpoint tree only needs a handful of candidates per query point.
+MAX_PIECE_M = 50.0
+CANDIDATES = 8
+
+
+def spatial_path(graphml_path):
+    base = graphml_path[:-len('.graphml')] if graphml_path.endswith('.graphml') else graphml_path
+    return base + '.spatial.pkl'
+
+
+def edge_points(snapshot):
+    # Flattened polyline points of every edge: its geometry when it has one,
+    # otherwise its two end nodes. Returns the points and per-edge offsets.
+    n_geometry = np.diff(snapshot.geometry_offsets)
+    straight = n_geometry == 0
+    counts = np.where(straight, 2, n_geometry)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    xs = np.empty(offsets[-1])
+    ys = np.empty(offsets[-1])
+    geometry_edge = np.repeat(np.arange(len(counts)), n_geometry)
+    positions = offsets[geometry_edge] + np.arange(len(geometry_edge)) - snapshot.geometry_offsets[geometry_edge]
+    xs[positions] = snapshot.geometry_x
+    ys[positions] = snapshot.geometry_y
+    edges = np.flatnonzero(straight)
+    xs[offsets[edges]] = snapshot.x[snapshot.edge_u[edges]]
+    ys[offsets[edges]] = snapshot.y[snapshot.edge_u[edges]]
+    xs[offsets[edges] + 1] = snapshot.x[snapshot.edge_v[edges]]
+    ys[offsets[edges] + 1] = snapshot.y[snapshot.edge_v[edges]]
+    return xs, ys, offsets
+
+
+class SpatialIndex:
+    # KD-trees over graph nodes and street segments in a local equirectangular
+    # projection around the graph's mean latitude, which is accurate to well
+    # under a metre across a city. Segments are indexed by their midpoints;
+    # a query takes the nearest CANDIDATES midpoints, measures the exact
+    # distance to those segments and only asks for more candidates when a
+    # closer segment could still hide further out.
+
+    def __init__(self, lat0, node_tree, edge_tree, segments, segment_edge, half_length, source=None):
+        self.lat0 = lat0
+        self.node_tree = node_tree
+        self.edge_tree = edge_tree
+        self.segments = segments
+        self.segment_edge = segment_edge
+        self.half_length = half_length
+        self.source = source
+        self.snapshot = None
+
+    def project(self, lng, lat):
+        lng = np.radians(np.asarray(lng, dtype=np.float64))
+        lat = np.radians(np.asarray(lat, dtype=np.float64))
+        return np.stack([EARTH_RADIUS_M * np.cos(np.radians(self.lat0)) * lng, EARTH_RADIUS_M * lat], axis=-1)
+
+    @classmethod
+    def build(cls, snapshot):
+        index = cls(float(np.mean(snapshot.y)) if snapshot.num_nodes else 0.0, None, None, None, None, 0.0,
+                    snapshot.meta.get('source'))
+        index.node_tree = cKDTree(index.project(snapshot.x, snapshot.y))
+
+        xs, ys, offsets = edge_points(snapshot)
+        points = index.project(xs, ys)
+        last = np.zeros(len(xs), dtype=bool)
+        last[offsets[1:] - 1] = True
+        starts = np.flatnonzero(~last)
+        point_edge = np.repeat(np.arange(snapshot.num_edges), np.diff(offsets))
+
+        a, b = points[starts], points[starts + 1]
+        pieces = np.maximum(1, np.ceil(np.hypot(*(b - a).T) / MAX_PIECE_M)).astype(np.int64)
+        owner = np.repeat(np.arange(len(starts)), pieces)
+        step = np.arange(len(owner)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = (step / pieces[owner])[:, None]
+        t1 = ((step + 1) / pieces[owner])[:, None]
+        seg_a = a[owner] + t0 * (b[owner] - a[owner])
+        seg_b = a[owner] + t1 * (b[owner] - a[owner])
+
+        index.segments = np.hstack([seg_a, seg_b])
+        index.segment_edge = point_edge[starts][owner].astype(np.int32)
+        index.half_length = float(np.max(np.hypot(*(seg_b - seg_a).T)) / 2) if len(owner) else 0.0
+        index.edge_tree = cKDTree((seg_a + seg_b) / 2)
+        index.snapshot = snapshot
+        return index
+
+    def save(self, path):
+        snapshot, self.snapshot = self.snapshot, None
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump((SPATIAL_VERSION, self), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        finally:
+            self.snapshot = snapshot
+
+    @classmethod
+    def load(cls, path, snapshot):
+        with open(path, 'rb') as f:
+            version, index = pickle.load(f)
+        if version != SPATIAL_VERSION:
+            raise ValueError(f"{path} was written by an incompatible version of spatial.py")
+        if index.source != snapshot.meta.get('source'):
+            raise ValueError(f"{path} was built for a different graph")
+        index.snapshot = snapshot
+        return index
+
+    def nearest_nodes(self, X, Y, return_dist=False):
+        # Same call shape as ox.distance.nearest_nodes: X is longitude, Y is
+        # latitude, scalars in give scalars out. Distances are in metres.
+        scalar = np.ndim(X) == 0
+        dist, nodes = self.node_tree.query(self.project(np.atleast_1d(X), np.atleast_1d(Y)))
+        ids = self.snapshot.node_ids[nodes]
+        if scalar:
+            ids, dist = int(ids[0]), float(dist[0])
+        return (ids, dist) if return_dist else ids
+
+    def nearest_edge_index(self, X, Y):
+        # Position of the nearest edge in the snapshot's edge arrays, and
+        # the distance to it in metres.
+        points = self.project(np.atleast_1d(X), np.atleast_1d(Y))
+        segment = np.zeros(len(points), dtype=np.int64)
+        best_dist = np.full(len(points), np.inf)
+        todo = np.arange(len(points))
+        k = CANDIDATES
+        while len(todo):
+            # A segment whose midpoint lies beyond the k-th candidate can
+            # still be closer by up to half its length; such points are
+            # queried again with more candidates.
+            k = min(k, len(self.segment_edge))
+            mid_dist, candidates = self.edge_tree.query(points[todo], k=k)
+            mid_dist = mid_dist.reshape(len(todo), k)
+            candidates = candidates.reshape(len(todo), k)
+            dist = _segment_distance(points[todo, None, :], self.segments[candidates])
+            best = np.argmin(dist, axis=1)
+            rows = np.arange(len(todo))
+            segment[todo] = candidates[rows, best]
+            best_dist[todo] = dist[rows, best]
+            if k == len(self.segment_edge):
+                break
+            todo = todo[best_dist[todo] > mid_dist[:, -1] - self.half_length]
+            k *= 4
+        return self.segment_edge[segment], best_dist
+
+    def nearest_edges(self, X, Y, return_dist=False):
+        # Same call shape as ox.distance.nearest_edges, returning (u, v, key)
+        # rows of OSM ids, or a single tuple for scalar input.
+        scalar = np.ndim(X) == 0
+        edges, dist = self.nearest_edge_index(X, Y)
+        snapshot = self.snapshot
+        ids = np.stack([snapshot.node_ids[snapshot.edge_u[edges]], snapshot.node_ids[snapshot.edge_v[edges]],
+                        snapshot.edge_key[edges]], axis=-1)
+        if scalar:
+            ids, dist = tuple(int(i) for i in ids[0]), float(dist[0])
+        return (ids, dist) if return_dist else ids
+
+
+def _segment_distance(p, segments):
+    a, b = segments[..., :2], segments[..., 2:]
+    ab = b - a
+    length2 = np.sum(ab * ab, axis=-1)
+    t = np.clip(np.sum((p - a) * ab, axis=-1) / np.where(length2 > 0, length2, 1), 0, 1)
+    closest = a + t[..., None] * ab
+    return np.hypot(*np.moveaxis(p - closest, -1, 0))
+
+
+def load_index(graphml_path, snapshot):
+    # The index cached next to graphml_path, rebuilt when it is missing or
+    # belongs to another version of the graph.
+    path = spatial_path(graphml_path)
+    try:
+        return SpatialIndex.load(path, snapshot)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError) as e:
+        print(f"Building spatial index: {e}")
+    index = SpatialIndex.build(snapshot)
+    index.save(path)
+    return index
+
+
+if __name__ == '__main__':
+    from snapshot import load_graph
+
+    graphml_path = sys.argv[1] if len(sys.argv) > 1 else 'weighted_graph.graphml'
+    snapshot = load_graph(graphml_path)
+    start = time.perf_counter()
+    index = SpatialIndex.build(snapshot)
+    index.save(spatial_path(graphml_path))
+    print(f"Indexed {snapshot.num_nodes} nodes and {len(index.segment_edge)} segments in {time.perf_counter() - start:.1f}s")
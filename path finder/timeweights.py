@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from clustering import CHUNK_ROWS, HOUR_COLUMN
+from snapshot import publish_dir
+
+
+TIMEWEIGHTS_VERSION = 2
+# Hours of the week; slot = weekday * 24 + hour, Monday being 0.
+SLOTS = 7 * 24
+# Engines kept for the slots asked for last.
+ENGINES = 8
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+def timeweights_path(graphml_path):
+    base = graphml_path[:-len('.graphml')] if graphml_path.endswith('.graphml') else graphml_path
+    return base + '.slots'
+
+
+def slot_of(when):
+    # The slot of a departure time, a string pd.Timestamp reads, 'now'
+    # included. Raises ValueError for anything else: pd.Timestamp would
+    # read a number as nanoseconds since the epoch.
+    if not isinstance(when, str):
+        raise ValueError(f"Not a departure time: {when!r}")
+    when = pd.Timestamp(when)
+    if when is pd.NaT:
+        raise ValueError("No departure time given")
+    return when.weekday() * 24 + when.hour
+
+
+def slot_name(slot):
+    return f'{DAY_NAMES[slot // 24]} {slot % 24:02d}:00'
+
+
+def slot_volumes(csv_path, chunk_rows=CHUNK_ROWS):
+    # The mean hourly volume of each traffic counter location in each slot,
+    # read a chunk at a time, as lat, lng and an (n, SLOTS) array, NaN where
+    # a location was never counted in a slot.
+    def wanted(column):
+        return column in ('latitude', 'longitude', 'Date') or HOUR_COLUMN.match(column)
+
+    sums, counts = [], []
+    with pd.read_csv(csv_path, usecols=wanted, chunksize=chunk_rows, low_memory=False) as reader:
+        for chunk in reader:
+            chunk = chunk.dropna(subset=['latitude', 'longitude', 'Date'])
+            hours = [c for c in chunk.columns if HOUR_COLUMN.match(c)]
+            groups = chunk[hours].groupby([chunk['latitude'], chunk['longitude'],
+                                           pd.to_datetime(chunk['Date']).dt.weekday.rename('weekday')])
+            sums.append(groups.sum())
+            counts.append(groups.count())
+    levels = ['latitude', 'longitude', 'weekday']
+    total = pd.concat(sums).groupby(level=levels).sum()
+    count = pd.concat(counts).groupby(level=levels).sum()
+    means = (total / count.where(count > 0)).unstack('weekday').reindex(
+        columns=pd.MultiIndex.from_product([total.columns, range(7)]))
+    # Columns come hour-major; slots are weekday-major.
+    volumes = means.to_numpy(dtype=np.float64).reshape(len(means), 24, 7).transpose(0, 2, 1).reshape(len(means), SLOTS)
+    lat = means.index.get_level_values('latitude').to_numpy(dtype=np.float64)
+    lng = means.index.get_level_values('longitude').to_numpy(dtype=np.float64)
+    return lat, lng, volumes
+
+
+class TimeWeights:
+    # The traffic term of weights.risk_weights() for every hour of the week:
+    # slots[slot] holds the counters' volume in that slot on each of edges,
+    # the edges they snap to. An engine for a slot combines it with the
+    # other kinds of whichever weight version it routes on, so publishing
+    # new feeds needs no rebuild; the clustered traffic averages are
+    # replaced, and edges only they reach carry no traffic in any slot. The
+    # arrays are memory-mapped: a slot is read from disk when first routed
+    # on, and processes routing on the same file share its pages.
+
+    def __init__(self, edges, slots, meta=None, overlay=None):
+        self.edges = edges
+        self.slots = slots
+        self.meta = meta or {}
+        self.overlay = overlay
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(cls, overlay, csv_path):
+        lat, lng, volumes = slot_volumes(csv_path)
+        known = ~np.isnan(volumes).all(axis=1)
+        lat, lng, volumes = lat[known], lng[known], volumes[known]
+        if len(volumes):
+            low, high = np.nanmin(volumes), np.nanmax(volumes)
+            volumes = (volumes - low) / ((high - low) or 1) * 100
+        # An edge takes the busiest counter snapped to it, slot by slot; a
+        # slot none of them counted takes the edge's mean over the others.
+        edges, _ = overlay.spatial_index.nearest_edge_index(lng, lat)
+        unique, inverse = np.unique(edges, return_inverse=True)
+        top = np.full((len(unique), SLOTS), -np.inf)
+        np.fmax.at(top, inverse, volumes)
+        top[np.isinf(top)] = np.nan
+        top = np.where(np.isnan(top), np.nanmean(top, axis=1, keepdims=True), top) if len(top) else top
+        meta = {'source': overlay.snapshot.meta.get('source'), 'counters': int(len(lat)), 'edges': int(len(unique))}
+        return cls(unique, np.ascontiguousarray(top.T, dtype=np.float32), meta, overlay)
+
+    def save(self, path):
+        # Published with snapshot.publish_dir, as snapshots are.
+        def write(directory):
+            np.save(os.path.join(directory, 'edges.npy'), self.edges)
+            np.save(os.path.join(directory, 'slots.npy'), self.slots)
+            with open(os.path.join(directory, 'meta.json'), 'w') as f:
+                json.dump(dict(self.meta, version=TIMEWEIGHTS_VERSION), f)
+
+        publish_dir(path, write)
+
+    @classmethod
+    def load(cls, path, overlay):
+        path = os.path.realpath(path)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != TIMEWEIGHTS_VERSION:
+            raise ValueError(f"{path} was written by an incompatible version of timeweights.py")
+        if meta.get('source') != overlay.snapshot.meta.get('source'):
+            raise ValueError(f"{path} belongs to another version of the graph")
+        return cls(np.load(os.path.join(path, 'edges.npy'), mmap_mode='r'),
+                   np.load(os.path.join(path, 'slots.npy'), mmap_mode='r'), meta, overlay)
+
+    def weights(self, state, slot):
+        # The arc weights of state's tables with the traffic of slot in
+        # place of the clustered traffic. Edges only the clustered traffic
+        # reaches stay in the table at 0, so they weigh their length.
+        static = np.fromiter(state.tables.get('traffic', {}).keys(), dtype=np.int64)
+        static = static[~np.isin(static, self.edges)]
+        traffic = (np.concatenate([self.edges, static]),
+                   np.concatenate([self.slots[slot], np.zeros(len(static), dtype=np.float32)]))
+        return self.overlay.arc_weights(self.overlay.edge_weights(dict(state.tables, traffic=traffic)))
+
+    def engine(self, state, slot):
+        # An engine routing on state's weights in slot, kept while it is
+        # among the last ENGINES asked for.
+        key = (state.version, slot)
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = state.engine.with_weights(self.weights(state, slot))
+                self._engines[key] = engine
+                while len(self._engines) > ENGINES:
+                    self._engines.popitem(last=False)
+            self._engines.move_to_end(key)
+            return engine
+
+
+def load_timeweights(graphml_path, overlay):
+    # The slots built for graphml_path, or None when there are none; they
+    # need the raw traffic feed, so they are never built here.
+    path = timeweights_path(graphml_path)
+    try:
+        return TimeWeights.load(path, overlay)
+    except (OSError, ValueError) as e:
+        print(f"Routing without time-dependent weights: {e}")
+    return None
+
+
+if __name__ == '__main__':
+    from overlay import open_overlay
+
+    parser = argparse.ArgumentParser(description="Build hour-of-week edge weights from the hourly traffic counts")
+    parser.add_argument('csv', nargs='?', default=os.path.join('..', 'webapp', 'traffic.csv'), help="raw traffic feed")
+    parser.add_argument('--graph', default='weighted_graph.graphml')
+    args = parser.parse_args()
+
+    overlay = open_overlay(args.graph)
+    start = time.perf_counter()
+    weights = TimeWeights.build(overlay, args.csv)
+    weights.save(timeweights_path(args.graph))
+    print(f"Wrote {SLOTS} slots of {len(weights.edges)} edges from {weights.meta['counters']} counters "
+          f"({weights.slots.nbytes / 2 ** 20:.1f} MB) to {timeweights_path(args.graph)} "
+          f"in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+
+# Per kind of hazard (see overlay.KINDS): the share of its length an edge
+# weighs extra under a hazard at full scale, and the value that is full
+# scale. The clustered traffic and collision values run from 0 to 100; a
+# construction site counts in full whatever its award.
+RISK = {
+    'traffic': (1.0, 100.0),
+    'construction': (0.5, None),
+    'collision': (2.0, 100.0),
+}
+# Edges shorter than this many metres weigh as if they were this long, so
+# a hazard on them still counts.
+MIN_LENGTH = 1.0
+
+
+def edge_values(edges, values):
+    # One value per edge hit, the largest of the points snapped to it: a
+    # milder point never overwrites a worse one on the same edge. Points
+    # without a value are skipped.
+    edges = np.asarray(edges, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    unique, inverse = np.unique(edges[known], return_inverse=True)
+    top = np.full(len(unique), -np.inf)
+    np.maximum.at(top, inverse, values[known])
+    return unique, top
+
+
+def risk_weights(lengths, tables):
+    # The weight of every edge from its length and {kind: (edges, values)},
+    # each edge at most once per kind:
+    #     length * (1 + sum over kinds of share * min(value / full scale, 1))
+    # Edges without hazards weigh their length.
+    factor = np.ones(len(lengths))
+    for kind, (share, full) in RISK.items():
+        edges, values = tables.get(kind, ((), ()))
+        edges = np.asarray(edges, dtype=np.int64)
+        scaled = np.ones(len(edges)) if full is None else np.clip(np.asarray(values, dtype=np.float64) / full, 0, 1)
+        factor[edges] += share * scaled
+    return np.maximum(lengths, MIN_LENGTH) * factor
+
+
+def read_points(csv_paths):
+    # {kind: (lats, lngs, values)} from *_clustered.csv files, the kind
+    # told by each file's name.
+    from overlay import KINDS, kind_of
+
+    points = {}
+    for csv_path in csv_paths:
+        kind = kind_of(csv_path)
+        column = KINDS[kind][1]
+        df = pd.read_csv(csv_path).dropna(subset=['latitude', 'longitude'])
+        values = np.ones(len(df)) if column is None else df[column].to_numpy(dtype=np.float64)
+        points[kind] = (df['latitude'].to_numpy(dtype=np.float64), df['longitude'].to_numpy(dtype=np.float64), values)
+    return points
+
+
+def snap_points(spatial_index, points):
+    # {kind: {edge: value}} for {kind: (lats, lngs, values)}, the points of
+    # every kind snapped to their nearest edges in a single call.
+    kinds = list(points)
+    lats = np.concatenate([points[kind][0] for kind in kinds]) if kinds else np.empty(0)
+    lngs = np.concatenate([points[kind][1] for kind in kinds]) if kinds else np.empty(0)
+    edges = spatial_index.nearest_edge_index(lngs, lats)[0] if len(lats) else np.empty(0, dtype=np.int64)
+    tables = {}
+    start = 0
+    for kind in kinds:
+        n = len(points[kind][0])
+        tables[kind] = dict(zip(*(a.tolist() for a in edge_values(edges[start:start + n], points[kind][2]))))
+        start += n
+    return tables
+
+
+def build(overlay, csv_paths):
+    # Publishes the weights of the clustered files as one new version of
+    # overlay; kinds without a file keep what they hold.
+    tables = snap_points(overlay.spatial_index, read_points(csv_paths))
+    return overlay.update(tables, replace=True)
+
+
+if __name__ == '__main__':
+    from overlay import KINDS, open_overlay
+
+    parser = argparse.ArgumentParser(description="Build the graph's edge weights from the clustered feeds and "
+                                                 "publish them for the path finder")
+    parser.add_argument('csv', nargs='*', default=[KINDS[kind][0] for kind in KINDS],
+                        help="*_clustered.csv files, by default all three next to the graph")
+    parser.add_argument('--graph', default='weighted_graph.graphml')
+    args = parser.parse_args()
+
+    overlay = open_overlay(args.graph)
+    start = time.perf_counter()
+    points = read_points(args.csv)
+    tables = snap_points(overlay.spatial_index, points)
+    snapped = time.perf_counter()
+    state = overlay.update(tables, replace=True)
+    print(f"Snapped {sum(len(p[0]) for p in points.values())} points to "
+          f"{len(set().union(*(t.keys() for t in tables.values())))} edges in {snapped - start:.2f}s")
+    print(f"Published weight version {state.version} in {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,13 @@
+# Entry point for a preforking WSGI server such as gunicorn with
+# preload_app (see gunicorn.conf.py at the top of the repository). This
+# module is imported once, in the master process: the graph snapshot,
+# spatial index, hierarchy and weights are loaded here, and every worker
+# forked from the master shares them copy-on-write instead of loading its
+# own.
+import time
+
+started = time.perf_counter()
+
+from app import app
+
+print(f"Path finder loaded in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The apps import their modules by name from their own directories, and
+# the shared ones from common/ at the top of the repository.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'path finder'))
@@ -0,0 +1,24 @@
+import pytest
+
+from common.geocoding import Gazetteer, _street_query, normalize_address
+
+
+@pytest.mark.parametrize('address, street', [
+    ("5th Avenue", '5 avenue'),
+    ("1st Street, New York", '1 street'),
+    ("350 5th Avenue", '5 avenue'),
+    ("350 Broadway", 'broadway'),
+    ("5th Avenue and 42nd Street", '5 avenue and 42 street'),
+    ("12 West 4th Street, NYC, 10012", 'west 4 street'),
+])
+def test_street_query(address, street):
+    assert _street_query(normalize_address(address)) == street
+
+
+def test_gazetteer_resolves_numbered_streets():
+    gazetteer = Gazetteer({'5 avenue': (40.75, -73.98), 'broadway': (40.71, -74.01)},
+                          {('42 street', '5 avenue'): (40.753, -73.981)})
+    assert gazetteer.geocode("350 5th Avenue, New York") == (40.75, -73.98)
+    assert gazetteer.geocode("5th Ave") == (40.75, -73.98)
+    assert gazetteer.geocode("5th Avenue & 42nd St") == (40.753, -73.981)
+    assert gazetteer.geocode("350 Broadway") == (40.71, -74.01)
@@ -0,0 +1,76 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from ch import ContractionHierarchy
+from routing import RoutingEngine
+
+
+def street_graph(nodes=60, edges=180, seed=0):
+    # A random MultiDiGraph laid out around Manhattan, with parallel edges,
+    # some one-way streets and a node no street reaches.
+    rng = np.random.default_rng(seed)
+    G = nx.MultiDiGraph()
+    for n in range(nodes):
+        G.add_node(1000 + n, x=-74.0 + rng.random() * 0.05, y=40.7 + rng.random() * 0.05)
+    for _ in range(edges):
+        u, v = (1000 + int(n) for n in rng.choice(nodes, 2, replace=False))
+        G.add_edge(u, v, weight=float(rng.uniform(10, 500)))
+        if rng.random() < 0.7:
+            G.add_edge(v, u, weight=float(rng.uniform(10, 500)))
+    G.add_node(1000 + nodes, x=-73.9, y=40.8)
+    return G
+
+
+def path_weight(G, path):
+    return sum(min(data['weight'] for data in G[u][v].values()) for u, v in zip(path[:-1], path[1:]))
+
+
+@pytest.fixture(scope='module')
+def graph():
+    G = street_graph()
+    engine = RoutingEngine.from_graph(G)
+    engine.hierarchy = ContractionHierarchy.build(engine)
+    return G, engine
+
+
+@pytest.mark.parametrize('method', ['dijkstra', 'bidirectional', 'astar', 'ch'])
+def test_shortest_path_matches_networkx(graph, method):
+    G, engine = graph
+    nodes = list(G.nodes)
+    for source, target in zip(nodes[::3], nodes[1::3] + nodes[:1]):
+        try:
+            expected = nx.shortest_path(G, source, target, weight='weight')
+        except nx.NetworkXNoPath:
+            with pytest.raises(nx.NetworkXNoPath):
+                engine.shortest_path(source, target, method=method)
+            continue
+        path = engine.shortest_path(source, target, method=method)
+        assert path[0] == source and path[-1] == target
+        assert path_weight(G, path) == pytest.approx(path_weight(G, expected), rel=1e-5)
+        assert engine.path_weight(path) == pytest.approx(path_weight(G, expected), rel=1e-5)
+
+
+def test_hierarchy_follows_new_weights(graph):
+    G, engine = graph
+    H = G.copy()
+    rng = np.random.default_rng(1)
+    for _, _, data in H.edges(data=True):
+        data['weight'] *= float(rng.uniform(0.5, 2.0))
+    reweighted = RoutingEngine.from_graph(H)
+    reweighted.hierarchy = ContractionHierarchy.build(engine)
+    reweighted.hierarchy.customize(reweighted)
+    nodes = list(H.nodes)
+    for source, target in zip(nodes[::2], nodes[1::2]):
+        if nx.has_path(H, source, target):
+            expected = nx.shortest_path(H, source, target, weight='weight')
+            path = reweighted.shortest_path(source, target, method='ch')
+            assert path_weight(H, path) == pytest.approx(path_weight(H, expected), rel=1e-5)
+
+
+def test_unknown_nodes_and_methods(graph):
+    _, engine = graph
+    with pytest.raises(nx.NodeNotFound):
+        engine.shortest_path(1, 1000)
+    with pytest.raises(ValueError):
+        engine.shortest_path(1000, 1001, method='teleport')
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.metrics import count_lookup, span
+
+
+CACHE_VERSION = 2
+CACHE_DIR = 'dashboard_cache'
+# Values kept in memory per data version; older ones are read back from
+# cache_dir when asked for again.
+MAX_VALUES = 32
+# Files kept in cache_dir per name, the least recently written removed
+# first.
+MAX_FILES = 64
+
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_size, stat.st_mtime_ns]
+
+
+def data_version(paths, content=False):
+    # Changes whenever one of the files does. By default only size and
+    # mtime are looked at; content=True hashes the bytes as well, for
+    # copies that keep their mtime.
+    digest = hashlib.sha1(json.dumps([CACHE_VERSION] + [file_stamp(p) for p in paths]).encode())
+    if content:
+        for path in paths:
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class Materialized:
+    # Values derived from a set of source files, computed once per data
+    # version. load(paths) reads the sources into whatever build(data, key)
+    # needs; both run again only when data_version() of the sources moves.
+    # Built values are kept in memory and as JSON under cache_dir, so a
+    # restarted or second process picks them up without recomputing.
+    # Builds are serialized: matplotlib's pyplot state is global, and a
+    # second request for the same value waits for the first one.
+
+    def __init__(self, paths, load, build, name, cache_dir=CACHE_DIR, content_hash=False):
+        self.paths = list(paths)
+        self.load = load
+        self.build = build
+        self.name = name
+        self.cache_dir = cache_dir
+        self.content_hash = content_hash
+        self.version = None
+        self._data = None
+        self._values = {}
+        self._lock = threading.RLock()
+
+    def current_version(self):
+        return data_version(self.paths, self.content_hash)
+
+    def data(self):
+        # The loaded sources, reloaded if the files changed since.
+        version = self.current_version()
+        with self._lock:
+            if version != self.version:
+                with span(f'load_{self.name}'):
+                    self._data = self.load(self.paths)
+                self._values = {}
+                self.version = version
+            return self._data
+
+    def snapshot(self):
+        # The loaded sources and the data version they were loaded at,
+        # taken together so a reload in between cannot mix them up.
+        with self._lock:
+            data = self.data()
+            return self.version, data
+
+    def _cache_path(self, version, key):
+        return os.path.join(self.cache_dir, f'{self.name}-{version}-{key}.json')
+
+    def get(self, key='', persist=True):
+        # persist=False keeps a built value in memory only, for keys
+        # requests can make up without bound.
+        version = self.current_version()
+        value = self._values.get((version, key))
+        if value is not None:
+            count_lookup(self.name, 'memory')
+            return value
+        with self._lock:
+            data = self.data()
+            version = self.version
+            value = self._values.get((version, key))
+            result = 'memory'
+            if value is None:
+                value, result = self._read(version, key), 'disk'
+            if value is None:
+                with span(f'build_{self.name}'):
+                    value, result = self.build(data, key), 'build'
+                if persist:
+                    self._write(version, key, value)
+            count_lookup(self.name, result)
+            self._values[(version, key)] = value
+            while len(self._values) > MAX_VALUES:
+                del self._values[next(iter(self._values))]
+            return value
+
+    def _read(self, version, key):
+        try:
+            with open(self._cache_path(version, key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, version, key, value):
+        path = self._cache_path(version, key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+        # Values of older data versions are never read again.
+        kept = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(self.name + '-') and name.endswith('.json'):
+                if name.startswith(f'{self.name}-{version}-'):
+                    kept.append(os.path.join(self.cache_dir, name))
+                else:
+                    os.remove(os.path.join(self.cache_dir, name))
+        if len(kept) > MAX_FILES:
+            kept.sort(key=lambda p: os.stat(p).st_mtime_ns)
+            for old in kept[:-MAX_FILES]:
+                os.remove(old)
@@ -0,0 +1,347 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import BytesIO
+
+import matplotlib
+import pandas as pd
+from matplotlib.figure import Figure
+
+from streaming import CollisionSummary, HourlyVolume
+from common.metrics import count_lookup, span
+
+
+# seaborn imports pyplot, which must not pick an interactive backend.
+matplotlib.use('Agg')
+
+# Rendered PNGs kept in memory, least recently used dropped first.
+CACHE_BYTES = 64 * 1024 * 1024
+
+CASUALTY_COLORS = ['lightcoral', 'lightskyblue', 'lightgreen', 'lightyellow', 'lightpink']
+# The construction columns the charts draw from.
+CONSTRUCTION_CHART_COLUMNS = ['boro', 'borough', 'consttype', 'award', 'data_as_of']
+
+
+# Each chart draws on its own Figure from the (collision, construction,
+# traffic) frames and must not modify them: in-process renders share them
+# between threads. The collisions may also be a CollisionSummary and the
+# traffic an HourlyVolume, as streaming.chart_data() loads them.
+
+def collision_summary(collisions):
+    return collisions if isinstance(collisions, CollisionSummary) else CollisionSummary().update(collisions)
+
+
+def hourly_volume(traffic):
+    return traffic if isinstance(traffic, HourlyVolume) else HourlyVolume().update(traffic)
+
+
+def chart_inputs(data):
+    # All the charts draw from: the collisions and traffic reduced to their
+    # aggregates and the construction columns the charts use. Small enough
+    # to send to a pool worker with every chart.
+    collisions, constructions, traffic = data
+    return collision_summary(collisions), constructions[CONSTRUCTION_CHART_COLUMNS], hourly_volume(traffic)
+
+
+def construction_types_by_borough(data):
+    construction_data = data[1]
+    construction_type_counts = construction_data.groupby(['borough', 'consttype']).size().unstack()
+    fig = Figure(figsize=(10, 10))
+    ax = fig.subplots()
+    construction_type_counts.plot(kind='bar', stacked=True, ax=ax)
+    ax.set_title('Number of Each Construction Type by Borough')
+    ax.set_xlabel('Borough')
+    ax.set_ylabel('Count')
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.legend(title='Construction Type')
+    return fig
+
+
+def construction_starts_per_month(data):
+    construction_data = data[1]
+    construction_counts = construction_data['data_as_of'].dt.to_period('M').value_counts().sort_index()
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    construction_counts.plot(kind='bar', ax=ax)
+    ax.set_title('Construction Starts Per Month')
+    ax.set_xlabel('Month')
+    ax.set_ylabel('Count')
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    return fig
+
+
+def casualties_by_borough(data):
+    borough_casualties = collision_summary(data[0]).by_borough('killed', unknown=None)
+    fig = Figure(figsize=(8, 8))
+    ax = fig.subplots()
+    ax.pie(borough_casualties, labels=borough_casualties.index, autopct='%1.1f%%', startangle=140, colors=CASUALTY_COLORS)
+    ax.set_title('Distribution of Casualties Due to Traffic Collision by Borough')
+    return fig
+
+
+def collision_wordcloud(data):
+    from wordcloud import WordCloud
+
+    # The words of each pair of factors, counted as often as the pair was
+    # reported, rather than the text of every collision joined.
+    wordcloud = WordCloud(width=800, height=400, background_color='white')
+    frequencies = {}
+    for text, count in collision_summary(data[0]).factors.items():
+        for word, n in wordcloud.process_text(text).items():
+            frequencies[word] = frequencies.get(word, 0) + n * count
+    wordcloud.generate_from_frequencies(frequencies)
+    fig = Figure(figsize=(10, 5))
+    ax = fig.subplots()
+    ax.imshow(wordcloud, interpolation='bilinear')
+    ax.set_title('Word Cloud of Contributing Factors in Collisions')
+    ax.axis('off')
+    return fig
+
+
+def traffic_volume_heatmap(data):
+    import seaborn as sns
+
+    pivot_table = hourly_volume(data[2]).by_weekday().set_axis([f'{i:02d}:00' for i in range(24)], axis=1)
+    pivot_table.index.name = 'DayOfWeek'
+    pivot_table.columns.name = 'Hour'
+    fig = Figure(figsize=(18, 5))
+    ax = fig.subplots()
+    sns.heatmap(pivot_table, cmap='Blues', annot=False, ax=ax)
+    ax.set_title('Traffic Volume Heatmap by Hour and Day of Week')
+    ax.set_ylabel('Day of Week')
+    ax.set_xlabel('Hour of Day')
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.tick_params(axis='y', labelrotation=0)
+    fig.tight_layout()
+    return fig
+
+
+def average_traffic_volume(data):
+    import seaborn as sns
+
+    average_volume_per_hour = hourly_volume(data[2]).by_hour()
+    hour_labels = [f'{i}:00' for i in range(24)]
+    average_volume_df = pd.DataFrame({'Hour': hour_labels, 'Average_volume': average_volume_per_hour.values})
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
+    sns.barplot(x='Hour', y='Average_volume', data=average_volume_df, ax=ax)
+    sns.lineplot(x='Hour', y='Average_volume', data=average_volume_df, sort=False, ax=ax)
+    ax.set_title('Average Traffic Volume per Hour of Day')
+    ax.set_xlabel('Hour of Day')
+    ax.set_ylabel('Average Volume')
+    for label in ax.get_xticklabels():
+        label.set_rotation(45)
+        label.set_horizontalalignment('right')
+    return fig
+
+
+def projects_per_borough(data):
+    borough_counts = data[1]['boro'].value_counts()
+    fig = Figure()
+    ax = fig.subplots()
+    borough_counts.plot(kind='bar', rot=45, color='skyblue', ax=ax)
+    ax.set_title('Number of Projects per Borough')
+    ax.set_xlabel('Borough')
+    ax.set_ylabel('Number of Projects')
+    return fig
+
+
+def project_types(data):
+    project_type_counts = data[1]['consttype'].value_counts()
+    fig = Figure()
+    ax = fig.subplots()
+    ax.pie(project_type_counts, labels=project_type_counts.index, autopct='%1.1f%%', startangle=90)
+    ax.axis('equal')
+    ax.set_title('Distribution of Project Types')
+    return fig
+
+
+def award_by_borough(data):
+    avg_award_by_borough = data[1].groupby('boro')['award'].mean()
+    normalized_avg_award = avg_award_by_borough / avg_award_by_borough.sum()
+    fig = Figure()
+    ax = fig.subplots()
+    normalized_avg_award.plot(kind='bar', color='skyblue', ax=ax)
+    ax.set_title('Normalized Average Award Amount by Borough')
+    ax.set_xlabel('Borough')
+    ax.set_ylabel('Normalized Average Award Amount')
+    return fig
+
+
+def collisions_per_borough(data):
+    borough_collisions = collision_summary(data[0]).by_borough('collisions').sort_values(ascending=False, kind='stable')
+    fig = Figure()
+    ax = fig.subplots()
+    ax.bar(borough_collisions.index, borough_collisions.values, color='blue')
+    ax.set_title('Number of Collisions per Borough in New York')
+    ax.set_xlabel('Borough')
+    ax.set_ylabel('Number of Collisions')
+    return fig
+
+
+def casualty_distribution(data):
+    borough_casualties = collision_summary(data[0]).by_borough('casualties')
+    fig = Figure()
+    ax = fig.subplots()
+    ax.pie(borough_casualties, labels=borough_casualties.index, autopct='%1.1f%%', startangle=140, colors=CASUALTY_COLORS)
+    ax.set_title('Distribution of Casualties by Borough')
+    return fig
+
+
+def traffic_heatmap(data):
+    import seaborn as sns
+
+    pivot_table = hourly_volume(data[2]).by_weekday_and_hour()
+    pivot_table.index.name = 'day_of_week'
+    pivot_table.columns.name = 'datetime'
+    fig = Figure(figsize=(15, 7))
+    ax = fig.subplots()
+    sns.heatmap(pivot_table, cmap='YlGnBu', ax=ax)
+    ax.set_title('Heatmap of Average Traffic Volume by Day and Hour')
+    ax.set_xlabel('Hour of the Day')
+    ax.set_ylabel('Day of the Week')
+    return fig
+
+
+CHARTS = {
+    'construction-types-by-borough': construction_types_by_borough,
+    'construction-starts-per-month': construction_starts_per_month,
+    'casualties-by-borough': casualties_by_borough,
+    'collision-wordcloud': collision_wordcloud,
+    'traffic-volume-heatmap': traffic_volume_heatmap,
+    'average-traffic-volume': average_traffic_volume,
+    'projects-per-borough': projects_per_borough,
+    'project-types': project_types,
+    'award-by-borough': award_by_borough,
+    'collisions-per-borough': collisions_per_borough,
+    'casualty-distribution': casualty_distribution,
+    'traffic-heatmap': traffic_heatmap,
+}
+
+
+def render(chart_id, data):
+    buf = BytesIO()
+    CHARTS[chart_id](data).savefig(buf, format='png')
+    return buf.getvalue()
+
+
+class ChartCache:
+    # Rendered bytes by key, such as chart PNGs by (chart id, data version)
+    # or map tiles, bounded by their total size. Lookups are counted under
+    # name.
+
+    def __init__(self, max_bytes=CACHE_BYTES, name='charts'):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            png = self._items.get(key)
+            if png is not None:
+                self._items.move_to_end(key)
+        count_lookup(self.name, 'hit' if png is not None else 'miss')
+        return png
+
+    def put(self, key, png):
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, old = self._items.popitem(last=False)
+                self.size -= len(old)
+
+
+class ChartService:
+    # Renders the dashboard charts of a Materialized source. With
+    # processes > 1 they are drawn in a pool of workers, so the charts of a
+    # page render side by side; otherwise in the requesting thread. A chart
+    # already being rendered is waited for rather than rendered twice.
+    # Charts are drawn from chart_inputs() of the source's data, derived
+    # once per data version and keyed by the version they came from.
+
+    def __init__(self, source, processes=None, cache=None):
+        self.source = source
+        self.processes = processes or os.cpu_count() or 1
+        self.cache = cache or ChartCache()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._inputs = (None, None)
+        self._inputs_lock = threading.Lock()
+        self._pool = None
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.processes)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def inputs(self):
+        # The data version of the source and its chart inputs.
+        with self._inputs_lock:
+            version, data = self.source.snapshot()
+            if self._inputs[0] != version:
+                with span('chart_inputs'):
+                    self._inputs = (version, chart_inputs(data))
+            return self._inputs
+
+    def png(self, chart_id):
+        # The chart's PNG bytes and the data version they were drawn from.
+        version = self.source.current_version()
+        key = (chart_id, version)
+        png = self.cache.get(key)
+        if png is not None:
+            return png, version
+        with span('chart'):
+            version, inputs = self.inputs()
+            return self._submit((chart_id, version), inputs).result(), version
+
+    def prerender(self, chart_ids=None):
+        # Starts the charts of chart_ids, all by default, not cached yet in
+        # the pool without waiting for them. Without a pool charts are only
+        # drawn when asked for.
+        if self.processes <= 1:
+            return
+        version = self.source.current_version()
+        missing = [chart_id for chart_id in chart_ids or CHARTS if self.cache.get((chart_id, version)) is None]
+        if missing:
+            version, inputs = self.inputs()
+            for chart_id in missing:
+                self._submit((chart_id, version), inputs)
+
+    def _submit(self, key, inputs):
+        chart_id = key[0]
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            if self.processes > 1:
+                future = self.pool().submit(render, chart_id, inputs)
+            else:
+                future = Future()
+                future.set_running_or_notify_cancel()
+            self._pending[key] = future
+
+        if self.processes <= 1:
+            try:
+                future.set_result(render(chart_id, inputs))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+        if future.exception() is None:
+            self.cache.put(key, future.result())
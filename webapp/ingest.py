@@ -0,0 +1,232 @@
+import json
+import os
+import sys
+import time
+import zlib
+from io import BytesIO
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from pandas.api.types import union_categoricals
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.boroughs import load_index
+from timeindex import TimeIndex
+
+
+INGEST_VERSION = 3
+BOROUGH_BOUNDARIES = 'new-york-city-boroughs.geojson'
+
+# Per feed, by CSV name: text columns stored as categoricals, dates parsed
+# once at conversion, whether rows with borough '0' are dropped, and the
+# date the rows are sorted by. Columns missing from a file are skipped.
+FEEDS = {
+    'collisions': {
+        'categories': ['borough', 'on_street_name', 'off_street_name', 'cross_street_name',
+                       'contributing_factor_vehicle_1', 'contributing_factor_vehicle_2',
+                       'contributing_factor_vehicle_3', 'contributing_factor_vehicle_4',
+                       'contributing_factor_vehicle_5', 'vehicle_type_code1', 'vehicle_type_code2',
+                       'vehicle_type_code_3', 'vehicle_type_code_4', 'vehicle_type_code_5'],
+        'dates': ['crash_date'],
+        'drop_borough_0': True,
+        'sort_by': 'crash_date',
+    },
+    'constructions': {
+        'categories': ['name', 'boro', 'projdesc', 'consttype', 'buildingid', 'city', 'borough', 'nta'],
+        'dates': ['data_as_of'],
+        'drop_borough_0': True,
+        'sort_by': None,
+    },
+    'traffic': {
+        'categories': ['Boro', 'Roadway_Name', 'From_St', 'To_St', 'Direction'],
+        'dates': ['Date'],
+        'drop_borough_0': False,
+        'sort_by': 'Date',
+    },
+}
+
+
+def columnar_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.arrow'
+
+
+def source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return [INGEST_VERSION, stat.st_size, stat.st_mtime_ns]
+
+
+def csv_digest(csv_path, size):
+    # CRC32 of the first size bytes of the CSV, and whether they end with a
+    # complete line.
+    crc = 0
+    last = b''
+    with open(csv_path, 'rb') as f:
+        while size > 0:
+            chunk = f.read(min(size, 1 << 20))
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            size -= len(chunk)
+            last = chunk[-1:]
+    return crc, last == b'\n'
+
+
+def borough_labels(lng, lat, boundaries_path=BOROUGH_BOUNDARIES):
+    # Name of the borough polygon each point lies in, NaN outside all of
+    # them, from the cached index of the polygons.
+    return load_index(boundaries_path).labels(lng, lat)
+
+
+def feed_name(csv_path):
+    return os.path.splitext(os.path.basename(csv_path))[0]
+
+
+def read_options(csv_path):
+    # pd.read_csv arguments for the feed, with its text columns read as
+    # categoricals.
+    feed = FEEDS[feed_name(csv_path)]
+    return dict(dtype={c: 'category' for c in feed['categories']}, low_memory=False)
+
+
+def prepare(csv_path, source=None):
+    # The feed as a typed frame: categoricals, parsed dates, integer counts
+    # downcast, and the derived columns the dashboard used to compute on
+    # every load. source, if given, is read in place of the file.
+    df = pd.read_csv(source or csv_path, **read_options(csv_path))
+    return transform(feed_name(csv_path), df)
+
+
+def transform(name, df):
+    # The conversions of prepare() on a frame already read, which may hold
+    # only some of the rows or columns of the feed.
+    feed = FEEDS[name]
+    if feed['drop_borough_0'] and 'borough' in df:
+        df = df[df['borough'] != '0'].reset_index(drop=True)
+    for column in feed['dates']:
+        if column in df:
+            df[column] = pd.to_datetime(df[column])
+    for column in df.select_dtypes('integer').columns:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+    for column in df.select_dtypes('category').columns:
+        df[column] = df[column].cat.remove_unused_categories()
+
+    if name == 'constructions' and 'data_as_of' in df:
+        # Every project is shown as of 2023, keeping its month and day.
+        dates = df['data_as_of']
+        df['data_as_of'] = pd.to_datetime(pd.DataFrame({'year': 2023, 'month': dates.dt.month, 'day': dates.dt.day})) \
+            + (dates - dates.dt.normalize())
+    if name == 'traffic' and 'longitude' in df:
+        df['borough'] = borough_labels(df['longitude'], df['latitude'])
+    return df
+
+
+def read_metadata(csv_path):
+    try:
+        with pa.memory_map(columnar_path(csv_path)) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return {}
+    return {key.decode(): json.loads(value) for key, value in metadata.items() if key.startswith(b'navguard')}
+
+
+def appended_rows(csv_path, metadata):
+    # The rows added to the end of the CSV since its columnar copy was
+    # written, prepared on their own. None if the file changed in any other
+    # way, or the copy was written by another version.
+    previous = metadata.get('navguard_csv')
+    if metadata.get('navguard', [None])[0] != INGEST_VERSION or previous is None or not previous['newline']:
+        return None
+    if os.path.getsize(csv_path) <= previous['size'] or csv_digest(csv_path, previous['size'])[0] != previous['crc32']:
+        return None
+    with open(csv_path, 'rb') as f:
+        header = f.readline()
+        f.seek(previous['size'])
+        tail = f.read()
+    return prepare(csv_path, BytesIO(header + tail))
+
+
+def combine(old, new):
+    # The old rows followed by the new ones, keeping categoricals with the
+    # union of both sets of categories.
+    df = pd.concat([old, new], ignore_index=True)
+    for column in old.select_dtypes('category').columns:
+        if column in new and isinstance(new[column].dtype, pd.CategoricalDtype):
+            df[column] = union_categoricals([old[column], new[column]])
+    for column in df.select_dtypes('integer').columns:
+        df[column] = pd.to_numeric(df[column], downcast='integer')
+    return df
+
+
+def sort_by_date(csv_path, df):
+    # The rows in date order, missing dates last, so that each year or
+    # month is one run of rows (see timeindex.py).
+    column = FEEDS[feed_name(csv_path)]['sort_by']
+    if column is None:
+        return df
+    return df.sort_values(column, kind='stable', na_position='last', ignore_index=True)
+
+
+def convert(csv_path):
+    # Writes the feed as an uncompressed Arrow IPC file next to the CSV, so
+    # it can be memory-mapped and read a column at a time. The CSV's stamp
+    # goes into the schema metadata to tell when it is out of date, with
+    # its size and checksum: when rows were only appended to it, just those
+    # are parsed and labeled, and added to the rows already converted. Feeds
+    # with a sort_by date are stored in date order.
+    stamp = source_stamp(csv_path)
+    crc32, newline = csv_digest(csv_path, stamp[1])
+    new = appended_rows(csv_path, read_metadata(csv_path))
+    if new is None:
+        df = prepare(csv_path)
+    else:
+        old = feather.read_table(columnar_path(csv_path), memory_map=True).to_pandas()
+        df = combine(old, new)
+        print(f"Appended {len(new)} rows to {columnar_path(csv_path)}")
+    df = sort_by_date(csv_path, df)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'navguard': json.dumps(stamp).encode(),
+        b'navguard_csv': json.dumps({'size': stamp[1], 'crc32': crc32, 'newline': newline}).encode(),
+        b'navguard_sorted_by': json.dumps(FEEDS[feed_name(csv_path)]['sort_by']).encode(),
+    })
+    path = columnar_path(csv_path)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    feather.write_feather(table, tmp, compression='uncompressed')
+    os.replace(tmp, path)
+    return path
+
+
+def is_current(csv_path):
+    return read_metadata(csv_path).get('navguard') == source_stamp(csv_path)
+
+
+def load_feed(csv_path, columns=None, start=None, end=None):
+    # The feed as a DataFrame with only the given columns, read from its
+    # memory-mapped columnar copy, which is (re)built first if needed. For
+    # feeds stored in date order, start and end select the rows dated from
+    # start up to end without reading the others, and the frame is marked
+    # with attrs['sorted_by'] so later selections are slices as well.
+    if not is_current(csv_path):
+        print(f"Converting {csv_path} to {columnar_path(csv_path)}")
+        convert(csv_path)
+    path = columnar_path(csv_path)
+    sorted_by = read_metadata(csv_path).get('navguard_sorted_by')
+    table = feather.read_table(path, memory_map=True)
+    if sorted_by is not None and (start is not None or end is not None):
+        rows = TimeIndex(table.column(sorted_by).to_numpy()).rows(start, end)
+        table = table.slice(rows.start, rows.stop - rows.start)
+    if columns is not None:
+        table = table.select([c for c in columns if c in table.schema.names])
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    if sorted_by is not None and sorted_by in df:
+        df.attrs['sorted_by'] = sorted_by
+    return df
+
+
+if __name__ == '__main__':
+    for csv_path in sys.argv[1:] or [name + '.csv' for name in FEEDS]:
+        start = time.perf_counter()
+        path = convert(csv_path)
+        print(f"Wrote {path} in {time.perf_counter() - start:.1f}s")
@@ -1,49 +1,124 @@
-import base64
-from io import BytesIO
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
-from flask import Flask, jsonify, render_template
-from wordcloud import WordCloud
+from flask import Flask, Response, abort, jsonify, render_template, request
+from urllib.parse import urlencode
 from functions import (
+    HOUR_COLUMNS,
     read_data,
+    load_data,
+    load_streets,
     filter_traffic_data,
     filter_crash_data,
     aggregate_crash_data,
-    create_geo_dataframes,
-    plot_on_map_feature_groups,
-    analyze_construction_data,
-    analyze_collision_data,
-    analyze_traffic_data,
 )
-import folium
-from folium.plugins import FastMarkerCluster
-from geopy.geocoders import Nominatim
-import seaborn as sns
-import geopandas as gpd
-import matplotlib
-matplotlib.use('Agg')
+from aggregates import Materialized
+from charts import CHARTS, ChartCache, ChartService
+from streaming import chart_data, stream_layers
+from tiles import LAYERS, MAX_ZOOM, TileService, tile_map
+from timeindex import period, period_key
+from common.metrics import instrument, span
+from common.streets import SUGGESTIONS
 
 
 app = Flask(__name__)
+# Per-stage latencies and cache counters at /metrics; see common/metrics.py.
+instrument(app)
+
+DATA_FILES = ["collisions.csv", "constructions.csv", "traffic.csv"]
+DEFAULT_YEAR = 2022
+LAYER_NAMES = {'collisions': "Vehicle Collisions", 'constructions': "Construction Projects", 'traffic': "Traffic Projects"}
+# The charts templates/index.html shows, started as soon as the page is
+# asked for; the others are drawn only when requested.
+INDEX_CHARTS = [
+    'construction-types-by-borough', 'construction-starts-per-month', 'casualties-by-borough',
+    'collision-wordcloud', 'traffic-volume-heatmap', 'average-traffic-volume',
+]
+
+
+def request_period():
+    # The period asked for with ?year= or ?start=&end= (dates, end
+    # excluded), DEFAULT_YEAR without either, as a cache key.
+    try:
+        start, end = period(request.args.get('year', DEFAULT_YEAR), request.args.get('start'), request.args.get('end'))
+    except ValueError as e:
+        abort(400, str(e))
+    return period_key(start, end)
+
+
+def period_bounds(key):
+    return tuple(pd.Timestamp(d) for d in key.split('_'))
+
+
+def period_dashboard(key):
+    # The dashboard of the period of key. Whole years are also kept on
+    # disk; other ranges, which clients can make up at will, only in
+    # memory.
+    start, end = period_bounds(key)
+    whole_year = start.month == start.day == 1 and end == start + pd.DateOffset(years=1)
+    return dashboard.get(key, persist=whole_year)
+
+
+def period_layers(data, key):
+    # The map layers of the period of key: collision casualties per
+    # location, construction awards and traffic volumes, from slices of the
+    # loaded feeds.
+    start, end = period_bounds(key)
+    collision_data, construction_data, traffic_data = data
+
+    filtered_traffic_data = filter_traffic_data(traffic_data, start=start, end=end)
+    filtered_crash_data = filter_crash_data(collision_data, start=start, end=end)
+
+    return {
+        'collisions': aggregate_crash_data(filtered_crash_data),
+        'constructions': construction_data,
+        'traffic': filtered_traffic_data.assign(Average_volume=filtered_traffic_data[HOUR_COLUMNS].sum(axis=1) / 24),
+    }
 
-collision_data = pd.read_csv("collisions.csv")
-construction_data = pd.read_csv("constructions.csv")
-traffic_data = pd.read_csv("traffic.csv")
-
-collision_data = collision_data[collision_data['borough'] != '0']
-construction_data = construction_data[construction_data['borough'] != '0']
-
-construction_data['data_as_of'] = pd.to_datetime(construction_data['data_as_of'])
-construction_data['data_as_of'] = construction_data['data_as_of'].apply(lambda d: d.replace(year=2023))
-
-borough_boundaries_path = 'new-york-city-boroughs.geojson'
-borough_boundaries = gpd.read_file(borough_boundaries_path)
-
-traffic_geo = gpd.GeoDataFrame(traffic_data, geometry=gpd.points_from_xy(traffic_data['longitude'], traffic_data['latitude']))
-
-traffic_geo_with_borough = gpd.sjoin(traffic_geo, borough_boundaries, op='within')
 
-traffic_data['borough'] = traffic_geo_with_borough['name']
+def streamed_layers(paths, key):
+    # The same layers, from the CSVs read a chunk at a time rather than
+    # from the loaded feeds.
+    return stream_layers(paths, *period_bounds(key))
+
+
+def build_dashboard(data, key):
+    # The map for the period of key. It only names the tiles its layers are
+    # drawn from, which are built on demand by /tiles. The charts are
+    # served by /charts.
+    query = urlencode(dict(zip(('start', 'end'), key.split('_')), v=dashboard.version))
+    m = tile_map(f'/tiles/{{layer}}/{{z}}/{{x}}/{{y}}?{query}', LAYER_NAMES)
+    return dict(map_html=m.get_root().render())
+
+
+# The dashboard is rebuilt only when one of the CSVs changes on disk. With
+# NAVGUARD_STREAMING set the feeds are never held whole in memory: the map
+# tiles are built from them a chunk at a time, and the charts from the
+# chart columns and the traffic's hourly aggregates (see
+# streaming.chart_data).
+if os.environ.get('NAVGUARD_STREAMING'):
+    dashboard = Materialized(DATA_FILES, list, build_dashboard, 'dashboard')
+    dashboard.data()
+    chart_source = Materialized(DATA_FILES, chart_data, None, 'charts')
+    tiles = TileService(dashboard, streamed_layers, ChartCache(name='tiles'))
+else:
+    dashboard = Materialized(DATA_FILES, load_data, build_dashboard, 'dashboard')
+    dashboard.data()
+    chart_source = dashboard
+    tiles = TileService(dashboard, period_layers, ChartCache(name='tiles'))
+charts = ChartService(chart_source, processes=int(os.environ.get('NAVGUARD_CHART_PROCESSES', 0)) or None)
+# The streets named in the collisions, indexed when first asked for and
+# again whenever collisions.csv changes.
+streets = Materialized(DATA_FILES[:1], load_streets, None, 'streets')
+MAX_SUGGESTIONS = 50
+
+
+@app.route('/ready')
+def ready():
+    # For load balancers and process managers: 200 once the feeds of the
+    # current data version are loaded, 503 while they are not.
+    if dashboard.version is None or dashboard.version != dashboard.current_version():
+        return jsonify(ready=False), 503
+    return jsonify(ready=True, data_version=dashboard.version, pid=os.getpid())
 
 
 @app.route('/collisions-heatmap')
@@ -62,190 +137,65 @@ def construction_heatmap():
 
 @app.route("/")
 def home():
-
-    year = 2022
-    filtered_traffic_data = filter_traffic_data(traffic_data, year)
-    filtered_crash_data = filter_crash_data(collision_data, year)
-
-    aggregated_crash_data = aggregate_crash_data(filtered_crash_data)
-
-    traffic_gdf, construction_gdf, collision_gdf = create_geo_dataframes(
-        filtered_traffic_data, construction_data, aggregated_crash_data
-    )
-
-    map_html = (
-        plot_on_map_feature_groups(traffic_gdf, construction_gdf, collision_gdf)
-        .get_root()
-        .render()
-    )
-
-    proj_per_boro, proj_dist, award_boro = analyze_construction_data(construction_data)
-
-    collision_boro, pie_chart = analyze_collision_data(collision_data)
-    
-    construction_types_by_borough_image = construction_types_by_borough().json['image']
-    construction_starts_per_month_image = construction_starts_per_month().json['image']
-    casualties_by_borough_image = casualties_by_borough().json['image']
-    collision_wordcloud_image = collision_wordcloud().json['image']
-    traffic_volume_heatmap_image = traffic_volume_heatmap().json['image']
-    average_traffic_volume_image = average_traffic_volume().json['image']
-    
-
-
-    (heatmaps) = analyze_traffic_data(traffic_data)
-
-    return render_template(
-        "index.html",
-        map_html=map_html,
-        proj_per_boro=proj_per_boro,
-        proj_dist=proj_dist,
-        award_boro=award_boro,
-        collision_boro=collision_boro,
-        pie_chart=pie_chart,
-        heatmap=heatmaps,
-        construction_types_by_borough_image=construction_types_by_borough_image,
-        construction_starts_per_month_image=construction_starts_per_month_image,
-        casualties_by_borough_image=casualties_by_borough_image,
-        collision_wordcloud_image=collision_wordcloud_image,
-        traffic_volume_heatmap_image=traffic_volume_heatmap_image,
-        average_traffic_volume_image=average_traffic_volume_image,
-        
-    )
-
-def construction_types_by_borough():
-    construction_type_counts = construction_data.groupby(['borough', 'consttype']).size().unstack()
-    construction_type_counts.plot(kind='bar', stacked=True, figsize=(10, 10))
-    plt.title('Number of Each Construction Type by Borough')
-    plt.xlabel('Borough')
-    plt.ylabel('Count')
-    plt.xticks(rotation=45)
-    plt.legend(title='Construction Type')
-
-    return jsonify({"image": save_plot_to_base64()})
-
-
-def construction_starts_per_month():
-    construction_data['data_as_of'] = pd.to_datetime(construction_data['data_as_of'])
-    construction_counts = construction_data['data_as_of'].dt.to_period('M').value_counts().sort_index()
-
-    plt.figure(figsize=(12, 6))
-    construction_counts.plot(kind='bar')
-    plt.title('Construction Starts Per Month')
-    plt.xlabel('Month')
-    plt.ylabel('Count')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-
-    return jsonify({"image": save_plot_to_base64()})
-
-
-def casualties_by_borough():
-    borough_casualties = collision_data.groupby('borough')['number_of_persons_killed'].sum()
-
-    plt.figure(figsize=(8, 8))
-    plt.pie(borough_casualties, labels=borough_casualties.index, autopct='%1.1f%%', startangle=140, colors=['lightcoral', 'lightskyblue', 'lightgreen', 'lightyellow', 'lightpink'])
-    plt.title('Distribution of Casualties Due to Traffic Collision by Borough')
-
-    return jsonify({"image": save_plot_to_base64()})
-
-
-def collision_wordcloud():
-    contributing_factors = collision_data['contributing_factor_vehicle_1'].str.cat(collision_data['contributing_factor_vehicle_2'], sep=', ')
-    contributing_factors = contributing_factors.dropna()
-    wordcloud = WordCloud(width=800, height=400, background_color='white').generate(' '.join(contributing_factors))
-
-    plt.figure(figsize=(10, 5))
-    plt.imshow(wordcloud, interpolation='bilinear')
-    plt.title('Word Cloud of Contributing Factors in Collisions')
-    plt.axis('off')
-
-    return jsonify({"image": save_plot_to_base64()})
-
-
-def traffic_volume_heatmap():
-    traffic_data_copy = traffic_data.copy()
-    traffic_data_copy['Date'] = pd.to_datetime(traffic_data_copy['Date'])
-    traffic_data_copy['DayOfWeek'] = traffic_data_copy['Date'].dt.day_name()
-
-    day_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    traffic_data_copy['DayOfWeek'] = pd.Categorical(traffic_data_copy['DayOfWeek'], categories=day_order, ordered=True)
-    traffic_data_copy.columns = traffic_data_copy.columns.str.strip()
-
-    hour_rename = {
-        '_12_00_1_00_am': '00:00', '_1_00_2_00am': '01:00', '_2_00_3_00am': '02:00',
-        '_3_00_4_00am': '03:00', '_4_00_5_00am': '04:00', '_5_00_6_00am': '05:00',
-        '_6_00_7_00am': '06:00', '_7_00_8_00am': '07:00', '_8_00_9_00am': '08:00',
-        '_9_00_10_00am': '09:00', '_10_00_11_00am': '10:00', '_11_00_12_00pm': '11:00',
-        '_12_00_1_00pm': '12:00', '_1_00_2_00pm': '13:00', '_2_00_3_00pm': '14:00',
-        '_3_00_4_00pm': '15:00', '_4_00_5_00pm': '16:00', '_5_00_6_00pm': '17:00',
-        '_6_00_7_00pm': '18:00', '_7_00_8_00pm': '19:00', '_8_00_9_00pm': '20:00',
-        '_9_00_10_00pm': '21:00', '_10_00_11_00pm': '22:00', '_11_00_12_00am': '23:00'
-    }
-    traffic_data_copy.rename(columns=hour_rename, inplace=True)
-
-    hour_columns = list(hour_rename.values())
-    traffic_data_long = traffic_data_copy.melt(id_vars=['DayOfWeek', 'Date'], value_vars=hour_columns, var_name='Hour', value_name='TrafficVolume')
-    pivot_table = traffic_data_long.pivot_table(index='DayOfWeek', columns='Hour', values='TrafficVolume', aggfunc='mean')
-
-    plt.figure(figsize=(18, 5))
-    sns.heatmap(pivot_table, cmap='Blues', annot=False)
-    plt.title('Traffic Volume Heatmap by Hour and Day of Week')
-    plt.ylabel('Day of Week')
-    plt.xlabel('Hour of Day')
-    plt.xticks(rotation=90)
-    plt.yticks(rotation=0)
-    plt.tight_layout()
-
-    return jsonify({"image": save_plot_to_base64()})
-
-
-def average_traffic_volume():
-    hourly_columns = [
-        '_12_00_1_00_am', '_1_00_2_00am', '_2_00_3_00am', '_3_00_4_00am',
-        '_4_00_5_00am', '_5_00_6_00am', '_6_00_7_00am', '_7_00_8_00am',
-        '_8_00_9_00am', '_9_00_10_00am', '_10_00_11_00am', '_11_00_12_00pm',
-        '_12_00_1_00pm', '_1_00_2_00pm', '_2_00_3_00pm', '_3_00_4_00pm',
-        '_4_00_5_00pm', '_5_00_6_00pm', '_6_00_7_00pm', '_7_00_8_00pm',
-        '_8_00_9_00pm', '_9_00_10_00pm', '_10_00_11_00pm', '_11_00_12_00am'
-    ]
-
-    average_volume_per_hour = traffic_data[hourly_columns].mean()
-    hour_labels = [f'{i}:00' for i in range(24)]
-    average_volume_df = pd.DataFrame({'Hour': hour_labels, 'Average_volume': average_volume_per_hour.values})
-
-    plt.figure(figsize=(10, 6))
-    sns.barplot(x='Hour', y='Average_volume', data=average_volume_df)
-    sns.lineplot(x='Hour', y='Average_volume', data=average_volume_df, sort=False)
-    plt.title('Average Traffic Volume per Hour of Day')
-    plt.xlabel('Hour of Day')
-    plt.ylabel('Average Volume')
-    plt.xticks(rotation=45, ha='right')
-
-    return jsonify({"image": save_plot_to_base64()})
-
-def average_volume_by_borough():
-    collision_data = pd.read_csv("collisions.csv")
-    construction_data = pd.read_csv("constructions.csv")
-    traffic_data = pd.read_csv("traffic.csv")
-    borough_volume = traffic_data.groupby('borough')['Average_volume'].mean().reset_index()
-
-    plt.figure(figsize=(12, 6))
-    sns.barplot(x='borough', y='Average_volume', data=borough_volume)
-    plt.title('Average Traffic Volume by Borough')
-    plt.xlabel('Borough')
-    plt.ylabel('Average Volume')
-
-    return jsonify({"image": save_plot_to_base64()})
-
-def save_plot_to_base64():
-    buf = BytesIO()
-    plt.savefig(buf, format="png")
-    buf.seek(0)
-    plot_url = base64.b64encode(buf.read()).decode('utf-8')
-    buf.close()
-    plt.clf()
-    return plot_url
-
+    with span('dashboard'):
+        context = period_dashboard(request_period())
+    with span('prerender'):
+        charts.prerender(INDEX_CHARTS)
+    with span('render'):
+        return render_template("index.html", data_version=dashboard.version, **context)
+
+
+@app.route("/map")
+def period_map():
+    return period_dashboard(request_period())['map_html']
+
+
+@app.route('/charts/<chart_id>.png')
+def chart(chart_id):
+    if chart_id not in CHARTS:
+        abort(404)
+    png, version = charts.png(chart_id)
+    response = Response(png, mimetype='image/png')
+    response.set_etag(f'{chart_id}-{version}')
+    # Pages link to the charts with the data version in the URL, so those
+    # URLs never change content; anything else is revalidated.
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000 if request.args.get('v') == version else 0
+    return response.make_conditional(request)
+
+
+@app.route('/tiles/<layer>/<int:z>/<int:x>/<int:y>')
+def tile(layer, z, x, y):
+    # One tile of a map layer for the period asked for, as JSON columns of
+    # lat, lng, count and value. Cached like the charts.
+    if layer not in LAYERS or z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        abort(404)
+    key = request_period()
+    body, version = tiles.tile(key, layer, z, x, y)
+    response = Response(body, mimetype='application/json')
+    response.set_etag(f'{layer}-{version}-{key}-{z}-{x}-{y}')
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000 if request.args.get('v') == version else 0
+    return response.make_conditional(request)
+
+
+@app.route('/api/streets')
+def street_suggestions():
+    # Streets for an address input, ?q= being what was typed so far, with
+    # their collision counts.
+    try:
+        limit = max(1, min(int(request.args.get('limit', SUGGESTIONS)), MAX_SUGGESTIONS))
+    except ValueError:
+        abort(400, "limit must be a number")
+    return jsonify(streets=streets.data().complete(request.args.get('q', ''), limit))
+
+
+@app.route('/api/streets/<path:name>')
+def street_collisions(name):
+    street = streets.data().street(name)
+    if street is None:
+        return jsonify(error="No collisions on this street"), 404
+    return jsonify(street)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+import sys
+import time
+
+import pandas as pd
+
+from functions import CASUALTY_COLUMNS, CONSTRUCTION_COLUMNS, HOUR_COLUMNS
+from ingest import feed_name, read_options, transform
+from timeindex import period
+
+
+# Rows read from a CSV at a time. Peak memory follows this and the size of
+# the aggregates, not the length of the feeds.
+CHUNK_ROWS = 200000
+
+CRASH_KEYS = ["borough", "latitude", "longitude"]
+CRASH_COLUMNS = [
+    "number_of_persons_injured", "number_of_persons_killed",
+    "number_of_cyclist_injured", "number_of_cyclist_killed",
+    "number_of_motorist_injured", "number_of_motorist_killed",
+]
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+# The collision columns the dashboard charts draw from.
+CHART_CRASH_COLUMNS = ["borough", *CASUALTY_COLUMNS, "contributing_factor_vehicle_1", "contributing_factor_vehicle_2"]
+
+
+def read_chunks(csv_path, columns=None, chunk_rows=CHUNK_ROWS):
+    # The feed as frames of at most chunk_rows rows, each converted as
+    # ingest.prepare() converts the whole file. Only the given columns are
+    # parsed, and borough, which rows are dropped by.
+    needed = None
+    if columns is not None:
+        needed = set(columns) | {'borough'}
+    reader = pd.read_csv(csv_path, usecols=needed and (lambda c: c in needed), chunksize=chunk_rows,
+                         **read_options(csv_path))
+    name = feed_name(csv_path)
+    with reader:
+        for chunk in reader:
+            chunk = transform(name, chunk)
+            yield chunk if columns is None else chunk[[c for c in columns if c in chunk]]
+
+
+def in_period(chunks, column, start, end):
+    # The rows of each chunk dated from start up to end, as
+    # filter_crash_data/filter_traffic_data select them.
+    for chunk in chunks:
+        dates = chunk[column]
+        chunk = chunk[(dates >= start) & (dates < end)]
+        if len(chunk):
+            yield chunk
+
+
+def in_year(chunks, column, year):
+    return in_period(chunks, column, *period(year))
+
+
+# Partial aggregates: update() folds in one chunk, combine() merges the
+# partial of another run (another file, or another process's share of the
+# chunks) and result() gives the same frame the whole-table helpers in
+# functions.py compute. The aggregates hold one row per group, never one
+# per input row.
+
+class CrashAggregate:
+    # aggregate_crash_data(): the mean of each casualty count per location,
+    # kept as sums and counts until the end.
+
+    def __init__(self):
+        self.sums = None
+        self.counts = None
+
+    def update(self, chunk):
+        keys = [chunk[k].astype(object) if k == 'borough' else chunk[k] for k in CRASH_KEYS]
+        groups = chunk[CRASH_COLUMNS].groupby(keys)
+        self._add(groups.sum(), groups.count())
+        return self
+
+    def combine(self, other):
+        if other.sums is not None:
+            self._add(other.sums, other.counts)
+        return self
+
+    def _add(self, sums, counts):
+        if self.sums is None:
+            self.sums, self.counts = sums, counts
+        else:
+            self.sums = self.sums.add(sums, fill_value=0)
+            self.counts = self.counts.add(counts, fill_value=0)
+
+    def result(self):
+        if self.sums is None:
+            return pd.DataFrame(columns=CRASH_KEYS + ["total_casualties"])
+        means = (self.sums / self.counts).sort_index().reset_index()
+        means["total_casualties"] = means[CRASH_COLUMNS].sum(axis=1)
+        return means[CRASH_KEYS + ["total_casualties"]]
+
+
+class HourlyVolume:
+    # The traffic counts' hourly columns summed per weekday, with the
+    # number of counts behind each sum: enough for the average volume per
+    # hour of day, overall or by weekday. Counts without a date are summed
+    # under NaN, so they still count overall. Each count's mean hourly
+    # volume is also summed per weekday and hour of its Date.
+
+    def __init__(self):
+        self.sums = pd.DataFrame(0.0, index=range(7), columns=HOUR_COLUMNS)
+        self.counts = pd.DataFrame(0, index=range(7), columns=HOUR_COLUMNS)
+        self.day_sums = None
+        self.day_counts = None
+
+    def update(self, chunk):
+        dates = chunk['Date']
+        groups = chunk[HOUR_COLUMNS].groupby(dates.dt.dayofweek.rename(None), dropna=False)
+        self.sums = self.sums.add(groups.sum(), fill_value=0)
+        self.counts = self.counts.add(groups.count(), fill_value=0)
+        average = chunk[HOUR_COLUMNS].sum(axis=1) / 24
+        groups = average.groupby([dates.dt.dayofweek.rename('weekday'), dates.dt.hour.rename('hour')])
+        self._add_days(groups.sum(), groups.count())
+        return self
+
+    def combine(self, other):
+        self.sums = self.sums.add(other.sums, fill_value=0)
+        self.counts = self.counts.add(other.counts, fill_value=0)
+        if other.day_sums is not None:
+            self._add_days(other.day_sums, other.day_counts)
+        return self
+
+    def _add_days(self, sums, counts):
+        if self.day_sums is None:
+            self.day_sums, self.day_counts = sums, counts
+        else:
+            self.day_sums = self.day_sums.add(sums, fill_value=0)
+            self.day_counts = self.day_counts.add(counts, fill_value=0)
+
+    def by_hour(self):
+        return self.sums.sum() / self.counts.sum()
+
+    def by_weekday(self):
+        means = (self.sums / self.counts).reindex(range(7))
+        means.index = DAY_NAMES
+        return means.dropna(how='all')
+
+    def by_weekday_and_hour(self):
+        # The mean of the counts' mean hourly volume, by weekday (rows) and
+        # hour of their Date (columns).
+        if self.day_sums is None:
+            return pd.DataFrame()
+        means = (self.day_sums / self.day_counts).unstack('hour')
+        means.index = [DAY_NAMES[int(day)] for day in means.index]
+        return means
+
+
+class CollisionSummary:
+    # What the collision charts draw: per borough ('' for rows without
+    # one) the collisions, the persons killed and all casualties, and how
+    # often each pair of contributing factors was reported, as
+    # "factor 1, factor 2".
+
+    def __init__(self):
+        self.boroughs = None
+        self.factors = None
+
+    def update(self, chunk):
+        frame = pd.DataFrame({'collisions': 1, 'killed': chunk['number_of_persons_killed'],
+                              'casualties': chunk[CASUALTY_COLUMNS].sum(axis=1)})
+        boroughs = frame.groupby(chunk['borough'].astype(object).fillna('').to_numpy()).sum()
+        factors = chunk['contributing_factor_vehicle_1'].astype(object).str.cat(
+            chunk['contributing_factor_vehicle_2'].astype(object), sep=', ').value_counts()
+        self._add(boroughs, factors)
+        return self
+
+    def combine(self, other):
+        if other.boroughs is not None:
+            self._add(other.boroughs, other.factors)
+        return self
+
+    def _add(self, boroughs, factors):
+        if self.boroughs is None:
+            self.boroughs, self.factors = boroughs, factors
+        else:
+            self.boroughs = self.boroughs.add(boroughs, fill_value=0)
+            self.factors = self.factors.add(factors, fill_value=0)
+
+    def by_borough(self, column, unknown='Unknown'):
+        # column per borough, sorted by name; rows without a borough are
+        # labelled unknown, or left out when it is None.
+        if self.boroughs is None:
+            return pd.Series(dtype=float)
+        values = self.boroughs[column].sort_index()
+        if unknown is None:
+            return values.drop('', errors='ignore')
+        return values.rename(index={'': unknown}).sort_index()
+
+
+class Rows:
+    # The selected rows themselves, in the given columns only, for outputs
+    # that draw every row. Unlike the aggregates it grows with the rows
+    # selected.
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.parts = []
+
+    def update(self, chunk):
+        self.parts.append(chunk[self.columns])
+        return self
+
+    def combine(self, other):
+        self.parts.extend(other.parts)
+        return self
+
+    def result(self):
+        if not self.parts:
+            return pd.DataFrame(columns=self.columns)
+        return pd.concat(self.parts, ignore_index=True)
+
+
+def aggregate(chunks, *partials):
+    # Feeds every chunk to each of the partials, one chunk in memory at a
+    # time, and returns the partials.
+    for chunk in chunks:
+        for partial in partials:
+            partial.update(chunk)
+    return partials
+
+
+def with_average_volume(chunks):
+    # Each traffic count's mean hourly volume, as the dashboard shows it.
+    for chunk in chunks:
+        yield chunk.assign(Average_volume=chunk[HOUR_COLUMNS].sum(axis=1) / 24)
+
+
+def chart_data(paths, chunk_rows=CHUNK_ROWS):
+    # The (collision, construction, traffic) data the dashboard charts draw
+    # from, read a chunk at a time: the collisions as a CollisionSummary
+    # and the traffic counts as an HourlyVolume, neither growing with the
+    # feeds, and the small construction feed in the columns the charts use.
+    collision_path, construction_path, traffic_path = paths
+    crashes, = aggregate(read_chunks(collision_path, CHART_CRASH_COLUMNS, chunk_rows), CollisionSummary())
+    constructions = pd.concat(read_chunks(construction_path, CONSTRUCTION_COLUMNS, chunk_rows), ignore_index=True)
+    volume, = aggregate(read_chunks(traffic_path, ["Date", *HOUR_COLUMNS], chunk_rows), HourlyVolume())
+    return crashes, constructions, volume
+
+
+def stream_layers(paths, start, end, chunk_rows=CHUNK_ROWS):
+    # The frames the dashboard map layers are drawn from, as
+    # main.period_layers() derives them from the loaded feeds, read a chunk
+    # at a time.
+    collision_path, construction_path, traffic_path = paths
+    crashes, = aggregate(in_period(read_chunks(collision_path, ["crash_date", *CRASH_KEYS, *CRASH_COLUMNS], chunk_rows),
+                                   "crash_date", start, end), CrashAggregate())
+    traffic, = aggregate(with_average_volume(in_period(read_chunks(traffic_path, ["Date", "latitude", "longitude", *HOUR_COLUMNS],
+                                                                   chunk_rows), "Date", start, end)),
+                         Rows(["latitude", "longitude", "Average_volume"]))
+    construction, = aggregate(read_chunks(construction_path, ["latitude", "longitude", "award"], chunk_rows),
+                              Rows(["latitude", "longitude", "award"]))
+    return {'collisions': crashes.result(), 'constructions': construction.result(), 'traffic': traffic.result()}
+
+
+if __name__ == '__main__':
+    # python streaming.py YEAR [collisions.csv traffic.csv]: the year's
+    # collision and traffic aggregates, without loading either file whole.
+    year = int(sys.argv[1]) if len(sys.argv) > 1 else 2022
+    collision_path, traffic_path = sys.argv[2:4] if len(sys.argv) > 3 else ('collisions.csv', 'traffic.csv')
+    start = time.perf_counter()
+    crashes, = aggregate(in_year(read_chunks(collision_path, ["crash_date", *CRASH_KEYS, *CRASH_COLUMNS]), "crash_date", year),
+                         CrashAggregate())
+    volume, = aggregate(in_year(read_chunks(traffic_path, ["Date", *HOUR_COLUMNS]), "Date", year), HourlyVolume())
+    print(f"{len(crashes.result())} collision locations in {year}")
+    print(volume.by_hour().round(1).to_string())
+    print(f"Aggregated in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,185 @@
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import folium
+import numpy as np
+from folium.map import Layer
+from folium.template import Template
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.layers import mercator, point_columns, zoom_layer
+from common.metrics import span
+
+
+# Points are ordered along a quadtree this deep; tiles up to this zoom are
+# one run of them.
+MAX_ZOOM = 20
+# Periods whose pyramids are kept in memory at once.
+PYRAMIDS = 4
+
+# Per layer: the column each point's value comes from, its popup label and
+# colour.
+LAYERS = {
+    'collisions': ('total_casualties', 'Total casualties ', 'red'),
+    'constructions': ('award', 'Construction award ', 'blue'),
+    'traffic': ('Average_volume', 'Traffic volume ', 'green'),
+}
+
+
+def _spread(v):
+    # The bits of v with a zero after each, to interleave two coordinates.
+    v = v.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def quadkey(x, y):
+    return _spread(np.asarray(x)) | (_spread(np.asarray(y)) << np.uint64(1))
+
+
+class TilePyramid:
+    # The points of one layer sorted by their tile at MAX_ZOOM in quadtree
+    # order, so the points of any tile at any zoom are found by binary
+    # search. tile() merges them into grid cells as common/layers.py does
+    # for whole layers.
+
+    def __init__(self, lat, lng, values):
+        x, y = mercator(lat, lng)
+        side = 2 ** MAX_ZOOM
+        keys = quadkey(np.clip(x * side, 0, side - 1).astype(np.int64), np.clip(y * side, 0, side - 1).astype(np.int64))
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.lat = lat[order]
+        self.lng = lng[order]
+        self.values = None if values is None else values[order]
+
+    def rows(self, z, x, y):
+        shift = np.uint64(2 * (MAX_ZOOM - z))
+        first = quadkey(x, y) << shift
+        last = (quadkey(x, y) + np.uint64(1)) << shift
+        return slice(*np.searchsorted(self.keys, [first, last]))
+
+    def tile(self, z, x, y):
+        rows = self.rows(z, x, y)
+        values = None if self.values is None else self.values[rows]
+        return zoom_layer(self.lat[rows], self.lng[rows], values, z)
+
+
+class TileService:
+    # Serves the map layers of a period as tiles of a TilePyramid. The
+    # pyramids are built from source (a Materialized of the feeds) by
+    # build_layers(data, key), which returns a frame per LAYERS entry with
+    # latitude, longitude and its value column. Encoded tiles are kept in
+    # cache, a ChartCache, by data version, period and tile.
+
+    def __init__(self, source, build_layers, cache):
+        self.source = source
+        self.build_layers = build_layers
+        self.cache = cache
+        self._pyramids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pyramids(self, key):
+        with self._lock:
+            data = self.source.data()
+            version = self.source.version
+            pyramids = self._pyramids.get((version, key))
+            if pyramids is None:
+                with span('tile_pyramids'):
+                    frames = self.build_layers(data, key)
+                    pyramids = {layer: TilePyramid(*point_columns(frames[layer], LAYERS[layer][0]))
+                                for layer in LAYERS}
+                self._pyramids[(version, key)] = pyramids
+                while len(self._pyramids) > PYRAMIDS:
+                    self._pyramids.popitem(last=False)
+            self._pyramids.move_to_end((version, key))
+            return pyramids, version
+
+    def tile(self, key, layer, z, x, y):
+        # The tile as JSON bytes and the data version it was built from.
+        version = self.source.current_version()
+        cache_key = (version, key, layer, z, x, y)
+        body = self.cache.get(cache_key)
+        if body is not None:
+            return body, version
+        pyramids, version = self.pyramids(key)
+        body = json.dumps(pyramids[layer].tile(z, x, y), separators=(',', ':')).encode()
+        self.cache.put((version, key, layer, z, x, y), body)
+        return body, version
+
+
+class TileMarkers(Layer):
+    # A map layer drawn from /tiles: each visible tile is fetched as it
+    # comes into view and drawn as canvas circles, sized by the number of
+    # points a circle stands for, and dropped again when it leaves.
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function () {
+                var group = L.layerGroup();
+                var renderer = L.canvas({padding: 0.5});
+                var drawn = {};
+                var Grid = L.GridLayer.extend({
+                    createTile: function (coords, done) {
+                        var tile = document.createElement('div');
+                        var key = coords.z + '/' + coords.x + '/' + coords.y;
+                        drawn[key] = tile;
+                        fetch({{ this.url|tojson }}.replace('{z}', coords.z).replace('{x}', coords.x).replace('{y}', coords.y))
+                            .then(function (r) { return r.json(); })
+                            .then(function (data) {
+                                if (drawn[key] !== tile) { return; }
+                                var markers = [];
+                                for (var i = 0; i < data.lat.length; i++) {
+                                    var count = data.count[i];
+                                    var value = data.value[i] === null ? 'unknown' : data.value[i];
+                                    markers.push(L.circleMarker([data.lat[i], data.lng[i]], {
+                                        renderer: renderer,
+                                        radius: count > 1 ? Math.min(5 + 2 * Math.sqrt(count), 30) : 5,
+                                        color: {{ this.color|tojson }},
+                                        weight: 1,
+                                        fillOpacity: 0.6
+                                    }).bindPopup(count > 1
+                                        ? count + ' places, average ' + {{ this.label|tojson }} + value
+                                        : {{ this.label|tojson }} + value));
+                                }
+                                drawn[key] = L.layerGroup(markers).addTo(group);
+                                done(null, tile);
+                            }, function (error) { done(error, tile); });
+                        return tile;
+                    }
+                });
+                var grid = new Grid({tileSize: 256, maxZoom: {{ this.max_zoom }}});
+                grid.on('tileunload', function (e) {
+                    var key = e.coords.z + '/' + e.coords.x + '/' + e.coords.y;
+                    if (drawn[key] instanceof L.Layer) { group.removeLayer(drawn[key]); }
+                    delete drawn[key];
+                });
+                group.addLayer(grid);
+                return group;
+            })();
+            {{ this.get_name() }}.addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, url, label, color, name=None, max_zoom=MAX_ZOOM):
+        super().__init__(name=name)
+        self._name = 'TileMarkers'
+        self.url = url
+        self.label = label
+        self.color = color
+        self.max_zoom = max_zoom
+
+
+def tile_map(url, names):
+    # A map of the LAYERS drawn from tiles at url, a template with {layer},
+    # {z}, {x} and {y}. Its size does not depend on the data.
+    m = folium.Map(location=[40.7128, -74.0060], tiles="OpenStreetMap", zoom_start=12)
+    for layer, (_, label, color) in LAYERS.items():
+        TileMarkers(url.replace('{layer}', layer), label, color, name=names[layer]).add_to(m)
+    folium.LayerControl().add_to(m)
+    return m
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+
+
+class TimeIndex:
+    # Row positions of a frame sorted by a datetime column, as ingest.py
+    # writes the collision and traffic feeds (missing dates last). Any
+    # period is found by binary search and is a slice of the frame; no
+    # dates are parsed or compared row by row.
+
+    def __init__(self, dates):
+        self.dates = np.asarray(dates)
+        self.dated = int(np.searchsorted(self.dates, np.datetime64('NaT')))
+
+    def _position(self, when):
+        return int(np.searchsorted(self.dates[:self.dated], np.datetime64(pd.Timestamp(when)).astype(self.dates.dtype)))
+
+    def rows(self, start=None, end=None):
+        # The rows dated from start up to, not including, end.
+        first = 0 if start is None else self._position(start)
+        last = self.dated if end is None else self._position(end)
+        return slice(first, max(first, last))
+
+    def year(self, year):
+        return self.rows(f'{year}-01-01', f'{year + 1}-01-01')
+
+    def months(self):
+        # Rows by month, as {'2022-01': slice, ...}.
+        months, starts = np.unique(self.dates[:self.dated].astype('datetime64[M]'), return_index=True)
+        stops = np.append(starts[1:], self.dated)
+        return {str(month): slice(int(a), int(b)) for month, a, b in zip(months, starts, stops)}
+
+    def weekday(self, day, rows=slice(None)):
+        # Positions of the rows within rows dated on a weekday, Monday
+        # being 0. Weekdays do not form one slice, so this looks at each
+        # row of the period once.
+        first, last, _ = rows.indices(self.dated)
+        days = self.dates[first:last].astype('datetime64[D]').astype(np.int64)
+        # 1970-01-01 was a Thursday.
+        return np.flatnonzero((days + 3) % 7 == day) + first
+
+
+def period(year=None, start=None, end=None):
+    # The (start, end) dates a dashboard request asks for: a whole year, or
+    # from start up to end. Raises ValueError for anything else.
+    if start or end:
+        if not (start and end):
+            raise ValueError("start and end go together")
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if start is pd.NaT or end is pd.NaT:
+            raise ValueError("start and end must be dates")
+        start, end = start.normalize(), end.normalize()
+    else:
+        start = pd.Timestamp(year=int(year), month=1, day=1)
+        end = start + pd.DateOffset(years=1)
+    if start >= end:
+        raise ValueError("start must come before end")
+    return start, end
+
+
+def period_key(start, end):
+    return f'{start:%Y-%m-%d}_{end:%Y-%m-%d}'
+
+
+def select_period(df, column, start, end):
+    # The rows of df dated from start up to end. Frames loaded sorted by
+    # that column (see ingest.load_feed) are sliced, others scanned.
+    if df.attrs.get('sorted_by') == column:
+        return df.iloc[TimeIndex(df[column]).rows(start, end)]
+    dates = pd.to_datetime(df[column])
+    return df[(dates >= start) & (dates < end)]
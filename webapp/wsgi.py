@@ -0,0 +1,16 @@
+# Entry point for a preforking WSGI server such as gunicorn with
+# preload_app (see gunicorn.conf.py at the top of the repository). This
+# module is imported once, in the master process: the feeds are loaded and
+# the default dashboard and street index built here, and every worker
+# forked from the master shares them copy-on-write instead of loading its
+# own.
+import time
+
+started = time.perf_counter()
+
+from main import DEFAULT_YEAR, app, dashboard, streets
+from timeindex import period, period_key
+
+dashboard.get(period_key(*period(DEFAULT_YEAR)))
+streets.data()
+print(f"Dashboard loaded in {time.perf_counter() - started:.1f}s")